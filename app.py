@@ -1,66 +1,106 @@
 # app.py
 
-from flask import Flask, render_template, request, jsonify, current_app
-from chromecast_utils import discover_devices, send_message_to_device, serve_audio_file, get_local_ip
-from chromecast_utils import MessageQueue, pause_audio_on_device, stop_audio_on_device, PORT
-from threading import Thread
-import time
-import json, tempfile, os
-import logging
-from urllib.parse import urlparse, parse_qs, unquote
-from logging.handlers import RotatingFileHandler
-import pychromecast
-import requests
+from flask import Flask, Request, Response, render_template, request, jsonify
+from chromecast_utils import discover_devices, create_message_audio, serve_audio_file, serve_audio_stream, get_local_ip
+from chromecast_utils import pause_audio_on_device, stop_audio_on_device, fan_out, broadcast_synchronized, start_media, FANOUT_TIMEOUT, PORT
+from job_queue import message_queue, parse_priority, BATCH_WINDOW, BATCH_MAX_WINDOW
+from device_registry import registry, device_browser
+from shared_state import shared_state, service_lock
+from metrics import metrics, render_json, render_prometheus
+from audio_server import audio_server
+from events import event_hub, TooManySubscribers
+from tts_cache import tts_cache
+from tts_handler import preload as preload_tts
+from voice_catalog import voice_catalog
+from media_queue import media_queues, resolve_items, MediaQueueFull, UnknownDevice
+from media_types import content_type_resolver, AUDIO_MIME_TYPES, audio_mime_type
+from upload_store import upload_cache, upload_stream_factory, store_upload, UPLOAD_MAX_FILE_BYTES
+from audio_processing import audio_processor
+from logger_utils import setup_logger, bind_context, reset_context, dropped_records
+from federation import federation, FORWARDED_HEADER
+import json, os, socket, threading, time, uuid
+from urllib.parse import urlparse, parse_qs
+
+class UploadRequest(Request):
+    # Hash uploaded files while they are parsed instead of spooling them to an anonymous temp file
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_stream_factory(total_content_length, content_type, filename, content_length)
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_FILE_BYTES
 
-devices = []
-message_queue = MessageQueue()
-device_ip = {}
-
-def load_device_ip():
-    with current_app.open_resource('static/json/device_ip.json') as f:
-        return json.load(f)
-
-# Set up logging with rotation
-def setup_logger(name, log_file, level=logging.INFO):
-    handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
-
-    return logger
+STREAM_MIN_CHARS = 200  # Messages at least this long start playing while still being synthesized
+SERVICE_RETRY = 5.0     # Seconds between attempts to take over discovery and the job lanes
+NODE_NAME = os.environ.get('NESTCAST_NODE_NAME') or socket.gethostname()
+NODE_URL = os.environ.get('NESTCAST_NODE_URL')  # How peers reach this node; defaults to the LAN address
 
 # Create loggers
 app_logger = setup_logger('app', 'logs/app.log')
 
-def background_discovery():
-    global devices
-    while True:
-        try:
-            devices = discover_devices()
-            # Irritating logging
-            # app_logger.info(f"Discovered {len(devices)} devices")
-        except Exception as e:
-            app_logger.error(f"Error in device discovery: {str(e)}")
-        time.sleep(300)  # Discover devices every 5 minutes
-
-def process_queue():
-    while True:
-        message, device_name, volume, language = message_queue.get()
-        try:
-            volume = validate_volume(volume)
-            send_message_to_device(device_name, message, volume, language)
-            app_logger.info(f"Message sent to {device_name}")
-        except Exception as e:
-            app_logger.error(f"Error sending message to {device_name}: {str(e)}")
-        time.sleep(1)  # Small delay to prevent overloading
+@app.before_request
+def bind_request_id():
+    # Every log line of the request, and of the jobs it queues, carries this id
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16]
+    request.environ['nestcast.request_id'] = request_id
+    request.environ['nestcast.start'] = time.perf_counter()
+    request.environ['nestcast.log_token'] = bind_context(request_id=request_id)
+
+@app.after_request
+def add_request_id(response):
+    request_id = request.environ.get('nestcast.request_id')
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    start = request.environ.get('nestcast.start')
+    if start is not None:
+        # Lets a forwarding node tell our processing time from the network and pooling overhead
+        response.headers['Server-Timing'] = f"app;dur={(time.perf_counter() - start) * 1000:.1f}"
+    return response
+
+@app.teardown_request
+def unbind_request_id(exc):
+    token = request.environ.pop('nestcast.log_token', None)
+    if token is not None:
+        reset_context(token)
+
+def form_flag(name, default=False):
+    value = request.form.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+def forward_remote(device_names, files=None):
+    """
+    Forward this request to the nodes owning any of device_names, in the
+    background. Returns (the names handled here, the pending forwards).
+    A request that was itself forwarded is never forwarded again.
+    """
+    if not federation.enabled or request.headers.get(FORWARDED_HEADER):
+        return device_names, []
+    local_names, remote = federation.split(device_names)
+    body = request.get_json(silent=True) if request.is_json else None
+    forwards = []
+    for peer, names in remote.items():
+        app_logger.info(f"Forwarding {request.path} for {names} to {peer.name}")
+        if body is not None:
+            future = federation.forward(peer, request.path, names, json_body=dict(body, devices=names))
+        else:
+            form = dict(request.form.to_dict(), devices=json.dumps(names))
+            future = federation.forward(peer, request.path, names, form=form, files=files)
+        forwards.append((peer, names, future))
+    return local_names, forwards
+
+def with_forwarded(payload, forwards):
+    """Add the results of forwarded requests, and each node's round trip, to a response payload."""
+    if not forwards:
+        return payload
+    results, nodes = federation.collect(forwards)
+    payload["results"] = payload.get("results", []) + results
+    payload["nodes"] = nodes
+    return payload
 
 def validate_volume(volume):
-    print("input volume:", volume)
+    app_logger.debug(f"Input volume: {volume}")
     try:
         volume = float(volume)
         if 0.0 <= volume <= 1.0:
@@ -93,79 +133,53 @@ def determine_content_type(url):
         else:
             raise ValueError("Unable to extract YouTube video ID")
 
-    # Define known file extensions and their corresponding MIME types
-    mime_types = {
-        'mp4': 'video/mp4',
-        'mp3': 'audio/mpeg',
-        'wav': 'audio/wav',
-        'ogg': 'audio/ogg',
-        'webm': 'video/webm',
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'gif': 'image/gif'
-    }
-
-    # Parse the URL
-    parsed_url = urlparse(unquote(url))
-    path = parsed_url.path.lower()
-
-    # Check for known extensions in the path
-    for ext, mime_type in mime_types.items():
-        if path.endswith(f'.{ext}'):
-            app_logger.info(f"Determined content type from path: audio/{mime_type} for URL: {url}")
-            return url, mime_type
-
-    # If no extension found in path, try HEAD request
-    try:
-        response = requests.head(url, timeout=5, allow_redirects=True)
-        content_type = response.headers.get('content-type', '').lower()
-        
-        if content_type:
-            # Check if the content type is an image type
-            if content_type.startswith('image/'):
-                app_logger.info(f"Determined image content type from HEAD request: {content_type} for URL: {url}")
-                return url, content_type
-            
-            app_logger.info(f"Determined content type from HEAD request: {content_type} for URL: {url}")
-            return url, content_type
-    except requests.RequestException as e:
-        app_logger.error(f"Error in HEAD request: {str(e)}")
-
-    # If all else fails, try to guess the content type from the URL
-    for ext, mime_type in mime_types.items():
-        if f'.{ext}' in url.lower():
-            app_logger.info(f"Guessed content type from URL: {mime_type} for URL: {url}")
-            return url, mime_type
-
-    # If still unable to determine, default to application/octet-stream
-    app_logger.warning(f"Could not determine content type, defaulting to application/octet-stream for URL: {url}")
-    return url, 'application/octet-stream'
-
-def get_chromecast_device(device_name, chromecasts):
-    """Get the Chromecast device by name or fallback to device_ip."""
-    chromecast = next((cc for cc in chromecasts if cc.name == device_name), None)
-
-    if not chromecast:
-        # If the device is not found, check the device_ip dictionary
-        if device_name in device_ip:
-            ip_address = device_ip[device_name]
-            app_logger.info(f"Device {device_name} not found in discovered devices, using IP from device_ip: {ip_address}")
-            chromecast = pychromecast.Chromecast(ip_address)
-            chromecast.wait()
-        else:
-            app_logger.error(f"Device {device_name} not found")
-            raise ValueError(f"Device {device_name} not found")
+    # Known extensions resolve immediately; other URLs are probed once and cached
+    return url, content_type_resolver.resolve(url)
 
-    return chromecast
+def get_chromecast_device(device_name):
+    """Get the connected Chromecast device by name from the shared registry."""
+    try:
+        return registry.get(device_name)
+    except Exception as e:
+        app_logger.error(f"Device {device_name} not found: {str(e)}")
+        raise
 
 @app.route('/')
 def index():
-    return render_template('index.html', devices=devices)
+    return render_template('index.html', devices=discover_devices() + federation.devices())
 
 @app.route('/api/devices')
 def get_devices():
-    return jsonify(devices)
+    # Devices on other nodes carry the owning node's name; requests for them are forwarded
+    return jsonify(discover_devices() + federation.devices())
+
+@app.route('/api/voices')
+def get_voices():
+    """Edge TTS voices, optionally filtered by ?locale=, ?language= and ?gender=, with ETag revalidation."""
+    body, etag = voice_catalog.response(request.args.get('locale'), request.args.get('language'),
+                                        request.args.get('gender'))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response.make_conditional(request)
+
+@app.route('/api/events')
+def events():
+    """Server-Sent Events: device, health, player, volume and job updates, resumable with Last-Event-ID."""
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    types = request.args.get('types')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    # A fresh connection starts from the current state; a resumed one only needs what it missed
+    snapshot = None if last_id is not None else dict(event_hub.latest(), devices=discover_devices())
+    try:
+        frames = event_hub.stream(last_id, set(types.split(',')) if types else None, snapshot)
+    except TooManySubscribers:
+        return jsonify({"status": "Error", "message": "Too many event streams, poll instead"}), 503
+    return Response(frames, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/send_message', methods=['POST'])
 def send_message():
@@ -173,9 +187,11 @@ def send_message():
     message = request.form.get('message')
     volume = request.form.get('volume')
     language = request.form.get('language', 'en')  # Default to English
+    priority = request.form.get('priority')  # 'high', 'normal', 'low' or an integer, lower first
+    chime = form_flag('chime')  # Play the attention chime before the message
     device_names = json.loads(request.form.get('devices', '[]'))
     
-    app_logger.info(json.dumps(request.form.to_dict()))
+    app_logger.debug("Form fields", extra={"form": request.form.to_dict()})
     
     app_logger.info(f"Message: {message}, Volume: {volume} Language: {language}, Devices: {device_names}")
     
@@ -186,47 +202,126 @@ def send_message():
         app_logger.error(error_msg)
         return jsonify({"status": "Error", "message": error_msg}), 400
     
-    results = []
-    for device_name in device_names:
-        try:
-            app_logger.info(f"Attempting to send message to {device_name}")
-            send_message_to_device(device_name, message, volume, language)
-            results.append({"device": device_name, "status": "Message sent"})
-            app_logger.info(f"Message sent successfully to {device_name}")
-        except Exception as e:
-            error_msg = f"Error sending message to {device_name}: {str(e)}"
+    try:
+        priority = parse_priority(priority)
+    except ValueError as e:
+        app_logger.error(str(e))
+        return jsonify({"status": "Error", "message": str(e)}), 400
+
+    device_names, forwards = forward_remote(device_names)
+
+    if form_flag('sync'):
+        # Synchronized rooms start together, so this bypasses the per-device lanes
+        results = []
+        if device_names:
+            try:
+                audio_path = audio_processor.process(create_message_audio(message, language), chime)
+            except Exception as e:
+                app_logger.error(f"Error creating audio for message: {str(e)}")
+                return jsonify(with_forwarded({"status": "Error", "message": str(e)}, forwards)), 500
+            audio_url = f"http://{get_local_ip()}:{PORT}/audio/{audio_path}"
+            results = broadcast_synchronized(device_names, audio_url, "audio/mp3", volume)
+        return jsonify(with_forwarded({"results": results}, forwards))
+
+    # Long messages start playing while they are still being synthesized
+    stream = form_flag('stream', default=len(message) >= STREAM_MIN_CHARS)
+    job = None
+    if device_names:
+        job = message_queue.submit(message, device_names, volume, language, priority=priority, stream=stream,
+                                   chime=chime)
+    job_id = job.id if job else None
+
+    # Callers that need the outcome in the response can still wait for it
+    if form_flag('wait'):
+        status = message_queue.wait(job.id, timeout=FANOUT_TIMEOUT) if job else None
+        return jsonify(with_forwarded({"job_id": job_id, "results": status["results"] if status else []}, forwards))
+    return jsonify(with_forwarded({"job_id": job_id, "status": "Queued"}, forwards)), 202
+
+@app.route('/api/send_batch', methods=['POST'])
+def send_batch():
+    """
+    Queue several messages at once. Messages reaching the same device within
+    `window` seconds play as one clip, and exact duplicates are dropped.
+    """
+    app_logger.info("Received request to /api/send_batch")
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        error_msg = "Missing items"
+        app_logger.error(error_msg)
+        return jsonify({"status": "Error", "message": error_msg}), 400
+
+    try:
+        priority = parse_priority(data.get('priority'))
+        window = min(max(float(data.get('window', BATCH_WINDOW)), 0.0), BATCH_MAX_WINDOW)
+    except (TypeError, ValueError) as e:
+        app_logger.error(str(e))
+        return jsonify({"status": "Error", "message": str(e)}), 400
+
+    # Validate every item before queueing any, so a bad item does not leave half a batch behind
+    messages = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('message') or not item.get('devices'):
+            error_msg = f"Item {index}: missing message or devices"
             app_logger.error(error_msg)
-            results.append({"device": device_name, "status": "Error", "message": str(e)})
-    
-    return jsonify({"results": results})
+            return jsonify({"status": "Error", "message": error_msg}), 400
+        devices = item['devices'] if isinstance(item['devices'], list) else [item['devices']]
+        volume = validate_volume(item.get('volume', data.get('volume')))
+        language = item.get('voice') or item.get('language') or data.get('voice') or data.get('language', 'en')
+        messages.append((item['message'], devices, volume, language))
+
+    messages, forwards = forward_batch(data, messages)
+
+    # Batched clips are joined once synthesized, so they are never streamed
+    jobs = [message_queue.submit(message, devices, volume, language, priority=priority, coalesce_window=window,
+                                 chime=bool(data.get('chime')))
+            for message, devices, volume, language in messages]
+    app_logger.info(f"Queued batch of {len(jobs)} messages with a {window}s window")
+
+    if data.get('wait'):
+        statuses = [message_queue.wait(job.id, timeout=FANOUT_TIMEOUT + window) for job in jobs]
+        return jsonify(with_forwarded({"jobs": [status or {"job_id": job.id} for job, status in zip(jobs, statuses)]},
+                                      forwards))
+    return jsonify(with_forwarded({"job_ids": [job.id for job in jobs], "status": "Queued"}, forwards)), 202
+
+def forward_batch(data, messages):
+    """
+    Like forward_remote, for /api/send_batch: each peer gets the items that
+    name its devices, limited to those devices, so it can coalesce them
+    itself. Returns (the messages left for this node, the pending forwards).
+    """
+    if not federation.enabled or request.headers.get(FORWARDED_HEADER):
+        return messages, []
+    local_messages, remote_items = [], {}
+    for (message, devices, volume, language), item in zip(messages, data['items']):
+        local_names, remote = federation.split(devices)
+        if local_names:
+            local_messages.append((message, local_names, volume, language))
+        for peer, names in remote.items():
+            remote_items.setdefault(peer, []).append(dict(item, devices=names))
+    forwards = []
+    for peer, items in remote_items.items():
+        names = list(dict.fromkeys(name for item in items for name in item['devices']))
+        app_logger.info(f"Forwarding {len(items)} batch items for {names} to {peer.name}")
+        forwards.append((peer, names, federation.forward(peer, request.path, names, json_body=dict(data, items=items))))
+    return local_messages, forwards
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    status = message_queue.status(job_id)
+    if status is None and federation.enabled and not request.headers.get(FORWARDED_HEADER):
+        # Jobs for devices on other nodes are queued there, under the id the forwarded request returned
+        status = federation.find(request.path)
+    if status is None:
+        return jsonify({"status": "Error", "message": f"Unknown job {job_id}"}), 404
+    return jsonify(status)
 
 @app.route('/api/discover', methods=['POST'])
 def trigger_discovery():
-    global devices
-    try:
-        devices = discover_devices()
-        app_logger.info(f"Manual discovery completed, found {len(devices)} devices")
-        return jsonify({"status": "Discovery completed", "devices": devices})
-    except Exception as e:
-        app_logger.error(f"Error in manual device discovery: {str(e)}")
-        return jsonify({"status": "Error", "message": str(e)}), 500
-    
-def get_chromecast_device(device_name, chromecasts):
-    """Get the Chromecast device by name or fallback to device_ip."""
-    chromecast = next((cc for cc in chromecasts if cc.name == device_name), None)
-    
-    if not chromecast:
-        # If the device is not found, check the device_ip dictionary
-        if device_name in device_ip:
-            ip_address = device_ip[device_name]
-            app_logger.info(f"Device {device_name} not found in discovered devices, using IP from device_ip: {ip_address}")
-            chromecast = pychromecast.Chromecast(ip_address)
-            chromecast.wait()
-        else:
-            app_logger.error(f"Device {device_name} not found")
-            raise ValueError(f"Device {device_name} not found")
-    
-    return chromecast
+    # Discovery runs continuously in the background, so this only reports the current table
+    devices = discover_devices()
+    app_logger.info(f"Manual discovery requested, {len(devices)} devices known")
+    return jsonify({"status": "Discovery completed", "devices": devices})
 
 @app.route('/api/stream_media', methods=['POST'])
 def stream_media():
@@ -237,7 +332,8 @@ def stream_media():
     app_logger.info(f"Received request: media_url='{media_url}', content_type='{provided_content_type}', volume={volume}, devices={device_names}")
     
     try:
-        media_url, determined_content_type = determine_content_type(media_url)
+        with metrics.timer("content_type"):
+            media_url, determined_content_type = determine_content_type(media_url)
         
         # Use the determined content type for images, otherwise use provided content type if available
         if determined_content_type.startswith('image/'):
@@ -249,27 +345,24 @@ def stream_media():
     except Exception as e:
         app_logger.error(f"Error determining content type: {str(e)}")
         return jsonify({"status": "Error", "message": f"Error determining content type: {str(e)}"}), 400
-    
-    results = []
-    chromecasts, browser = pychromecast.get_chromecasts()
-    for device_name in device_names:
+
+    device_names, forwards = forward_remote(device_names)
+
+    if form_flag('sync'):
+        results = broadcast_synchronized(device_names, media_url, content_type, float(volume)) if device_names else []
+        return jsonify(with_forwarded({"results": results}, forwards))
+
+    def stream(device_name):
         try:
-            chromecast = get_chromecast_device(device_name, chromecasts)
-            chromecast.wait()
-            mc = chromecast.media_controller
-            
-            # Set volume for all content types
-            chromecast.set_volume(float(volume))
-            
-            mc.play_media(media_url, content_type)
-            mc.block_until_active(timeout=10)
-            results.append({"device": device_name, "status": "Media streaming started"})
+            chromecast = get_chromecast_device(device_name)
+            start_media(device_name, chromecast, media_url, content_type, float(volume))
             app_logger.info(f"Media streaming started on {device_name} with content type: {content_type}")
         except Exception as e:
-            results.append({"device": device_name, "status": "Error", "message": str(e)})
             app_logger.error(f"Error streaming media to {device_name}: {str(e)}")
-    
-    return jsonify({"results": results})
+            raise
+
+    results = fan_out(device_names, stream, "Media streaming started")
+    return jsonify(with_forwarded({"results": results}, forwards))
 
 @app.route('/api/play_audio', methods=['POST'])
 def play_audio():
@@ -290,97 +383,250 @@ def play_audio():
         return jsonify({"status": "Error", "message": error_str}), 400
 
     # Check file extension and set appropriate MIME type
-    file_extension = os.path.splitext(audio_file.filename)[1].lower()
-    mime_types = {
-        '.mp3': 'audio/mp3',
-        '.wav': 'audio/wav',
-        '.ogg': 'audio/ogg',
-        '.flac': 'audio/flac',
-        '.aac': 'audio/aac',
-        '.m4a': 'audio/mp4',
-        '.wma': 'audio/x-ms-wma'
-    }
-    
-    if file_extension not in mime_types:
-        error_str = f"Unsupported audio format: {file_extension}"
+    file_extension = os.path.splitext(audio_file.filename)[1].lower().lstrip('.')
+    if file_extension not in AUDIO_MIME_TYPES:
+        error_str = f"Unsupported audio format: .{file_extension}"
         app_logger.error(error_str)
         return jsonify({"status": "Error", "message": error_str}), 400
 
-    mime_type = mime_types[file_extension]
+    mime_type = audio_mime_type(audio_file.filename)
 
-    # Save the file temporarily
-    temp_dir = tempfile.gettempdir()
-    filename = os.path.join(temp_dir, audio_file.filename)
-    app_logger.info(f"Saving the audio file temporarily @ {temp_dir}, filename: {audio_file.filename}")
-    audio_file.save(filename)
+    # Identical uploads share one file in the store, named by content hash
+    with metrics.timer("store_upload"):
+        stored_name = store_upload(audio_file, file_extension)
+    app_logger.info(f"Upload {audio_file.filename} stored as {stored_name}")
 
-    results = []
-    chromecasts, browser = pychromecast.get_chromecasts()
-    for device_name in devices:
+    # Peers get the stored file re-uploaded, since their devices cannot reach this node's store by name
+    devices, forwards = forward_remote(devices, files={"audio": (
+        audio_file.filename, upload_cache.lookup_file(stored_name), mime_type)})
+
+    # Normalized and transcoded once per upload; the processed clip is always MP3
+    played_name = audio_processor.process(stored_name, form_flag('chime')) if devices else stored_name
+    if played_name != stored_name:
+        mime_type = 'audio/mpeg'
+
+    local_ip = get_local_ip()
+
+    def play(device_name):
         try:
-            # Find the Chromecast device
-            chromecast = next((cc for cc in chromecasts if cc.name == device_name), None)
-            if not chromecast:
-                app_logger.error(f"Device {device_name} not found")
-                ip_address = device_ip[device_name]
-                app_logger.info(f"Device {device_name} not found in discovered devices, using IP from device_ip: {ip_address}")
-                chromecast = pychromecast.Chromecast(ip_address) 
-                   
-            if not chromecast:
-                raise ValueError(f"Device {device_name} not found")
-
-            # Connect to the Chromecast
-            chromecast.wait()
-            mc = chromecast.media_controller
-
-            # Play the audio file
-            local_ip = get_local_ip()
-            chromecast.set_volume(volume)
-            mc.play_media(f'http://{local_ip}:{PORT}/audio/{os.path.basename(filename)}', f"audio/{mime_type}")
-            mc.block_until_active()
-
-            results.append({"device": device_name, "status": "Audio playback started"})
+            chromecast = get_chromecast_device(device_name)
+            start_media(device_name, chromecast, f'http://{local_ip}:{PORT}/audio/{played_name}', mime_type, volume)
             app_logger.info(f"Audio playback started on {device_name}")
         except Exception as e:
-            results.append({"device": device_name, "status": "Error", "message": str(e)})
             app_logger.error(f"Error playing audio on {device_name}: {str(e)}")
-
-    return jsonify({"results": results})
+            raise
+
+    results = fan_out(devices, play, "Audio playback started")
+    return jsonify(with_forwarded({"results": results}, forwards))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    merged = metrics.collect()
+    if request.args.get('format') == 'json':
+        return jsonify(render_json(merged))
+    return Response(render_prometheus(merged), mimetype='text/plain; version=0.0.4')
+
+def requesting_device():
+    """The name of the device making the request, or 'unknown', so metric labels stay a fixed set."""
+    info = device_browser.lookup_ip(request.remote_addr)
+    return info.friendly_name if info is not None else 'unknown'
+
+METRIC_CACHES = {"tts": tts_cache, "uploads": upload_cache, "processed": audio_processor, "audio_hot": audio_server, "content_types": content_type_resolver}
+
+def _cache_gauge(field):
+    def read():
+        values = {}
+        for name, cache in METRIC_CACHES.items():
+            stats = cache.stats()
+            if field in stats:
+                values[name] = stats[field]
+        return values
+    return read
+
+registry.health.add_listener(lambda device_name, status: event_hub.publish("health", dict(status, device=device_name)))
+
+metrics.register_gauge("queue_depth", message_queue.depth)
+metrics.register_gauge("cache_hits", _cache_gauge("hits"))
+metrics.register_gauge("cache_misses", _cache_gauge("misses"))
+metrics.register_gauge("cache_entries", _cache_gauge("entries"))
+metrics.register_gauge("cache_bytes", _cache_gauge("bytes"))
+metrics.register_gauge("log_dropped", lambda: {"all": dropped_records()})
+metrics.register_gauge("events_dropped", lambda: {"all": event_hub.dropped})
+
+@app.route('/api/tts_cache')
+def tts_cache_stats():
+    return jsonify(tts_cache.stats())
+
+@app.route('/api/uploads')
+def upload_stats():
+    return jsonify(upload_cache.stats())
+
+@app.route('/api/audio_processing')
+def audio_processing_stats():
+    return jsonify(audio_processor.stats())
 
 @app.route('/audio/<filename>')
 def audio(filename):
-    return serve_audio_file(filename)
+    # Time until the response is ready to send (roughly the first byte), not until the device has the whole
+    # file: the body is streamed after this returns. Labelled with the device that asked for it
+    with metrics.timer("audio_fetch", requesting_device()):
+        return serve_audio_file(filename)
+
+@app.route('/audio/stream/<stream_id>')
+def audio_stream(stream_id):
+    return serve_audio_stream(stream_id)
     
 @app.route('/api/pause_audio', methods=['POST'])
 def pause_audio():
     data = request.json
-    devices = data.get('devices', [])
-    results = []
-    for device in devices:
-        try:
-            pause_audio_on_device(device)
-            results.append({"device": device, "status": "Message paused"})
-        except Exception as e:
-            results.append({"device": device, "status": "Error", "message": str(e)})
-    return jsonify({"results": results})
+    devices, forwards = forward_remote(data.get('devices', []))
+    results = fan_out(devices, pause_audio_on_device, "Message paused")
+    return jsonify(with_forwarded({"results": results}, forwards))
 
 @app.route('/api/stop_audio', methods=['POST'])
 def stop_audio():
     data = request.json
+    devices, forwards = forward_remote(data.get('devices', []))
+    results = fan_out(devices, stop_audio_on_device, "Message stopped")
+    return jsonify(with_forwarded({"results": results}, forwards))
+
+@app.route('/api/media_queue', methods=['POST'])
+def enqueue_media():
+    """Append items to the media queue of every selected device; each plays gaplessly after the previous one."""
+    data = request.get_json(silent=True) or {}
     devices = data.get('devices', [])
+    items = data.get('items')
+    if not devices or not isinstance(items, list) or not items:
+        error_msg = "Missing items or devices"
+        app_logger.error(error_msg)
+        return jsonify({"status": "Error", "message": error_msg}), 400
+    volume = validate_volume(data['volume']) if data.get('volume') is not None else None
+
+    # Content types are looked up now, in parallel, rather than when each item is due
+    try:
+        with metrics.timer("content_type"):
+            resolved = resolve_items(items)
+    except (TypeError, ValueError) as e:
+        app_logger.error(f"Invalid media queue items: {str(e)}")
+        return jsonify({"status": "Error", "message": str(e)}), 400
+
+    devices, forwards = forward_remote(devices)
     results = []
-    for device in devices:
+    for device_name in devices:
         try:
-            stop_audio_on_device(device)
-            results.append({"device": device, "status": "Message stopped"})
-        except Exception as e:
-            results.append({"device": device, "status": "Error", "message": str(e)})
-    return jsonify({"results": results})
+            media_queues.enqueue(device_name, resolved, volume)
+            results.append({"device": device_name, "status": f"Queued {len(resolved)} items"})
+        except (MediaQueueFull, UnknownDevice) as e:
+            results.append({"device": device_name, "status": "Error", "message": str(e)})
+    app_logger.info(f"Queued {len(resolved)} media items for {devices}")
+    return jsonify(with_forwarded({"results": results, "items": resolved}, forwards)), 202
+
+@app.route('/api/media_queue/<device_name>')
+def get_media_queue(device_name):
+    peer = None if request.headers.get(FORWARDED_HEADER) else federation.owner(device_name)
+    if peer is not None:
+        status = federation.fetch(peer, request.path)
+        if status is None:
+            return jsonify({"status": "Error", "message": f"Node {peer.name} unreachable"}), 502
+        return jsonify(status)
+    return jsonify(media_queues.status(device_name))
+
+@app.route('/api/media_queue/skip', methods=['POST'])
+def skip_media():
+    data = request.get_json(silent=True) or {}
+    devices, forwards = forward_remote(data.get('devices', []))
+    results = []
+    for device_name in devices:
+        try:
+            media_queues.skip(device_name)
+            results.append({"device": device_name, "status": "Skipping"})
+        except UnknownDevice as e:
+            results.append({"device": device_name, "status": "Error", "message": str(e)})
+    return jsonify(with_forwarded({"results": results}, forwards)), 202
+
+@app.route('/api/media_queue/clear', methods=['POST'])
+def clear_media():
+    data = request.get_json(silent=True) or {}
+    devices, forwards = forward_remote(data.get('devices', []))
+    results = []
+    for device_name in devices:
+        try:
+            media_queues.clear(device_name, stop=bool(data.get('stop')))
+            results.append({"device": device_name, "status": "Cleared"})
+        except UnknownDevice as e:
+            results.append({"device": device_name, "status": "Error", "message": str(e)})
+    return jsonify(with_forwarded({"results": results}, forwards)), 202
+
+@app.route('/api/federation/register', methods=['POST'])
+def federation_register():
+    """A peer announcing itself; answers with this node's device table."""
+    data = request.get_json(silent=True) or {}
+    if not data.get('name') or not data.get('url'):
+        return jsonify({"status": "Error", "message": "Missing name or url"}), 400
+    if not federation.may_register(data['url'], request.headers):
+        app_logger.warning(f"Refused federation registration from {request.remote_addr} as {data['url']}")
+        return jsonify({"status": "Error",
+                        "message": "Registration needs the federation token, or a URL listed in NESTCAST_PEERS"}), 403
+    return jsonify(federation.register(data['name'], data['url'], data.get('devices')))
+
+@app.route('/api/federation/devices')
+def federation_devices():
+    """This node's own devices, pulled periodically by its peers."""
+    if not federation.authorized(request.headers):
+        return jsonify({"status": "Error", "message": "Invalid federation token"}), 403
+    return jsonify(federation.local_table())
+
+@app.route('/api/federation/peers')
+def federation_peers():
+    return jsonify({"node": federation.node_name, "peers": federation.peers()})
+
+def start_services():
+    """
+    Run discovery and the job lanes in exactly one process on this host.
+
+    Every worker calls this. The first to take the service lock runs the
+    services; the others follow the shared device table and keep trying the
+    lock, so a surviving worker takes over if the owner exits.
+    """
+    metrics.share(shared_state)
+    registry.health.share(shared_state)
+    event_hub.share(shared_state)
+    # Every worker keeps its own copy of the peers' device tables, so any of them can route a request
+    federation.start(NODE_NAME, NODE_URL or f"http://{get_local_ip()}:{PORT}", discover_devices)
+    if service_lock.acquire():
+        _run_services()
+        return
+    app_logger.info(f"Process {os.getpid()} follows the shared device table and job queue")
+    device_browser.follow(shared_state)
+    threading.Thread(target=_wait_for_services, name='service-standby', daemon=True).start()
+
+def _wait_for_services():
+    while not service_lock.acquire():
+        time.sleep(SERVICE_RETRY)
+    app_logger.info(f"Process {os.getpid()} is taking over discovery and the job lanes")
+    _run_services()
+
+def _publish_device_event(event, info):
+    event_hub.publish("device", {"event": event, "device": info.friendly_name, "ip": info.host})
+
+def _run_services():
+    # Only the discovering process reports device changes; followers would repeat them
+    device_browser.add_listener(_publish_device_event)
+    device_browser.start(known_hosts=registry.known_hosts(), state=shared_state)
+    message_queue.start()
+    media_queues.start()
+    # One process evicts for all workers, so each disk budget holds for the host, not per worker
+    for cache in (tts_cache, upload_cache, audio_processor.cache):
+        cache.start_janitor()
+    # Messages are synthesized in this process; load Edge TTS before the first one arrives
+    preload_tts()
 
 if __name__ == '__main__':
-    Thread(target=background_discovery, daemon=True).start()
-    Thread(target=process_queue, daemon=True).start()
-    app.run(host='0.0.0.0', port=PORT, debug=True)
+    debug = os.environ.get('NESTCAST_DEBUG', '1') == '1'
+    # With the reloader, only the child process that serves requests runs the services
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_services()
+    app.run(host='0.0.0.0', port=PORT, debug=debug, threaded=True)
     
 @app.route('/api/set_volume', methods=['POST'])
 def set_volume():
@@ -0,0 +1,142 @@
+# audio_processing.py
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future
+
+from logger_utils import chromecast_logger
+from metrics import metrics
+from tts_cache import AudioCache, PARTIAL_SUFFIX, tts_cache
+from upload_store import upload_cache
+
+PROCESSING_ENABLED = os.environ.get('NESTCAST_AUDIO_PROCESSING', '0') == '1'  # Opt-in: ffmpeg is slow on small hosts
+FFMPEG = os.environ.get('NESTCAST_FFMPEG') or shutil.which('ffmpeg')
+PROCESSED_DIR = os.path.join(tempfile.gettempdir(), 'nestcast_processed')
+PROCESSED_MAX_BYTES = int(os.environ.get('NESTCAST_PROCESSED_CACHE_BYTES', 200 * 1024 * 1024))  # Disk budget for processed clips
+LOUDNESS_TARGET = -16.0    # Integrated loudness (LUFS) every clip is brought to
+TRUE_PEAK = -1.5           # Ceiling for true peaks (dBTP)
+LOUDNESS_RANGE = 11.0      # Loudness range (LU) the normalizer may keep
+OUTPUT_BITRATE = os.environ.get('NESTCAST_AUDIO_BITRATE', '96k')  # Constant MP3 bitrate, so large uploads shrink
+OUTPUT_SAMPLE_RATE = 44100
+CHIME_FILE = os.environ.get('NESTCAST_CHIME_FILE')  # Custom attention chime; a two-tone chime is generated otherwise
+CHIME_GAP = 0.3            # Seconds of silence between the chime and the clip
+PROCESS_TIMEOUT = 120.0    # Seconds ffmpeg gets for one clip
+
+class AudioProcessor:
+    """
+    Loudness normalization, an optional attention chime and MP3 transcoding
+    for clips before a device fetches them.
+
+    Every clip from Edge TTS and every upload is already named by a content
+    hash, so the processed clip is cached under a key made from that name and
+    the processing settings: each clip goes through ffmpeg once, and callers
+    asking for the same clip at the same time share one run. Processing is
+    off unless NESTCAST_AUDIO_PROCESSING=1 and ffmpeg is found; clips are
+    then served as they are, and the chime is not played.
+    """
+
+    def __init__(self, ffmpeg=FFMPEG, enabled=PROCESSING_ENABLED, cache=None):
+        self.ffmpeg = ffmpeg
+        self.enabled = enabled and ffmpeg is not None
+        self.cache = cache or AudioCache(PROCESSED_DIR, PROCESSED_MAX_BYTES)
+        self._pending = {}  # key -> Future of the processed name
+        self._lock = threading.Lock()
+        self._chime = None
+        self._chime_warned = False
+        if enabled and ffmpeg is None:
+            chromecast_logger.info("ffmpeg not found; audio is served without loudness normalization")
+
+    def process(self, name, chime=False):
+        """
+        Return the name below /audio/ of the processed version of clip `name`,
+        or `name` itself when processing is off, the clip is a live stream or
+        ffmpeg fails.
+        """
+        if not self.enabled or name.startswith('stream/'):
+            if chime and not self._chime_warned:
+                self._chime_warned = True
+                chromecast_logger.warning("A chime was requested, but audio processing is off "
+                                          "(set NESTCAST_AUDIO_PROCESSING=1 and install ffmpeg)")
+            return name
+        source = tts_cache.lookup_file(name) or upload_cache.lookup_file(name)
+        if source is None:
+            return name
+        key = AudioCache.make_key('processed', name, chime, CHIME_FILE if chime else '',
+                                  LOUDNESS_TARGET, TRUE_PEAK, LOUDNESS_RANGE, OUTPUT_BITRATE, OUTPUT_SAMPLE_RATE)
+        if self.cache.get(key) is not None:
+            return os.path.basename(self.cache.path_for(key))
+
+        with self._lock:
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+        result = name
+        try:
+            with metrics.timer("audio_processing"):
+                self._run(key, source, chime)
+            result = os.path.basename(self.cache.path_for(key))
+        except Exception as e:
+            chromecast_logger.warning(f"Could not process {name}, serving it unprocessed: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            future.set_result(result)
+        return result
+
+    def stats(self):
+        return dict(self.cache.stats(), enabled=self.enabled)
+
+    def _run(self, key, source, chime):
+        loudnorm = f"loudnorm=I={LOUDNESS_TARGET}:TP={TRUE_PEAK}:LRA={LOUDNESS_RANGE}"
+        if chime:
+            # Both parts share one format for concat; the clip is normalized on its own so the chime keeps its level
+            fmt = f"aformat=sample_rates={OUTPUT_SAMPLE_RATE}:channel_layouts=stereo"
+            inputs = ['-i', self._chime_path(), '-i', source]
+            filters = ['-filter_complex', f"[0:a]{fmt},apad=pad_dur={CHIME_GAP}[c];"
+                                          f"[1:a]{loudnorm},{fmt}[m];[c][m]concat=n=2:v=0:a=1"]
+        else:
+            inputs = ['-i', source]
+            filters = ['-af', loudnorm]
+        self._ffmpeg(key, inputs + filters)
+
+    def _chime_path(self):
+        """The chime as MP3 in the cache, made once from CHIME_FILE or generated."""
+        if self._chime is not None and os.path.exists(self._chime):
+            return self._chime
+        key = AudioCache.make_key('chime', CHIME_FILE or 'two-tone', OUTPUT_SAMPLE_RATE)
+        path = self.cache.get(key)
+        if path is None:
+            if CHIME_FILE:
+                inputs = ['-i', CHIME_FILE, '-af', f"loudnorm=I={LOUDNESS_TARGET}:TP={TRUE_PEAK}"]
+            else:
+                inputs = ['-f', 'lavfi', '-i', 'sine=frequency=880:duration=0.18',
+                          '-f', 'lavfi', '-i', 'sine=frequency=660:duration=0.32',
+                          '-filter_complex', '[0:a][1:a]concat=n=2:v=0:a=1,afade=t=out:st=0.35:d=0.15,volume=0.5']
+            path = self._ffmpeg(key, inputs)
+        self._chime = path
+        return path
+
+    def _ffmpeg(self, key, arguments):
+        fd, part = tempfile.mkstemp(dir=self.cache.directory, suffix=PARTIAL_SUFFIX)
+        os.close(fd)
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *arguments,
+                   '-map_metadata', '-1', '-ar', str(OUTPUT_SAMPLE_RATE),
+                   '-c:a', 'libmp3lame', '-b:a', OUTPUT_BITRATE, '-f', 'mp3', part]
+        try:
+            completed = subprocess.run(command, capture_output=True, timeout=PROCESS_TIMEOUT)
+            if completed.returncode != 0:
+                raise RuntimeError(completed.stderr.decode('utf-8', 'replace').strip() or
+                                   f"ffmpeg exited with {completed.returncode}")
+            return self.cache.put(key, part)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+
+audio_processor = AudioProcessor()
@@ -0,0 +1,125 @@
+# audio_server.py
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from flask import Response, request, send_file
+
+from media_types import audio_mime_type
+
+HOT_MAX_FILE_BYTES = 2 * 1024 * 1024   # Clips up to this size are kept in memory
+HOT_MAX_BYTES = 32 * 1024 * 1024       # Memory budget for the hot set
+AUDIO_MAX_AGE = 3600                   # Served files never change in place, so clients may cache them
+
+class _HotClip:
+    __slots__ = ('data', 'etag', 'stamp')
+
+    def __init__(self, data, stamp):
+        self.data = data
+        self.etag = hashlib.blake2b(data, digest_size=16).hexdigest()
+        self.stamp = stamp
+
+class AudioServer:
+    """
+    Serves audio files to Chromecasts with ETags, 304s and 206 range responses.
+
+    Devices fetch the same clip repeatedly, often with several Range requests,
+    so short clips are kept in an in-memory LRU and served without touching
+    the SD card. Each clip is read once even when several devices ask for it
+    at the same moment. Larger files go through send_file, which hands the
+    file to the WSGI server's file wrapper (sendfile where available).
+    """
+
+    def __init__(self, max_file_bytes=HOT_MAX_FILE_BYTES, max_bytes=HOT_MAX_BYTES):
+        self.max_file_bytes = max_file_bytes
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._hot = OrderedDict()  # path -> _HotClip, least recently used first
+        self._hot_bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def serve(self, filepath, mimetype=None):
+        """Return a response for filepath, or None if it does not exist."""
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        mimetype = mimetype or audio_mime_type(filepath)
+
+        if st.st_size > self.max_file_bytes:
+            etag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+            return send_file(filepath, mimetype=mimetype, conditional=True, etag=etag, max_age=AUDIO_MAX_AGE)
+
+        clip = self._hot_clip(filepath, (st.st_ino, st.st_size, st.st_mtime_ns))
+        if clip is None:
+            return None
+        response = Response(clip.data, mimetype=mimetype)
+        response.set_etag(clip.etag)
+        response.last_modified = st.st_mtime
+        response.cache_control.public = True
+        response.cache_control.max_age = AUDIO_MAX_AGE
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(clip.data))
+
+    def discard(self, filepath):
+        with self._lock:
+            clip = self._hot.pop(filepath, None)
+            if clip is not None:
+                self._hot_bytes -= len(clip.data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._hot),
+                "bytes": self._hot_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _cached(self, filepath, stamp):
+        with self._lock:
+            clip = self._hot.get(filepath)
+            if clip is not None and clip.stamp == stamp:
+                self._hot.move_to_end(filepath)
+                self.hits += 1
+                return clip
+        return None
+
+    def _hot_clip(self, filepath, stamp):
+        clip = self._cached(filepath, stamp)
+        if clip is not None:
+            return clip
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(filepath, threading.Lock())
+        # Concurrent requests for the same clip wait for one read instead of each reading it
+        with load_lock:
+            clip = self._cached(filepath, stamp)
+            if clip is not None:
+                return clip
+            try:
+                with open(filepath, 'rb') as f:
+                    clip = _HotClip(f.read(), stamp)
+            except OSError:
+                return None
+            finally:
+                # Dropped on failure too, or every missing file would leave a lock behind
+                with self._lock:
+                    self._load_locks.pop(filepath, None)
+            with self._lock:
+                self.misses += 1
+                old = self._hot.pop(filepath, None)
+                if old is not None:
+                    self._hot_bytes -= len(old.data)
+                self._hot[filepath] = clip
+                self._hot_bytes += len(clip.data)
+                while self._hot_bytes > self.max_bytes:
+                    _, evicted = self._hot.popitem(last=False)
+                    self._hot_bytes -= len(evicted.data)
+            return clip
+
+audio_server = AudioServer()
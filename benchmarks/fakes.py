@@ -0,0 +1,277 @@
+# benchmarks/fakes.py
+#
+# Stand-ins for Chromecast devices and Edge TTS, so the benchmark runs without
+# speakers on the network or access to the Edge TTS service.
+
+import asyncio
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+
+@dataclass
+class FakeConfig:
+    connect_delay: float = 0.05     # Seconds for the socket connect and cast.wait()
+    command_delay: float = 0.01     # Seconds for set_volume, play_media, pause and stop round trips
+    playback: float = 0.5           # Seconds a clip plays before the device reports IDLE
+    fetch_audio: bool = True        # Fetch the media URL like a real device does
+    tts_delay: float = 0.3          # Seconds Edge TTS takes for a whole message
+    tts_first_chunk: float = 0.08   # Seconds until Edge TTS streams its first chunk
+    tts_chunks: int = 8
+    tts_bytes_per_char: int = 200   # Roughly the bitrate of Edge TTS MP3 output
+
+class FakeMediaStatus:
+    __slots__ = ('player_state', 'media_session_id', 'idle_reason', 'content_id', 'media_custom_data')
+
+    def __init__(self, player_state='UNKNOWN', media_session_id=None, idle_reason=None, content_id=None,
+                 media_custom_data=None):
+        self.player_state = player_state
+        self.media_session_id = media_session_id
+        self.idle_reason = idle_reason
+        self.content_id = content_id
+        self.media_custom_data = media_custom_data or {}
+
+class FakeMediaController:
+    """
+    Follows the pychromecast MediaController protocol: play_media, status
+    callbacks, session events and the receiver queue (QUEUE_INSERT,
+    QUEUE_REMOVE and queue_next). Inserted items are fetched right away, so
+    they start without buffering once the current item ends.
+    """
+
+    _sessions = itertools.count(1)
+    _item_ids = itertools.count(1)
+
+    def __init__(self, config, http):
+        self.config = config
+        self.http = http
+        self.status = FakeMediaStatus()
+        self.session_active_event = threading.Event()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._remaining = 0.0
+        self._queue = []   # Inserted items: {"itemId", "url", "custom_data", "fetched"}
+
+    def register_status_listener(self, listener):
+        self._listeners.append(listener)
+
+    def play_media(self, url, content_type, autoplay=True, media_info=None, **kwargs):
+        time.sleep(self.config.command_delay)
+        with self._lock:
+            self._queue = []  # A load replaces the receiver's queue
+        self._start(url, autoplay, custom_data=(media_info or {}).get("customData"))
+
+    def send_message(self, data, inc_session_id=False, callback_function=None, no_add_request_id=False):
+        time.sleep(self.config.command_delay)
+        response = None
+        if data.get("type") == "QUEUE_INSERT":
+            inserted = []
+            for entry in data.get("items", []):
+                url, custom_data = entry["media"]["contentId"], entry["media"].get("customData")
+                item = {"itemId": next(self._item_ids), "url": url, "custom_data": custom_data,
+                        "fetched": self._preload(url)}
+                inserted.append({"itemId": item["itemId"], "media": {"contentId": url, "customData": custom_data}})
+                with self._lock:
+                    self._queue.append(item)
+            response = {"status": [{"items": inserted}]}
+        elif data.get("type") == "QUEUE_REMOVE":
+            with self._lock:
+                self._queue = [item for item in self._queue if item["itemId"] not in data.get("itemIds", [])]
+            response = {"status": [{"items": []}]}
+        if callback_function:
+            callback_function(response is not None, response)
+
+    def queue_next(self, timeout=10.0):
+        time.sleep(self.config.command_delay)
+        item = self._pop_queue()
+        if item is not None:
+            self._start(item["url"], True, item["fetched"], item["custom_data"])
+
+    def _start(self, url, autoplay, fetched=None, custom_data=None):
+        session = next(self._sessions)
+        with self._lock:
+            self._remaining = self.config.playback
+        self._update('BUFFERING', session, content_id=url, custom_data=custom_data or {})
+        threading.Thread(target=self._play, args=(session, url, autoplay, fetched), daemon=True).start()
+
+    def _pop_queue(self):
+        with self._lock:
+            return self._queue.pop(0) if self._queue else None
+
+    def _fetch(self, url):
+        try:
+            with self.http.get(url, stream=True, timeout=30) as response:
+                for _ in response.iter_content(64 * 1024):
+                    pass
+            return True
+        except requests.RequestException:
+            return False
+
+    def _preload(self, url):
+        result = {}
+        if self.config.fetch_audio:
+            thread = threading.Thread(target=lambda: result.update(ok=self._fetch(url)), daemon=True)
+            thread.start()
+            result["thread"] = thread
+        return result
+
+    def block_until_active(self, timeout=None):
+        self.session_active_event.wait(timeout=timeout)
+
+    def play(self):
+        time.sleep(self.config.command_delay)
+        if self.status.player_state in ('PAUSED', 'BUFFERING'):
+            self._update('PLAYING', self.status.media_session_id)
+
+    def pause(self):
+        time.sleep(self.config.command_delay)
+        if self.status.player_state == 'PLAYING':
+            self._update('PAUSED', self.status.media_session_id)
+
+    def stop(self):
+        time.sleep(self.config.command_delay)
+        self._update('IDLE', self.status.media_session_id, idle_reason='CANCELLED')
+
+    def _play(self, session, url, autoplay, fetched=None):
+        if self.config.fetch_audio:
+            if fetched is not None:
+                fetched["thread"].join()   # Usually finished while the previous item played
+                ok = fetched.get("ok", False)
+            else:
+                ok = self._fetch(url)
+            if not ok:
+                self._update('IDLE', session, idle_reason='ERROR')
+                return
+        self._update('PLAYING' if autoplay else 'PAUSED', session)
+        while True:
+            time.sleep(0.01)
+            with self._lock:
+                status = self.status
+                if status.media_session_id != session or status.player_state == 'IDLE':
+                    return
+                if status.player_state == 'PLAYING':
+                    self._remaining -= 0.01
+                finished = self._remaining <= 0
+            if finished:
+                item = self._pop_queue()
+                if item is not None:
+                    self._start(item["url"], True, item["fetched"], item["custom_data"])
+                else:
+                    self._update('IDLE', session, idle_reason='FINISHED')
+                return
+
+    def _update(self, player_state, session, idle_reason=None, content_id=None, custom_data=None):
+        with self._lock:
+            if session != self.status.media_session_id and self.status.media_session_id is not None \
+                    and session < self.status.media_session_id:
+                return  # A newer clip replaced this one
+            content_id = content_id or self.status.content_id
+            custom_data = self.status.media_custom_data if custom_data is None else custom_data
+            self.status = status = FakeMediaStatus(player_state, session, idle_reason, content_id, custom_data)
+        if player_state == 'IDLE':
+            self.session_active_event.clear()
+        else:
+            self.session_active_event.set()
+        for listener in list(self._listeners):
+            listener.new_media_status(status)
+
+class FakeCastStatus:
+    __slots__ = ('volume_level', 'volume_muted', 'display_name')
+
+    def __init__(self, volume_level, volume_muted=False, display_name='Default Media Receiver'):
+        self.volume_level = volume_level
+        self.volume_muted = volume_muted
+        self.display_name = display_name
+
+class FakeSocketClient:
+    def __init__(self):
+        self.is_connected = True
+
+    def disconnect(self):
+        self.is_connected = False
+
+class FakeChromecast:
+    """Enough of pychromecast.Chromecast for the registry, fan-out and sync paths."""
+
+    def __init__(self, cast_info, config, http):
+        self.cast_info = cast_info
+        self.uuid = cast_info.uuid
+        self.name = cast_info.friendly_name
+        self.config = config
+        self.socket_client = FakeSocketClient()
+        self.media_controller = FakeMediaController(config, http)
+        self.status = None
+        self._connection_listeners = []
+        self._status_listeners = []
+
+    def wait(self, timeout=None):
+        time.sleep(self.config.connect_delay)
+
+    def set_volume(self, volume):
+        time.sleep(self.config.command_delay)
+        self.status = status = FakeCastStatus(volume)
+        for listener in list(self._status_listeners):
+            listener.new_cast_status(status)
+
+    def register_status_listener(self, listener):
+        self._status_listeners.append(listener)
+
+    def register_connection_listener(self, listener):
+        self._connection_listeners.append(listener)
+
+    def register_handler(self, handler):
+        pass
+
+class FakeCommunicate:
+    """Local replacement for edge_tts.Communicate with configurable synthesis time."""
+
+    config = FakeConfig()
+
+    def __init__(self, text, voice, rate="+0%", **kwargs):
+        self.text = text
+        self.voice = voice
+        self.rate = rate
+
+    def _audio(self):
+        size = max(1, len(self.text)) * self.config.tts_bytes_per_char
+        return bytes(size)
+
+    async def save(self, path):
+        await asyncio.sleep(self.config.tts_delay)
+        with open(path, 'wb') as f:
+            f.write(self._audio())
+
+    async def stream(self):
+        data = self._audio()
+        chunks = max(1, self.config.tts_chunks)
+        step = -(-len(data) // chunks)
+        rest = max(0.0, self.config.tts_delay - self.config.tts_first_chunk) / chunks
+        await asyncio.sleep(self.config.tts_first_chunk)
+        for offset in range(0, len(data), step):
+            yield {"type": "audio", "data": data[offset:offset + step]}
+            yield {"type": "WordBoundary", "offset": offset, "duration": 0, "text": ""}
+            await asyncio.sleep(rest)
+
+def install(config):
+    """Patch pychromecast and edge_tts so every connection and synthesis uses the fakes."""
+    import edge_tts
+    import pychromecast
+
+    http = requests.Session()
+    http.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=64))
+
+    def from_cast_info(cast_info, zconf=None, **kwargs):
+        return FakeChromecast(cast_info, config, http)
+
+    def from_host(host, **kwargs):
+        from pychromecast.models import CastInfo, HostServiceInfo
+        ip, port, uuid, model, name = host
+        return FakeChromecast(CastInfo({HostServiceInfo(ip, port)}, uuid, model, name, ip, port, None, None),
+                              config, http)
+
+    pychromecast.get_chromecast_from_cast_info = from_cast_info
+    pychromecast.get_chromecast_from_host = from_host
+    FakeCommunicate.config = config
+    edge_tts.Communicate = FakeCommunicate
@@ -0,0 +1,328 @@
+# benchmarks/run.py
+#
+# Offline load test: serves the real Flask app over HTTP against simulated
+# Chromecasts and a fake Edge TTS, drives the API concurrently and prints
+# latency percentiles and throughput as JSON.
+#
+#   python benchmarks/run.py --devices 4 --concurrency 8 --requests 50 --output results.json
+#
+# With --nodes N, N-1 more instances run as subprocesses on their own ports,
+# each with its own simulated devices. Requests go to the first instance,
+# which forwards them to the owning nodes (see federation.py).
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NODE_NAMES = 'Node {}'
+NODE_READY_TIMEOUT = 30.0  # Seconds to wait until the first node sees every other node's devices
+SCENARIOS = ('send_message', 'send_message_stream', 'send_batch', 'stream_media', 'play_audio', 'pause_audio', 'stop_audio')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="NestCast benchmark with fake Chromecasts and fake Edge TTS")
+    parser.add_argument('--devices', type=int, default=4, help="Simulated devices on the network")
+    parser.add_argument('--targets', type=int, default=2, help="Devices addressed by each request")
+    parser.add_argument('--concurrency', type=int, default=8, help="Client threads sending requests")
+    parser.add_argument('--requests', type=int, default=40, help="Requests per scenario")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument('--messages', type=int, default=10, help="Distinct message texts, so the TTS cache sees repeats")
+    parser.add_argument('--batch-size', type=int, default=4, help="Messages in each /api/send_batch request")
+    parser.add_argument('--upload-bytes', type=int, default=256 * 1024, help="Size of the file sent to /api/play_audio")
+    parser.add_argument('--connect-delay', type=float, default=0.05)
+    parser.add_argument('--command-delay', type=float, default=0.01)
+    parser.add_argument('--playback', type=float, default=0.5, help="Seconds each clip plays")
+    parser.add_argument('--tts-delay', type=float, default=0.3)
+    parser.add_argument('--tts-first-chunk', type=float, default=0.08)
+    parser.add_argument('--no-fetch', action='store_true', help="Do not have fake devices fetch the media URL")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--nodes', type=int, default=1, help="NestCast instances; requests are forwarded between them")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    parser.add_argument('--serve-node', type=int, help=argparse.SUPPRESS)  # Run as one of the extra nodes
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-fraction * len(sorted_values) // 1)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    ms = lambda v: None if v is None else round(v * 1000, 2)
+    return {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round((len(values) + errors) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": ms(percentile(values, 0.50)),
+            "p95": ms(percentile(values, 0.95)),
+            "p99": ms(percentile(values, 0.99)),
+            "mean": ms(sum(values) / len(values)) if values else None,
+            "max": ms(values[-1]) if values else None,
+        },
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def isolate():
+    """Keep caches, state, uploads and logs of the run out of the real installation."""
+    workdir = tempfile.mkdtemp(prefix='nestcast_bench_')
+    tempfile.tempdir = workdir
+    os.environ['NESTCAST_STATE_DIR'] = os.path.join(workdir, 'state')
+    os.makedirs(os.path.join(workdir, 'logs'))
+    os.chdir(workdir)
+    return workdir
+
+def start_app(args, port, node=1):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from fakes import FakeConfig, install
+
+    install(FakeConfig(connect_delay=args.connect_delay, command_delay=args.command_delay,
+                       playback=args.playback, fetch_audio=not args.no_fetch, tts_delay=args.tts_delay,
+                       tts_first_chunk=args.tts_first_chunk))
+
+    import app as nestcast
+    import chromecast_utils
+    from device_registry import device_browser
+    from job_queue import message_queue
+    from shared_state import service_lock
+
+    # Audio URLs handed to the fake devices must point at this server
+    nestcast.get_local_ip = chromecast_utils.get_local_ip = lambda: '127.0.0.1'
+
+    if args.nodes > 1:
+        names = [f"Bench Speaker {node}.{i + 1}" for i in range(args.devices)]
+    else:
+        names = [f"Bench Speaker {i + 1}" for i in range(args.devices)]
+    device_browser._apply([{"uuid": str(uuid.uuid5(uuid.NAMESPACE_DNS, name)), "name": name,
+                            "ip": f"127.0.1.{i + 1}", "port": 8009, "model": "Fake", "cast_type": "audio",
+                            "manufacturer": "Bench"} for i, name in enumerate(names)])
+    service_lock.acquire()
+    message_queue.start()
+    nestcast.media_queues.start()
+    for cache in (nestcast.tts_cache, nestcast.upload_cache, nestcast.audio_processor.cache):
+        cache.start_janitor()
+    nestcast.federation.start(NODE_NAMES.format(node), f"http://127.0.0.1:{port}", chromecast_utils.discover_devices)
+
+    # Keep-alive lets forwarded requests reuse the pooled connections between nodes
+    handler = type('Handler', (WSGIRequestHandler,), {'protocol_version': 'HTTP/1.1' if args.nodes > 1 else 'HTTP/1.0'})
+    server = make_server('127.0.0.1', port, nestcast.app, threaded=True, request_handler=handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, names
+
+def make_request(scenario, base, session, names, args, rng, upload):
+    devices = json.dumps(rng.sample(names, min(args.targets, len(names))))
+    message = f"Benchmark announcement number {rng.randrange(args.messages)}"
+    if scenario == 'send_message':
+        return session.post(f"{base}/api/send_message",
+                            data={"message": message, "devices": devices, "volume": "0.3", "wait": "true", "stream": "false"})
+    if scenario == 'send_message_stream':
+        return session.post(f"{base}/api/send_message",
+                            data={"message": message, "devices": devices, "volume": "0.3", "wait": "true", "stream": "true"})
+    if scenario == 'send_batch':
+        # A burst of announcements to the same rooms, some of them repeated
+        items = [{"message": f"Benchmark announcement number {rng.randrange(args.messages)}",
+                  "devices": json.loads(devices), "volume": 0.3} for _ in range(args.batch_size)]
+        return session.post(f"{base}/api/send_batch", json={"items": items, "window": 0.2, "wait": True})
+    if scenario == 'stream_media':
+        return session.post(f"{base}/api/stream_media",
+                            data={"media_url": f"{base}/audio/{upload['name']}", "devices": devices, "volume": "0.3"})
+    if scenario == 'play_audio':
+        return session.post(f"{base}/api/play_audio", data={"devices": devices, "volume": "0.3"},
+                            files={"audio": ("bench.mp3", io.BytesIO(upload['data']), "audio/mpeg")})
+    if scenario in ('pause_audio', 'stop_audio'):
+        return session.post(f"{base}/api/{scenario}", json={"devices": json.loads(devices)})
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+def run_scenario(scenario, base, names, args, upload):
+    local = threading.local()
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def one(i):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        # Seeded per request, so the same targets and messages are chosen on every run
+        rng = random.Random(f"{args.seed}-{scenario}-{i}")
+        start = time.perf_counter()
+        try:
+            response = make_request(scenario, base, local.session, names, args, rng, upload)
+            ok = response.status_code < 400 and not _device_errors(response)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+def _device_errors(response):
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    results = body.get("results", []) + [r for job in body.get("jobs", []) for r in job.get("results", [])]
+    return any(r.get("status") in ("Error", "Timeout") for r in results)
+
+def stage_summary():
+    from metrics import LATENCY_BUCKETS, metrics
+    stages = {}
+    for (stage, _), h in metrics.collect()["histograms"].items():
+        entry = stages.setdefault(stage, {"count": 0, "sum": 0.0, "counts": [0] * len(h["counts"])})
+        entry["count"] += h["count"]
+        entry["sum"] += h["sum"]
+        entry["counts"] = [a + b for a, b in zip(entry["counts"], h["counts"])]
+    report = {}
+    for stage, entry in sorted(stages.items()):
+        report[stage] = {
+            "count": entry["count"],
+            "mean_ms": round(entry["sum"] / entry["count"] * 1000, 2) if entry["count"] else None,
+            # Histogram buckets only bound the percentile from above
+            "p95_le_ms": _bucket_percentile(entry["counts"], entry["count"], 0.95, LATENCY_BUCKETS),
+        }
+    return report
+
+def _bucket_percentile(counts, total, fraction, bounds):
+    seen = 0
+    for count, bound in zip(counts, list(bounds) + [None]):
+        seen += count
+        if total and seen >= fraction * total:
+            return None if bound is None else bound * 1000
+    return None
+
+def start_nodes(args):
+    """Start the extra nodes as subprocesses; returns (processes, their base URLs)."""
+    processes, urls = [], []
+    for node in range(2, args.nodes + 1):
+        port = free_port()
+        command = [sys.executable, os.path.abspath(__file__), '--serve-node', str(node), '--port', str(port),
+                   '--nodes', str(args.nodes), '--devices', str(args.devices),
+                   '--connect-delay', str(args.connect_delay), '--command-delay', str(args.command_delay),
+                   '--playback', str(args.playback), '--tts-delay', str(args.tts_delay),
+                   '--tts-first-chunk', str(args.tts_first_chunk)] + (['--no-fetch'] if args.no_fetch else [])
+        env = dict(os.environ, NESTCAST_PORT=str(port), NESTCAST_PEERS='')
+        processes.append(subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+def serve_node(args):
+    workdir = isolate()
+    sys.path[:0] = [REPO_ROOT, os.path.dirname(os.path.abspath(__file__))]
+    try:
+        start_app(args, args.port, node=args.serve_node)
+        while True:
+            time.sleep(3600)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def wait_for_nodes(base, expected):
+    """Wait until the first node has every other node's devices; returns all device names."""
+    deadline = time.monotonic() + NODE_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            devices = requests.get(f"{base}/api/devices", timeout=5).json()
+            if len(devices) >= expected:
+                return [d["name"] for d in devices]
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"The nodes did not share their devices within {NODE_READY_TIMEOUT:.0f}s")
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve_node:
+        serve_node(args)
+        return
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    # The app prints progress to stdout; keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        workdir = isolate()
+        try:
+            report = run(args)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+def run(args):
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario: {scenario} (choose from {', '.join(SCENARIOS)})")
+
+    sys.path[:0] = [REPO_ROOT, os.path.dirname(os.path.abspath(__file__))]
+    port = free_port()
+    os.environ['NESTCAST_PORT'] = str(port)
+    if args.nodes > 1:
+        # The extra nodes only accept the first one's registration with the shared token
+        os.environ.setdefault('NESTCAST_FEDERATION_TOKEN', uuid.uuid4().hex)
+    processes, node_urls = start_nodes(args) if args.nodes > 1 else ([], [])
+    os.environ['NESTCAST_PEERS'] = ','.join(node_urls)
+    try:
+        return _run(args, scenarios, port, node_urls)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+def _run(args, scenarios, port, node_urls):
+    server, names = start_app(args, port)
+    base = f"http://127.0.0.1:{port}"
+    if node_urls:
+        names = wait_for_nodes(base, args.devices * args.nodes)
+
+    # One upload up front gives stream_media a local file to cast
+    data = os.urandom(args.upload_bytes)
+    response = requests.post(f"{base}/api/play_audio", data={"devices": json.dumps(names[:1]), "volume": "0.3"},
+                             files={"audio": ("bench.mp3", io.BytesIO(data), "audio/mpeg")})
+    response.raise_for_status()
+    upload = {"data": data, "name": f"{hashlib.sha256(data).hexdigest()}.mp3"}
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != 'output'},
+        "scenarios": {},
+    }
+    for scenario in scenarios:
+        report["scenarios"][scenario] = run_scenario(scenario, base, names, args, upload)
+    report["stages"] = stage_summary()
+    if node_urls:
+        from federation import federation
+        report["peers"] = federation.peers()
+    server.shutdown()
+    return report
+
+if __name__ == '__main__':
+    main()
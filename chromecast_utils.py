@@ -1,34 +1,194 @@
 # chromecast_utils_oct.py
 
-import pychromecast
 import time
-import ipaddress
 import os
+import shutil
 import tempfile
 import socket
 import threading
-import queue
-from flask import send_file
-from logger_utils import chromecast_logger
-from tts_handler import create_audio_file_gtts, delete_audio_file, create_custom_audio_file_edge
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from flask import Response
+from logger_utils import chromecast_logger, carry_context
+from device_registry import registry, device_browser
+from tts_handler import create_custom_audio_file_edge, start_custom_audio_stream_edge, get_audio_stream
+from tts_handler import follow_partial_stream
+from tts_cache import tts_cache, PARTIAL_SUFFIX
+from upload_store import upload_cache
+from audio_server import audio_server
+from audio_processing import audio_processor
+from metrics import metrics
 
-PORT = 5030
+PORT = int(os.environ.get('NESTCAST_PORT', '5030'))
+
+FANOUT_WORKERS = 16      # Upper bound on devices driven at the same time
+FANOUT_TIMEOUT = 120.0   # Seconds to wait for any single device before reporting an error
+PLAYBACK_TIMEOUT = 600.0 # Longest a spoken message may play before we stop waiting for it
+SYNC_PRELOAD_TIMEOUT = 15.0  # Seconds every device gets to connect and load media before the shared start
+ACTIVE_TIMEOUT = 10.0        # Seconds a device gets to start a media session after play_media
+VOLUME_TOLERANCE = 0.005     # A device already this close to the requested volume is not sent set_volume
 
 # Create logger
 #chromecast_logger = setup_logger('chromecast', 'logs/chromecast.log')
 
-# Global dictionary to store audio file paths and their deletion timers
-audio_files = {}
+# Shared by every endpoint so a burst of requests cannot spawn unbounded threads
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+
+def fan_out(device_names, action, success_status, timeout=FANOUT_TIMEOUT):
+    """
+    Run action(device_name) on every device at once and collect the results.
+
+    Returns the usual results list, in the order of device_names, with one
+    {"device", "status"[, "message"]} entry per device. A device that does not
+    finish within timeout seconds is reported as an error without holding up
+    the others.
+    """
+    action = carry_context(action)
+    futures = [(device_name, _fanout_pool.submit(action, device_name)) for device_name in device_names]
+    deadline = time.monotonic() + timeout
+
+    results = []
+    for device_name, future in futures:
+        try:
+            future.result(timeout=max(0.0, deadline - time.monotonic()))
+            results.append({"device": device_name, "status": success_status})
+        except FutureTimeout:
+            chromecast_logger.error(f"Timed out after {timeout:.0f}s on {device_name}")
+            registry.health.record_failure(device_name, "timeout", f"no answer within {timeout:.0f}s")
+            results.append({"device": device_name, "status": "Error", "message": f"Timed out after {timeout:.0f}s"})
+        except Exception as e:
+            results.append({"device": device_name, "status": "Error", "message": str(e)})
+    return results
+
+def find_cast_group(device_names):
+    """Return a discovered cast group whose members are exactly device_names, or None."""
+    targets = set(device_names)
+    if len(targets) < 2:
+        return None
+    for group_name in device_browser.groups():
+        try:
+            if registry.group_members(group_name) == targets:
+                return group_name
+        except Exception as e:
+            chromecast_logger.warning(f"Could not read members of cast group {group_name}: {str(e)}")
+    return None
+
+def broadcast_synchronized(device_names, media_url, content_type, volume, timeout=SYNC_PRELOAD_TIMEOUT):
+    """
+    Start the same media on several devices with as little start skew as possible.
+
+    When a cast group contains exactly the targets, the group plays it and
+    the devices keep themselves in sync. Otherwise every device is connected
+    and has the media loaded paused in parallel, then all PLAY commands are
+    released together. Each result carries start_skew_ms: how much later the
+    device acknowledged PLAY than the first device did.
+    """
+    device_names = list(dict.fromkeys(device_names))
+    group_name = find_cast_group(device_names)
+    if group_name:
+        try:
+            _start_on_device(group_name, media_url, content_type, volume)
+            chromecast_logger.info(f"Synchronized playback started on cast group {group_name}")
+            return [{"device": device_name, "status": "Synchronized playback started", "group": group_name, "start_skew_ms": 0.0}
+                    for device_name in device_names]
+        except Exception as e:
+            chromecast_logger.warning(f"Cast group {group_name} failed, syncing devices individually: {str(e)}")
+
+    barrier = threading.Barrier(len(device_names), timeout=timeout)
+    started = {}
+    errors = {}
+
+    def run(device_name):
+        mc = None
+        try:
+            mc = _preload_on_device(device_name, media_url, content_type, volume, timeout)
+        except Exception as e:
+            errors[device_name] = e
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            # A device is still loading past the timeout; start the ready ones anyway
+            pass
+        if mc is None:
+            return
+        try:
+            mc.play()
+            started[device_name] = time.monotonic()
+        except Exception as e:
+            errors[device_name] = e
+
+    threads = [threading.Thread(target=run, args=(device_name,), daemon=True) for device_name in device_names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout + 10.0)
+
+    first = min(started.values(), default=0.0)
+    results = []
+    for device_name in device_names:
+        if device_name in started:
+            skew_ms = round((started[device_name] - first) * 1000.0, 1)
+            results.append({"device": device_name, "status": "Synchronized playback started", "start_skew_ms": skew_ms})
+        else:
+            error = errors.get(device_name) or TimeoutError(f"Timed out after {timeout:.0f}s")
+            chromecast_logger.error(f"Synchronized playback failed on {device_name}: {str(error)}")
+            results.append({"device": device_name, "status": "Error", "message": str(error)})
+    return results
+
+def _preload_on_device(device_name, media_url, content_type, volume, timeout):
+    cast = registry.get(device_name)
+    set_device_volume(device_name, cast, volume)
+    mc = cast.media_controller
+    loaded = registry.playback(device_name).expect_loaded()
+    start = time.perf_counter()
+    try:
+        with metrics.timer("preload", device_name):
+            mc.play_media(media_url, content_type, autoplay=False)
+            loaded.result(timeout=timeout)
+    except Exception as e:
+        registry.health.record_failure(device_name, "preload", e)
+        raise
+    finally:
+        loaded.cancel()
+    registry.health.record_success(device_name, "preload", time.perf_counter() - start)
+    return mc
+
+def _start_on_device(device_name, media_url, content_type, volume):
+    cast = registry.get(device_name)
+    start_media(device_name, cast, media_url, content_type, volume)
 
-class MessageQueue:
-    def __init__(self):
-        self.queue = queue.Queue()
+def start_media(device_name, cast, media_url, content_type, volume, media_info=None):
+    """Set the volume and start media on a connected cast, timing each step; media_info is merged into the media."""
+    set_device_volume(device_name, cast, volume)
+    _play_on_device(device_name, cast.media_controller, media_url, content_type, media_info)
 
-    def put(self, item):
-        self.queue.put(item)
+def set_device_volume(device_name, cast, volume):
+    """
+    Set the volume unless the device already reports it, or volume is None.
+    With normalized clips the same volume suits every message, so this
+    usually saves a round trip to the device.
+    """
+    if volume is None:
+        return
+    status = getattr(cast, 'status', None)
+    if status is not None and status.volume_level is not None and abs(status.volume_level - volume) < VOLUME_TOLERANCE:
+        return
+    with metrics.timer("set_volume", device_name):
+        cast.set_volume(volume)
 
-    def get(self):
-        return self.queue.get()
+def _play_on_device(device_name, mc, media_url, content_type, media_info=None):
+    """play_media and wait for the session to start, recording the outcome in the device's health."""
+    start = time.perf_counter()
+    try:
+        with metrics.timer("play_media", device_name):
+            mc.play_media(media_url, content_type, media_info=media_info)
+        with metrics.timer("block_until_active", device_name):
+            # block_until_active() returns None either way; the event's wait says whether it started
+            if not mc.session_active_event.wait(timeout=ACTIVE_TIMEOUT):
+                raise TimeoutError(f"{device_name} did not start playback within {ACTIVE_TIMEOUT:.0f}s")
+    except Exception as e:
+        registry.health.record_failure(device_name, "playback", e)
+        raise
+    registry.health.record_success(device_name, "playback", time.perf_counter() - start)
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -43,81 +203,128 @@ def get_local_ip():
     return IP
 
 def discover_devices():
-    try:
-        services, browser = pychromecast.discovery.discover_chromecasts()
-        pychromecast.discovery.stop_discovery(browser)
-        devices = [{"name": service.friendly_name, "ip": service.host} for service in services]
-        
-        # Keep only the first occurrence of each IP address
-        devices = [next(d for d in devices if d['ip'] == ip) for ip in {d['ip'] for d in devices}]
-        
-        # Sort devices by IP address
-        sorted_devices = sorted(devices, key=lambda d: ipaddress.ip_address(d['ip']))
-        
-        return sorted_devices
-    except Exception as e:
-        chromecast_logger.error(f"Error discovering devices: {str(e)}")
-        return []
+    """Return the current device table kept up to date by the background browser, with each device's health."""
+    return [dict(device, health=registry.health.status(device["name"])) for device in device_browser.devices()]
 
-def send_message_to_device(device_name, message, volume, lang='en'):
-    chromecast_logger.info(f"Sending message to {device_name} in language {lang} with volume {volume}")
-    try:
-        local_ip = get_local_ip()
-        chromecast_logger.info(f"Local IP: {local_ip}")
-        
-        chromecasts, browser = pychromecast.get_listed_chromecasts(friendly_names=[device_name])
-        if not chromecasts:
-            raise ValueError(f"Device '{device_name}' not found")
-        
-        cast = chromecasts[0]
-        cast.wait()
-        chromecast_logger.info(f"Connected to device {device_name}")
+def create_message_audio(message, lang='en', stream=False):
+    """
+    Synthesize a message once, or reuse the cached clip.
 
+    Returns the clip's path below /audio/. With stream=True an uncached clip
+    is served from /audio/stream/<id> while it is still being synthesized,
+    so playback can start before the whole MP3 exists. A stream cannot be
+    normalized or get the chime, so with audio processing on the whole clip
+    is synthesized instead.
+    """
+    if stream and not audio_processor.enabled:
+        key, audio_file = start_custom_audio_stream_edge(message, lang)
+        if audio_file is None:
+            chromecast_logger.info(f"Streaming audio: {key}")
+            return f"stream/{key}"
+    else:
         audio_file = create_custom_audio_file_edge(message, lang)
-        chromecast_logger.info(f"Created audio file: {audio_file}")
-        
-        mc = cast.media_controller
-        cast.set_volume(volume)
-        chromecast_logger.info(f"Set volume to {volume}")
+    chromecast_logger.info(f"Created audio file: {audio_file}")
+    return os.path.basename(audio_file)
 
-        audio_url = f"http://{local_ip}:{PORT}/audio/{os.path.basename(audio_file)}"
-        chromecast_logger.info(f"Audio URL: {audio_url}")
-        
-        mc.play_media(audio_url, "audio/mp3")
-        mc.block_until_active()
-        chromecast_logger.info(f"Started playing audio on {device_name}")
-        
-        global audio_files
-        audio_files[audio_file] = threading.Timer(3600.0, delete_audio_file, args=[audio_file])
-        audio_files[audio_file].start()
+def combine_message_audio(audio_paths):
+    """
+    Join synthesized clips into one clip, cached like a single message.
 
-        # Wait for the audio to finish playing
-        while mc.status.player_state != 'IDLE':
-            time.sleep(1)
+    Edge TTS always returns MP3 in the same format, whatever the voice, so
+    the frames can be appended without re-encoding. Returns the clip's path
+    below /audio/.
+    """
+    key = tts_cache.make_key('combined', *audio_paths)
+    audio_file = tts_cache.get(key)
+    if audio_file is None:
+        fd, part = tempfile.mkstemp(dir=tts_cache.directory, suffix=PARTIAL_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for audio_path in audio_paths:
+                    clip_path = tts_cache.lookup_file(audio_path)
+                    if clip_path is None:
+                        raise FileNotFoundError(f"Clip {audio_path} is no longer cached")
+                    with open(clip_path, 'rb') as clip:
+                        shutil.copyfileobj(clip, out)
+            audio_file = tts_cache.put(key, part)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+    chromecast_logger.info(f"Combined {len(audio_paths)} clips into {audio_file}")
+    return os.path.basename(audio_file)
 
+def send_message_to_device(device_name, message, volume, lang='en', audio_path=None, chime=False):
+    """
+    Play a spoken message on one device and wait for it to finish.
+
+    Pass audio_path from create_message_audio when sending the same message to
+    several devices, so it is synthesized once and every device streams it.
+    With chime=True the attention chime plays first (see audio_processing.py).
+    """
+    chromecast_logger.info(f"Sending message to {device_name} in language {lang} with volume {volume}")
+    try:
+        with metrics.timer("send_message", device_name):
+            _send_message(device_name, message, volume, lang, audio_path, chime)
         chromecast_logger.info(f"Message sent successfully to {device_name}")
     except Exception as e:
         chromecast_logger.error(f"Error sending message to {device_name}: {str(e)}")
         raise
-        
+
+def _send_message(device_name, message, volume, lang, audio_path, chime):
+    local_ip = get_local_ip()
+    chromecast_logger.debug(f"Local IP: {local_ip}")
+
+    cast = registry.get(device_name)
+    chromecast_logger.info(f"Connected to device {device_name}")
+
+    if audio_path is None:
+        audio_path = create_message_audio(message, lang)
+    # Processed once per clip; the other lanes playing it wait for that run or hit the cache
+    audio_path = audio_processor.process(audio_path, chime)
+
+    mc = cast.media_controller
+    set_device_volume(device_name, cast, volume)
+    chromecast_logger.debug(f"Set volume to {volume}")
+
+    audio_url = f"http://{local_ip}:{PORT}/audio/{audio_path}"
+    chromecast_logger.debug(f"Audio URL: {audio_url}")
+
+    # Armed before play_media so the finishing status cannot be missed
+    finished = registry.playback(device_name).expect_finish()
+    try:
+        _play_on_device(device_name, mc, audio_url, "audio/mp3")
+        chromecast_logger.info(f"Started playing audio on {device_name}")
+
+        # Woken by the media status callback as soon as the device goes IDLE
+        with metrics.timer("playback", device_name):
+            finished.result(timeout=PLAYBACK_TIMEOUT)
+    finally:
+        finished.cancel()
 
 def serve_audio_file(filename):
-    filepath = os.path.join(tempfile.gettempdir(), filename)
-    if os.path.exists(filepath):
-        return send_file(filepath, mimetype="audio/mp3", conditional=True)
-    else:
+    filepath = (tts_cache.lookup_file(filename) or audio_processor.cache.lookup_file(filename)
+                or upload_cache.lookup_file(filename) or os.path.join(tempfile.gettempdir(), filename))
+    response = audio_server.serve(filepath)
+    if response is None:
         chromecast_logger.warning(f"Audio file not found: {filepath}")
         return "File not found", 404
+    return response
+
+def serve_audio_stream(stream_id):
+    stream = get_audio_stream(stream_id)
+    if stream is not None:
+        return Response(stream.iter_chunks(), mimetype="audio/mpeg")
+    # Synthesis is running in another worker process, or already finished and the clip is in the cache
+    chunks = follow_partial_stream(stream_id)
+    if chunks is not None:
+        return Response(chunks, mimetype="audio/mpeg")
+    return serve_audio_file(f"{stream_id}.mp3")
     
 def pause_audio_on_device(device_name):
     chromecast_logger.info(f"Pause audio requested on {device_name}")
     try:
-        chromecasts, browser = pychromecast.get_listed_chromecasts(friendly_names=[device_name])
-        if not chromecasts:
-            raise ValueError(f"Device '{device_name}' not found")
-
-        cast = chromecasts[0]
-        cast.wait()
+        cast = registry.get(device_name)
         mc = cast.media_controller
         
         """ 
@@ -135,18 +342,11 @@ def pause_audio_on_device(device_name):
     except Exception as e:
         chromecast_logger.error(f"Error pausing message on {device_name}: {str(e)}")
         raise
-    finally:
-        pychromecast.discovery.stop_discovery(browser)
 
 def stop_audio_on_device(device_name):
     chromecast_logger.info(f"Stop audio requested on {device_name}")
     try:
-        chromecasts, browser = pychromecast.get_listed_chromecasts(friendly_names=[device_name])
-        if not chromecasts:
-            raise ValueError(f"Device '{device_name}' not found")
-
-        cast = chromecasts[0]
-        cast.wait()
+        cast = registry.get(device_name)
         mc = cast.media_controller
 
         if mc.status.player_state not in ["IDLE"]: # ['PLAYING', 'PAUSED']:
@@ -156,6 +356,4 @@ def stop_audio_on_device(device_name):
             chromecast_logger.warning(f"Cannot stop: Device '{device_name}' is in state {mc.status.player_state}")
     except Exception as e:
         chromecast_logger.error(f"Error stopping audio on {device_name}: {str(e)}")
-        raise
-    finally:
-        pychromecast.discovery.stop_discovery(browser)
\ No newline at end of file
+        raise
\ No newline at end of file
@@ -0,0 +1,213 @@
+# device_health.py
+
+import socket
+import threading
+import time
+from collections import deque
+
+from logger_utils import chromecast_logger
+
+FAILURE_THRESHOLD = 3        # Consecutive failures that mark a device unavailable
+RECENT_EVENTS = 20           # Outcomes kept per device for /api/devices
+PROBE_INTERVAL = 10.0        # Seconds before the first probe of an unavailable device
+PROBE_MAX_INTERVAL = 300.0   # Probes back off up to this many seconds while a device stays down
+PROBE_TIMEOUT = 2.0          # Seconds allowed for the TCP probe of a device's cast port
+SHARED_REFRESH = 1.0         # Seconds between reads of the breaker states other processes published
+
+class DeviceUnavailableError(ConnectionError):
+    """Raised instead of connecting to a device whose circuit breaker is open."""
+
+class _DeviceHealth:
+    __slots__ = ('state', 'consecutive_failures', 'recent', 'last_error', 'changed', 'retry_at', 'interval')
+
+    def __init__(self):
+        self.state = "healthy"
+        self.consecutive_failures = 0
+        self.recent = deque(maxlen=RECENT_EVENTS)  # (time, stage, ok, seconds)
+        self.last_error = None
+        self.changed = time.time()
+        self.retry_at = None
+        self.interval = PROBE_INTERVAL
+
+    def to_dict(self):
+        failures = sum(1 for _, _, ok, _ in self.recent if not ok)
+        latencies = [seconds for _, _, ok, seconds in self.recent if ok and seconds is not None]
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "recent_failures": failures,
+            "recent_events": len(self.recent),
+            "mean_latency_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            "last_error": self.last_error,
+            "changed": self.changed,
+            "retry_at": self.retry_at,
+        }
+
+class HealthTracker:
+    """
+    Per-device circuit breaker fed by connect and playback outcomes.
+
+    After FAILURE_THRESHOLD consecutive failures a device is marked
+    unavailable and check() fails immediately instead of letting every
+    request wait for a connect or playback timeout. A background thread
+    probes the device's cast port with backoff and closes the breaker once it
+    answers; a discovery announcement for the device triggers a probe at once.
+    With a shared state, breaker changes are published so every worker
+    process fails fast for the same devices.
+    """
+
+    def __init__(self, resolve_address, threshold=FAILURE_THRESHOLD):
+        self.resolve_address = resolve_address  # device name -> (host, port) or None
+        self.threshold = threshold
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._prober = None
+        self._state = None
+        self._shared = {}
+        self._shared_read = 0.0
+        self._listeners = []
+
+    def share(self, state):
+        self._state = state
+
+    def add_listener(self, callback):
+        """Register callback(device_name, status) for breaker state changes."""
+        self._listeners.append(callback)
+
+    def check(self, device_name):
+        """Raise DeviceUnavailableError if device_name's breaker is open here or in another process."""
+        with self._lock:
+            health = self._devices.get(device_name)
+            if health is not None and health.state == "unavailable":
+                raise DeviceUnavailableError(f"Device '{device_name}' is unavailable: {health.last_error}")
+        shared = self._shared_status(device_name)
+        if shared is not None and shared["state"] == "unavailable" and \
+                (health is None or shared["changed"] > health.changed):
+            raise DeviceUnavailableError(f"Device '{device_name}' is unavailable: {shared['last_error']}")
+
+    def record_success(self, device_name, stage, seconds=None):
+        with self._lock:
+            health = self._health(device_name)
+            health.recent.append((time.time(), stage, True, seconds))
+            health.consecutive_failures = 0
+            recovered = health.state != "healthy"
+            if recovered:
+                self._close(health)
+        if recovered:
+            chromecast_logger.info(f"Device {device_name} is healthy again after a successful {stage}")
+            self._publish(device_name)
+
+    def record_failure(self, device_name, stage, error):
+        if isinstance(error, DeviceUnavailableError):
+            return
+        with self._lock:
+            health = self._health(device_name)
+            health.recent.append((time.time(), stage, False, None))
+            health.consecutive_failures += 1
+            health.last_error = f"{stage}: {error}"
+            tripped = health.state == "healthy" and health.consecutive_failures >= self.threshold
+            if tripped:
+                health.state = "unavailable"
+                health.changed = time.time()
+                health.interval = PROBE_INTERVAL
+                health.retry_at = health.changed + health.interval
+        if tripped:
+            chromecast_logger.warning(f"Device {device_name} marked unavailable after {self.threshold} failures ({stage}: {error})")
+            self._publish(device_name)
+            self._start_prober()
+
+    def probe_now(self, device_name):
+        """Probe an unavailable device on the next prober pass, e.g. after it was announced again."""
+        with self._lock:
+            health = self._devices.get(device_name)
+            if health is None or health.state != "unavailable":
+                return
+            health.retry_at = time.time()
+        self._wakeup.set()
+
+    def status(self, device_name):
+        with self._lock:
+            health = self._devices.get(device_name)
+            local = health.to_dict() if health is not None else None
+        shared = self._shared_status(device_name)
+        if shared is not None and (local is None or shared["changed"] > local["changed"]):
+            return shared
+        return local or {"state": "healthy", "consecutive_failures": 0, "recent_failures": 0,
+                         "recent_events": 0, "mean_latency_ms": None, "last_error": None,
+                         "changed": None, "retry_at": None}
+
+    def _health(self, device_name):
+        health = self._devices.get(device_name)
+        if health is None:
+            health = self._devices[device_name] = _DeviceHealth()
+        return health
+
+    def _close(self, health):
+        health.state = "healthy"
+        health.changed = time.time()
+        health.retry_at = None
+        health.interval = PROBE_INTERVAL
+
+    def _publish(self, device_name):
+        with self._lock:
+            status = self._devices[device_name].to_dict()
+        for callback in self._listeners:
+            try:
+                callback(device_name, status)
+            except Exception as e:
+                chromecast_logger.error(f"Error in health listener: {str(e)}")
+        if self._state is None:
+            return
+        try:
+            self._state.put_health(device_name, status)
+        except Exception as e:
+            chromecast_logger.error(f"Error publishing health of {device_name}: {str(e)}")
+
+    def _shared_status(self, device_name):
+        if self._state is None:
+            return None
+        now = time.monotonic()
+        if now - self._shared_read > SHARED_REFRESH:
+            self._shared_read = now
+            try:
+                self._shared = self._state.health()
+            except Exception as e:
+                chromecast_logger.error(f"Error reading shared device health: {str(e)}")
+        return self._shared.get(device_name)
+
+    def _start_prober(self):
+        with self._lock:
+            if self._prober is not None:
+                return
+            self._prober = threading.Thread(target=self._probe_loop, name='device-prober', daemon=True)
+        self._prober.start()
+        self._wakeup.set()
+
+    def _probe_loop(self):
+        while True:
+            now = time.time()
+            with self._lock:
+                due = [name for name, h in self._devices.items() if h.state == "unavailable" and h.retry_at <= now]
+                pending = [h.retry_at for h in self._devices.values() if h.state == "unavailable"]
+            for device_name in due:
+                self._probe(device_name)
+            delay = max(0.1, min(pending) - time.time()) if pending else None
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+    def _probe(self, device_name):
+        address = self.resolve_address(device_name)
+        try:
+            if address is None:
+                raise OSError("no known address")
+            start = time.perf_counter()
+            socket.create_connection(address, timeout=PROBE_TIMEOUT).close()
+        except OSError as e:
+            with self._lock:
+                health = self._devices[device_name]
+                health.last_error = f"probe: {e}"
+                health.interval = min(health.interval * 2, PROBE_MAX_INTERVAL)
+                health.retry_at = time.time() + health.interval
+            return
+        self.record_success(device_name, "probe", time.perf_counter() - start)
@@ -0,0 +1,527 @@
+# device_registry.py
+
+import ipaddress
+import json
+import os
+import threading
+import time
+import uuid as uuid_module
+from concurrent.futures import Future
+import pychromecast
+import zeroconf
+from pychromecast.controllers.media import MediaStatusListener
+from pychromecast.controllers.multizone import MultizoneController, MultiZoneControllerListener
+from pychromecast.controllers.receiver import CastStatusListener
+from pychromecast.discovery import AbstractCastListener, CastBrowser
+from pychromecast.models import CastInfo, HostServiceInfo
+from pychromecast.socket_client import (
+    ConnectionStatusListener,
+    CONNECTION_STATUS_DISCONNECTED,
+    CONNECTION_STATUS_FAILED,
+    CONNECTION_STATUS_LOST,
+)
+from logger_utils import chromecast_logger
+from metrics import metrics
+from device_health import HealthTracker
+from events import event_hub
+
+DEVICE_IP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'json', 'device_ip.json')
+
+CAST_PORT = 8009
+CONNECT_TIMEOUT = 10.0    # Seconds to wait for the first status message from a device
+CONNECT_TRIES = 3         # Let a dropped connection fail so the registry can rebuild it
+GROUP_STATUS_TIMEOUT = 3.0  # Seconds to wait for a cast group to report its members
+FOLLOW_INTERVAL = 1.0     # Seconds between device table checks in processes that do not run discovery
+
+def load_device_ip(path=DEVICE_IP_FILE):
+    """Load the static name -> IP fallback table."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        chromecast_logger.warning(f"Could not load device IP table {path}: {str(e)}")
+        return {}
+
+class _ConnectionWatcher(ConnectionStatusListener):
+    """Evicts a cached Chromecast from the registry once its socket goes down."""
+
+    def __init__(self, registry, device_name, cast):
+        self.registry = registry
+        self.device_name = device_name
+        self.cast = cast
+
+    def new_connection_status(self, status):
+        if status.status in (CONNECTION_STATUS_LOST, CONNECTION_STATUS_FAILED):
+            self.registry.health.record_failure(self.device_name, "connection", status.status)
+        if status.status in (CONNECTION_STATUS_LOST, CONNECTION_STATUS_FAILED, CONNECTION_STATUS_DISCONNECTED):
+            self.registry.evict(self.device_name, self.cast, reason=status.status)
+
+class _VolumeWatcher(CastStatusListener):
+    """Publishes volume and running-app changes from a connection's receiver status."""
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self._last = None
+
+    def new_cast_status(self, status):
+        current = (status.volume_level, status.volume_muted, status.display_name)
+        if current == self._last:
+            return
+        self._last = current
+        event_hub.publish("volume", {"device": self.device_name, "volume_level": status.volume_level,
+                                     "muted": status.volume_muted, "app": status.display_name})
+
+class _GroupMembersWatcher(MultiZoneControllerListener):
+    def __init__(self):
+        self.received = threading.Event()
+
+    def multizone_member_added(self, group_uuid):
+        pass
+
+    def multizone_member_removed(self, group_uuid):
+        pass
+
+    def multizone_status_received(self):
+        self.received.set()
+
+class _Waiter:
+    __slots__ = ('future', 'until', 'stale_session', 'session')
+
+    def __init__(self, until, stale_session):
+        self.future = Future()
+        self.until = until                  # "loaded" or "finished"
+        self.stale_session = stale_session  # Session already playing when armed, ignored
+        self.session = None                 # Our media's session once it shows up
+
+class PlaybackTracker(MediaStatusListener):
+    """
+    Turns a device's media status callbacks into playback futures.
+
+    Call expect_finish() or expect_loaded() before play_media; the returned
+    future resolves with the MediaStatus once that media has gone back to
+    IDLE, or has been loaded, and fails if loading fails or the connection
+    drops. The tracker outlives individual connections and is re-attached on
+    every reconnect.
+    """
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.status = None
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._published = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Register callback(status) for every media status; it runs on the connection's thread and must not block."""
+        self._listeners.append(callback)
+
+    def expect_finish(self):
+        return self._arm("finished")
+
+    def expect_loaded(self):
+        return self._arm("loaded")
+
+    def _arm(self, until):
+        with self._lock:
+            playing = self.status is not None and self.status.player_state not in ('IDLE', 'UNKNOWN')
+            waiter = _Waiter(until, self.status.media_session_id if playing else None)
+            self._waiters.append(waiter)
+        return waiter.future
+
+    def attach(self, cast):
+        cast.media_controller.register_status_listener(self)
+
+    def new_media_status(self, status):
+        self._publish(status)
+        for callback in self._listeners:
+            try:
+                callback(status)
+            except Exception as e:
+                chromecast_logger.error(f"Error in media status listener for {self.device_name}: {str(e)}")
+        resolved = []
+        with self._lock:
+            self.status = status
+            active = status.player_state not in ('IDLE', 'UNKNOWN')
+            # Drop waiters whose caller gave up and cancelled the future
+            self._waiters = [w for w in self._waiters if not w.future.done()]
+            for waiter in list(self._waiters):
+                if active and waiter.session is None and status.media_session_id != waiter.stale_session:
+                    waiter.session = status.media_session_id
+                    if waiter.until == "loaded":
+                        self._waiters.remove(waiter)
+                        resolved.append(waiter.future)
+                elif status.player_state == 'IDLE' and waiter.session is not None and waiter.session == status.media_session_id:
+                    # Only the session that started after arming counts,
+                    # not the previous clip being interrupted by ours
+                    self._waiters.remove(waiter)
+                    resolved.append(waiter.future)
+        for future in resolved:
+            if not future.done():
+                future.set_result(status)
+
+    def _publish(self, status):
+        # Position updates arrive often; only state and media changes are pushed
+        current = (status.player_state, status.media_session_id, status.content_id)
+        if current == self._published:
+            return
+        self._published = current
+        event_hub.publish("player", {"device": self.device_name, "player_state": status.player_state,
+                                     "content_id": status.content_id, "title": getattr(status, 'title', None),
+                                     "idle_reason": status.idle_reason})
+
+    def load_media_failed(self, queue_item_id, error_code):
+        self.fail(RuntimeError(f"Loading media failed on {self.device_name} (error {error_code})"))
+
+    def fail(self, exc):
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.future.done():
+                waiter.future.set_exception(exc)
+
+class DeviceBrowser(AbstractCastListener):
+    """
+    Continuous mDNS discovery built on pychromecast's CastBrowser.
+
+    Devices are added, updated and removed as announcements arrive, and kept
+    in name -> CastInfo and IP -> CastInfo indexes so lookups never scan the
+    network. The sorted {"name", "ip"} list served by /api/devices is rebuilt
+    only when the table changes.
+
+    Only one process browses. It publishes the table to the shared state,
+    and the other worker processes follow it from there with the same
+    indexes and listener events.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_uuid = {}
+        self._by_name = {}
+        self._by_ip = {}
+        self._devices = []
+        self._listeners = []
+        self._browser = None
+        self._state = None
+        self._following = None
+        self._started = None
+        self.zconf = None
+
+    def start(self, known_hosts=None, state=None):
+        if self._browser is not None:
+            return
+        self.unfollow()
+        self._state = state
+        self._started = time.perf_counter()
+        self.zconf = zeroconf.Zeroconf()
+        self._browser = CastBrowser(self, self.zconf, known_hosts)
+        self._browser.start_discovery()
+        chromecast_logger.info("Started continuous device discovery")
+
+    def stop(self):
+        if self._browser is not None:
+            self._browser.stop_discovery()
+            self._browser = None
+            self.zconf = None
+
+    def follow(self, state, interval=FOLLOW_INTERVAL):
+        """Mirror the device table another process publishes to state, until unfollow()."""
+        if self._following is not None:
+            return
+        self._following = threading.Event()
+        threading.Thread(target=self._follow_loop, args=(state, interval, self._following),
+                         name='device-follower', daemon=True).start()
+
+    def unfollow(self):
+        if self._following is not None:
+            self._following.set()
+            self._following = None
+
+    def add_listener(self, callback):
+        """Register callback(event, info) for "added", "updated" and "removed" events."""
+        self._listeners.append(callback)
+
+    def devices(self):
+        return self._devices
+
+    def lookup(self, device_name):
+        return self._by_name.get(device_name)
+
+    def lookup_ip(self, ip):
+        return self._by_ip.get(ip)
+
+    def lookup_uuid(self, uuid):
+        return self._by_uuid.get(uuid)
+
+    def groups(self):
+        """Names of the discovered cast groups (audio groups announce on a port other than 8009)."""
+        return [info.friendly_name for info in self._by_name.values() if info.port != CAST_PORT]
+
+    def add_cast(self, uuid, service):
+        self._store(uuid, "added")
+
+    def update_cast(self, uuid, service):
+        self._store(uuid, "updated")
+
+    def remove_cast(self, uuid, service, cast_info):
+        with self._lock:
+            if self._by_uuid.pop(uuid, None) is None:
+                return
+            self._reindex()
+        metrics.increment("discovery_events", "removed")
+        chromecast_logger.info(f"Device removed: {cast_info.friendly_name} ({cast_info.host})")
+        self._publish()
+        self._notify("removed", cast_info)
+
+    def _follow_loop(self, state, interval, stopped):
+        version = None
+        while not stopped.is_set():
+            try:
+                current = state.version()
+                if current != version:
+                    version = current
+                    self._apply(state.devices())
+            except Exception as e:
+                chromecast_logger.error(f"Error reading shared device table: {str(e)}")
+            stopped.wait(interval)
+
+    def _apply(self, rows):
+        infos = {}
+        for row in rows:
+            uuid = uuid_module.UUID(row['uuid'])
+            infos[uuid] = CastInfo({HostServiceInfo(row['ip'], row['port'])}, uuid, row['model'],
+                                   row['name'], row['ip'], row['port'], row['cast_type'], row['manufacturer'])
+        with self._lock:
+            previous, self._by_uuid = self._by_uuid, infos
+            self._reindex()
+        for uuid, info in previous.items():
+            if uuid not in infos:
+                self._notify("removed", info)
+        for uuid, info in infos.items():
+            old = previous.get(uuid)
+            if old is None:
+                self._notify("added", info)
+            elif (old.host, old.port, old.friendly_name) != (info.host, info.port, info.friendly_name):
+                self._notify("updated", info)
+
+    def _publish(self):
+        if self._state is None:
+            return
+        with self._lock:
+            rows = [{"uuid": str(info.uuid), "name": info.friendly_name, "ip": info.host, "port": info.port,
+                     "model": info.model_name, "cast_type": info.cast_type, "manufacturer": info.manufacturer}
+                    for info in self._by_uuid.values()]
+        try:
+            self._state.put_devices(rows)
+        except Exception as e:
+            chromecast_logger.error(f"Error publishing device table: {str(e)}")
+
+    def _store(self, uuid, event):
+        browser = self._browser
+        info = browser.devices.get(uuid) if browser is not None else None
+        if info is None or not info.friendly_name:
+            return
+        with self._lock:
+            previous = self._by_uuid.get(uuid)
+            self._by_uuid[uuid] = info
+            if previous is not None and (previous.host, previous.port, previous.friendly_name) == (info.host, info.port, info.friendly_name):
+                return
+            self._reindex()
+        metrics.increment("discovery_events", event)
+        if previous is None:
+            # How long after startup each device was found
+            metrics.observe("discovery", time.perf_counter() - self._started, info.friendly_name)
+            chromecast_logger.info(f"Device discovered: {info.friendly_name} ({info.host})")
+        else:
+            chromecast_logger.info(f"Device updated: {info.friendly_name} ({info.host})")
+        self._publish()
+        self._notify(event, info)
+
+    def _reindex(self):
+        # Prefer the device itself (port 8009) over cast groups sharing its IP
+        infos = sorted(self._by_uuid.values(), key=lambda i: i.port != CAST_PORT)
+        by_ip = {}
+        for info in infos:
+            by_ip.setdefault(info.host, info)
+        self._by_name = {info.friendly_name: info for info in reversed(infos)}
+        self._by_ip = by_ip
+        devices = [{"name": info.friendly_name, "ip": info.host} for info in by_ip.values()]
+        self._devices = sorted(devices, key=lambda d: _ip_sort_key(d['ip']))
+
+    def _notify(self, event, info):
+        for callback in self._listeners:
+            try:
+                callback(event, info)
+            except Exception as e:
+                chromecast_logger.error(f"Error in discovery listener: {str(e)}")
+
+def _ip_sort_key(ip):
+    try:
+        return (0, ipaddress.ip_address(ip))
+    except ValueError:
+        return (1, ip)
+
+class DeviceRegistry:
+    """
+    Long-lived pool of connected Chromecast objects, one per device name.
+
+    Connections are opened on first use and reused by every caller. When a
+    device drops, moves to a new address or disappears from discovery, its
+    entry is evicted and the next call reconnects, using the browser's table
+    first and the static device_ip.json table as a fallback. A device whose
+    circuit breaker is open (see device_health.py) fails at once instead.
+    """
+
+    def __init__(self, browser, device_ip=None):
+        self.browser = browser
+        self._casts = {}
+        self._trackers = {}
+        self._multizone = {}
+        self._device_ip = load_device_ip() if device_ip is None else dict(device_ip)
+        self._lock = threading.Lock()
+        self._connect_locks = {}
+        self.health = HealthTracker(self._address)
+        browser.add_listener(self._on_discovery)
+
+    def _on_discovery(self, event, info):
+        if event in ("updated", "removed"):
+            self.evict(info.friendly_name, reason=f"device {event}")
+        if event in ("added", "updated"):
+            self.health.probe_now(info.friendly_name)
+
+    def _address(self, device_name):
+        info = self.browser.lookup(device_name)
+        if info is not None:
+            return info.host, info.port
+        with self._lock:
+            ip = self._device_ip.get(device_name)
+        return (ip, CAST_PORT) if ip else None
+
+    def known_hosts(self):
+        """IPs from device_ip.json, polled directly in case mDNS misses them."""
+        with self._lock:
+            return list(self._device_ip.values())
+
+    def knows(self, device_name):
+        """Whether device_name was discovered or is listed in device_ip.json."""
+        if self.browser.lookup(device_name) is not None:
+            return True
+        with self._lock:
+            return device_name in self._device_ip
+
+    def get(self, device_name, timeout=CONNECT_TIMEOUT):
+        """Return a connected Chromecast for device_name, connecting if needed."""
+        self.health.check(device_name)
+        cast = self._casts.get(device_name)
+        if cast is not None and cast.socket_client.is_connected:
+            return cast
+
+        # Only one thread connects to a given device; the others wait and reuse it
+        with self._connect_lock(device_name):
+            cast = self._casts.get(device_name)
+            if cast is not None and cast.socket_client.is_connected:
+                return cast
+            if cast is not None:
+                self.evict(device_name, cast, reason="stale")
+
+            cast = self._connect(device_name, timeout)
+            with self._lock:
+                self._casts[device_name] = cast
+            return cast
+
+    def playback(self, device_name):
+        """Return the PlaybackTracker for device_name, which persists across reconnects."""
+        with self._lock:
+            tracker = self._trackers.get(device_name)
+            if tracker is None:
+                tracker = self._trackers[device_name] = PlaybackTracker(device_name)
+            return tracker
+
+    def group_members(self, group_name, timeout=GROUP_STATUS_TIMEOUT):
+        """Return the device names in a cast group, asking the group once per connection."""
+        cast = self.get(group_name)
+        with self._lock:
+            entry = self._multizone.get(group_name)
+        if entry is None or entry[0] is not cast:
+            controller = MultizoneController(cast.uuid)
+            watcher = _GroupMembersWatcher()
+            controller.register_listener(watcher)
+            cast.register_handler(controller)
+            controller.update_members()
+            watcher.received.wait(timeout)
+            entry = (cast, controller)
+            with self._lock:
+                self._multizone[group_name] = entry
+
+        members = set()
+        for member in entry[1].members:
+            try:
+                info = self.browser.lookup_uuid(uuid_module.UUID(member))
+            except ValueError:
+                info = None
+            if info is not None:
+                members.add(info.friendly_name)
+        return members
+
+    def evict(self, device_name, cast=None, reason=""):
+        """Drop a cached connection; the next get() will reconnect."""
+        with self._lock:
+            current = self._casts.get(device_name)
+            if current is None or (cast is not None and current is not cast):
+                return
+            del self._casts[device_name]
+        chromecast_logger.info(f"Dropped connection to {device_name} ({reason})")
+        self.playback(device_name).fail(ConnectionError(f"Connection to {device_name} dropped ({reason})"))
+        # Non-blocking, safe to call from the socket client's own thread
+        current.socket_client.disconnect()
+
+    def close(self):
+        with self._lock:
+            casts, self._casts = self._casts, {}
+        for cast in casts.values():
+            cast.socket_client.disconnect()
+
+    def _connect_lock(self, device_name):
+        with self._lock:
+            return self._connect_locks.setdefault(device_name, threading.Lock())
+
+    def _create_cast(self, device_name, timeout):
+        info = self.browser.lookup(device_name)
+        if info is not None:
+            chromecast_logger.info(f"Connecting to {device_name} at {info.host}:{info.port}")
+            return pychromecast.get_chromecast_from_cast_info(
+                info, self.browser.zconf, tries=CONNECT_TRIES, timeout=timeout)
+
+        with self._lock:
+            ip = self._device_ip.get(device_name)
+        if not ip:
+            raise ValueError(f"Device '{device_name}' not found")
+        chromecast_logger.info(f"Device {device_name} not discovered, using IP from device_ip: {ip}")
+        return pychromecast.get_chromecast_from_host(
+            (ip, CAST_PORT, None, None, device_name), tries=CONNECT_TRIES, timeout=timeout)
+
+    def _connect(self, device_name, timeout):
+        start = time.perf_counter()
+        try:
+            with metrics.timer("connect", device_name):
+                cast = self._create_cast(device_name, timeout)
+                try:
+                    cast.wait(timeout=timeout)
+                except Exception:
+                    cast.socket_client.disconnect()
+                    raise
+        except ValueError:
+            raise  # Unknown device, nothing wrong with its health
+        except Exception as e:
+            self.health.record_failure(device_name, "connect", e)
+            raise
+        self.health.record_success(device_name, "connect", time.perf_counter() - start)
+        cast.register_connection_listener(_ConnectionWatcher(self, device_name, cast))
+        cast.register_status_listener(_VolumeWatcher(device_name))
+        self.playback(device_name).attach(cast)
+        chromecast_logger.info(f"Connected to device {device_name}")
+        return cast
+
+# Shared by every endpoint and worker thread
+device_browser = DeviceBrowser()
+registry = DeviceRegistry(device_browser)
@@ -0,0 +1,162 @@
+# events.py
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+from logger_utils import chromecast_logger
+
+EVENT_HISTORY = 1000          # Events kept for clients reconnecting with Last-Event-ID
+EVENT_POLL_INTERVAL = 0.25    # Seconds between reads of events published by other worker processes
+EVENT_HEARTBEAT = 15.0        # Seconds between keep-alive comments on an idle stream
+EVENT_MAX_SUBSCRIBERS = 8     # Open streams per process; each one holds a server thread
+EVENT_RETRY_MS = 5000         # Reconnect delay suggested to EventSource clients
+EVENT_QUEUE_SIZE = 10000      # Events waiting for the database writer; beyond this they are dropped, never waited for
+EVENT_BATCH = 200             # Most events written in one transaction
+
+class TooManySubscribers(Exception):
+    pass
+
+class EventHub:
+    """
+    Fan-out of device, health, player, volume, job and media queue events to Server-Sent Events streams.
+
+    Events are published from the connections and queue lanes that already
+    exist, so watching a device costs no extra cast traffic. Each event gets
+    an increasing id and the last EVENT_HISTORY are kept, so a reconnecting
+    client resumes where it stopped. With a shared state, events are written
+    to the database and every worker process tails it, so a stream served by
+    any worker sees events from all of them. Publishing only queues the event;
+    one writer thread per process does the inserts, so cast socket threads,
+    lanes and job updates never wait for the database.
+    """
+
+    def __init__(self, history=EVENT_HISTORY, max_subscribers=EVENT_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._events = deque(maxlen=history)   # (id, type, data)
+        self._latest = {}                      # (type, device) -> data, for the snapshot sent on connect
+        self._next_id = 1
+        self._subscribers = 0
+        self._cond = threading.Condition()
+        self._state = None
+        self._tail = None
+        self._outbox = queue.Queue(EVENT_QUEUE_SIZE)
+        self.dropped = 0
+
+    def share(self, state):
+        """Publish through state and follow the events of the other worker processes."""
+        if self._state is not None:
+            return
+        self._state = state
+        with self._cond:
+            self._next_id = state.last_event_id() + 1
+        self._tail = threading.Thread(target=self._tail_loop, name='event-tail', daemon=True)
+        self._tail.start()
+        threading.Thread(target=self._write_loop, name='event-writer', daemon=True).start()
+
+    def publish(self, event_type, data):
+        if self._state is not None:
+            try:
+                self._outbox.put_nowait((event_type, data))
+            except queue.Full:
+                self.dropped += 1
+            return
+        with self._cond:
+            self._append(self._next_id, event_type, data)
+
+    def latest(self):
+        """Most recent event data per type and device."""
+        with self._cond:
+            snapshot = {}
+            for (event_type, device), data in self._latest.items():
+                snapshot.setdefault(event_type, {})[device] = data
+            return snapshot
+
+    def stream(self, last_id=None, types=None, snapshot=None):
+        """
+        Generator of SSE frames, starting after last_id (or with only new
+        events). Raises TooManySubscribers if this process is already serving
+        max_subscribers streams.
+        """
+        with self._cond:
+            if self._subscribers >= self.max_subscribers:
+                raise TooManySubscribers()
+            self._subscribers += 1
+            if last_id is None:
+                last_id = self._next_id - 1
+        return self._frames(last_id, types, snapshot)
+
+    def _frames(self, last_id, types, snapshot):
+        try:
+            yield f"retry: {EVENT_RETRY_MS}\n\n"
+            if snapshot is not None:
+                yield _frame(None, "snapshot", snapshot)
+            while True:
+                with self._cond:
+                    pending = [e for e in self._events if e[0] > last_id]
+                    if not pending:
+                        self._cond.wait(EVENT_HEARTBEAT)
+                        pending = [e for e in self._events if e[0] > last_id]
+                if not pending:
+                    yield ": keep-alive\n\n"
+                    continue
+                for event_id, event_type, data in pending:
+                    last_id = event_id
+                    if types is None or event_type in types:
+                        yield _frame(event_id, event_type, data)
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def _append(self, event_id, event_type, data):
+        self._events.append((event_id, event_type, data))
+        self._next_id = max(self._next_id, event_id + 1)
+        if isinstance(data, dict) and "device" in data:
+            self._latest[(event_type, data["device"])] = data
+        self._cond.notify_all()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._outbox.get()]
+            while len(batch) < EVENT_BATCH:
+                try:
+                    batch.append(self._outbox.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._state.add_events(batch)
+            except Exception as e:
+                chromecast_logger.error(f"Error sharing {len(batch)} events: {str(e)}")
+                # Not lost for this process's own streams
+                with self._cond:
+                    for event_type, data in batch:
+                        self._append(self._next_id, event_type, data)
+
+    def _tail_loop(self):
+        version = None
+        while True:
+            try:
+                current = self._state.version()
+                if current != version:
+                    version = current
+                    with self._cond:
+                        after = self._next_id - 1
+                    rows = self._state.events_after(after)
+                    if rows:
+                        with self._cond:
+                            for event_id, event_type, data in rows:
+                                self._append(event_id, event_type, data)
+                        self._state.trim_events(EVENT_HISTORY)
+            except Exception as e:
+                chromecast_logger.error(f"Error reading shared events: {str(e)}")
+            time.sleep(EVENT_POLL_INTERVAL)
+
+def _frame(event_id, event_type, data):
+    lines = [f"event: {event_type}", f"data: {json.dumps(data)}"]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+    return "\n".join(lines) + "\n\n"
+
+event_hub = EventHub()
@@ -0,0 +1,326 @@
+# federation.py
+
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import requests
+
+from logger_utils import chromecast_logger, carry_context
+from metrics import metrics
+from shared_state import shared_state
+
+FEDERATION_PEERS = [url.strip().rstrip('/') for url in os.environ.get('NESTCAST_PEERS', '').split(',') if url.strip()]
+FEDERATION_TOKEN = os.environ.get('NESTCAST_FEDERATION_TOKEN') or None  # Shared secret between nodes, if set
+FEDERATION_SYNC_INTERVAL = 10.0   # Seconds between device table pulls from each peer
+FEDERATION_STALE_AFTER = 60.0     # A peer's devices are dropped when it has not answered for this long
+FEDERATION_PRUNE_AFTER = 600.0    # A registered peer (not one in NESTCAST_PEERS) is forgotten after failing this long
+FEDERATION_SYNC_TIMEOUT = 5.0     # Seconds allowed for a registration or device table request
+FEDERATION_FORWARD_TIMEOUT = 150.0  # Longer than FANOUT_TIMEOUT, so a peer reports its own device timeouts
+FEDERATION_POOL_SIZE = 16         # Persistent connections kept per peer
+FORWARDED_HEADER = 'X-NestCast-Forwarded'
+TOKEN_HEADER = 'X-NestCast-Token'
+
+_SERVER_TIMING = re.compile(r'app;dur=([0-9.]+)')
+
+class Peer:
+    __slots__ = ('url', 'name', 'devices', 'synced', 'last_error', 'round_trip', 'failing_since')
+
+    def __init__(self, url, name=None):
+        self.url = url
+        self.name = name
+        self.devices = []
+        self.synced = None
+        self.last_error = None
+        self.round_trip = None
+        self.failing_since = None
+
+    def to_dict(self):
+        return {"name": self.name, "url": self.url, "devices": [d["name"] for d in self.devices],
+                "synced": self.synced, "last_error": self.last_error,
+                "round_trip_ms": round(self.round_trip * 1000, 1) if self.round_trip is not None else None}
+
+class Federation:
+    """
+    Device tables shared between NestCast nodes, and request forwarding.
+
+    Each node registers with the peers it is configured with (NESTCAST_PEERS)
+    and pulls their local device tables periodically. A request naming
+    devices that another node owns is split: the local devices are handled
+    here, and the rest is forwarded to the owning nodes in parallel over
+    pooled keep-alive connections. The forwarded results are merged into
+    the usual results list, with each node's round trip and the part of it
+    not spent inside the peer's application.
+
+    A node registering itself can claim device names, so registration is
+    only accepted with the shared token (NESTCAST_FEDERATION_TOKEN) or, when
+    no token is set, from a URL listed in NESTCAST_PEERS.
+    """
+
+    def __init__(self, node_name=None, node_url=None, peers=FEDERATION_PEERS, token=FEDERATION_TOKEN, state=None):
+        self.node_name = node_name
+        self.node_url = node_url
+        self.token = token
+        self.state = state
+        self._peers = {url: Peer(url) for url in peers}
+        self._configured = set(peers)
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=FEDERATION_POOL_SIZE))
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=FEDERATION_POOL_SIZE))
+        self._pool = ThreadPoolExecutor(max_workers=FEDERATION_POOL_SIZE, thread_name_prefix='federation')
+        self._local_devices = lambda: []
+        self._started = False
+
+    @property
+    def enabled(self):
+        with self._lock:
+            return bool(self._peers)
+
+    def start(self, node_name, node_url, local_devices):
+        """Register with the configured peers and keep their device tables; local_devices() gives this node's table."""
+        if self._started:
+            return
+        self._started = True
+        self.node_name, self.node_url = node_name, node_url.rstrip('/')
+        self._local_devices = local_devices
+        threading.Thread(target=self._sync_loop, name='federation-sync', daemon=True).start()
+
+    def authorized(self, headers):
+        return self.token is None or headers.get(TOKEN_HEADER) == self.token
+
+    def may_register(self, url, headers):
+        """Whether the node at url may join: it has the token, or there is none and url is a configured peer."""
+        if self.token is not None:
+            return headers.get(TOKEN_HEADER) == self.token
+        return url.rstrip('/') in self._configured
+
+    def register(self, name, url, devices=None):
+        """Add or rename a peer that registered with this node; returns this node's device table."""
+        url = url.rstrip('/')
+        with self._lock:
+            peer = self._peers.get(url)
+            if peer is None:
+                peer = self._peers[url] = Peer(url, name)
+                chromecast_logger.info(f"Node {name} at {url} joined the federation")
+            peer.name = name
+            if devices is not None:
+                # The registering node sends its table along, so its devices are usable before the next pull
+                peer.devices = [d for d in devices if isinstance(d, dict) and d.get("name")]
+                peer.synced = time.time()
+        if self.state is not None:
+            try:
+                self.state.put_peer(url, name)
+            except Exception as e:
+                chromecast_logger.error(f"Error saving peer {url}: {str(e)}")
+        return self.local_table()
+
+    def local_table(self):
+        return {"name": self.node_name, "url": self.node_url, "devices": self._local_devices()}
+
+    def peers(self):
+        with self._lock:
+            return [peer.to_dict() for peer in self._peers.values()]
+
+    def devices(self):
+        """Devices owned by other nodes, each with the owning node's name and URL."""
+        local = {d["name"] for d in self._local_devices()}
+        with self._lock:
+            peers = list(self._peers.values())
+        devices, seen = [], set(local)
+        for peer in peers:
+            for device in peer.devices:
+                if device["name"] not in seen:
+                    seen.add(device["name"])
+                    devices.append(dict(device, node=peer.name, node_url=peer.url))
+        return devices
+
+    def owner(self, device_name):
+        """The peer that owns device_name, or None if it is local or unknown."""
+        local_names, remote = self.split([device_name])
+        return next(iter(remote), None)
+
+    def fetch(self, peer, path):
+        """GET path from peer; returns the decoded JSON, or None if the peer did not answer."""
+        headers = {FORWARDED_HEADER: self.node_name or '1'}
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+        try:
+            with metrics.timer("federation_forward", peer.name):
+                response = self._session.get(f"{peer.url}{path}", headers=headers, timeout=FEDERATION_SYNC_TIMEOUT)
+                return response.json()
+        except (requests.RequestException, ValueError) as e:
+            chromecast_logger.error(f"Fetching {path} from {peer.name} failed: {str(e)}")
+            return None
+
+    def find(self, path):
+        """GET path from every named peer at once; returns the first answer that is not an error, or None."""
+        with self._lock:
+            peers = [peer for peer in self._peers.values() if peer.name is not None]
+        for answer in self._pool.map(carry_context(lambda peer: self.fetch(peer, path)), peers):
+            if answer is not None and answer.get("status") != "Error":
+                return answer
+        return None
+
+    def split(self, device_names):
+        """
+        Return (local names, {Peer: names}). A device is local unless only a
+        peer has it; unknown names stay local so the usual error is reported.
+        """
+        local = {d["name"] for d in self._local_devices()}
+        owners = {}
+        with self._lock:
+            for peer in self._peers.values():
+                for device in peer.devices:
+                    owners.setdefault(device["name"], peer)
+        local_names, remote = [], {}
+        for name in device_names:
+            peer = owners.get(name)
+            if name in local or peer is None:
+                local_names.append(name)
+            else:
+                remote.setdefault(peer, []).append(name)
+        return local_names, remote
+
+    def forward(self, peer, path, device_names, form=None, json_body=None, files=None):
+        """
+        POST a request for device_names to peer, in the background. The form
+        or JSON body must already name only that peer's devices; files map a
+        field to (filename, path, mimetype). Returns a future for collect().
+        """
+        return self._pool.submit(carry_context(self._forward), peer, path, device_names, form, json_body, files)
+
+    def collect(self, forwards, timeout=FEDERATION_FORWARD_TIMEOUT):
+        """Wait for forwarded requests; returns (results for their devices, per-node summary)."""
+        results, nodes = [], []
+        deadline = time.monotonic() + timeout
+        for peer, device_names, future in forwards:
+            try:
+                node_results, node = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                message = f"Node {peer.name} did not answer within {timeout:.0f}s"
+                node_results = [{"device": d, "status": "Error", "message": message} for d in device_names]
+                node = {"node": peer.name, "devices": device_names, "status": "Timeout"}
+            results.extend(node_results)
+            nodes.append(node)
+        return results, nodes
+
+    def _forward(self, peer, path, device_names, form, json_body, files):
+        headers = {FORWARDED_HEADER: self.node_name or '1'}
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+        kwargs = {"files": {}}
+        if json_body is not None:
+            kwargs["json"] = json_body
+        else:
+            kwargs["data"] = form or {}
+        start = time.perf_counter()
+        try:
+            # Files are (filename, path, mimetype); each peer reads its own handle
+            for field, (filename, file_path, mimetype) in (files or {}).items():
+                kwargs["files"][field] = (filename, open(file_path, 'rb'), mimetype)
+            response = self._session.post(f"{peer.url}{path}", headers=headers,
+                                          timeout=(FEDERATION_SYNC_TIMEOUT, FEDERATION_FORWARD_TIMEOUT), **kwargs)
+            round_trip = time.perf_counter() - start
+            body = response.json()
+        except (requests.RequestException, ValueError, OSError) as e:
+            metrics.increment('stage_errors', 'federation_forward', peer.name)
+            chromecast_logger.error(f"Forwarding {path} to {peer.name} failed: {str(e)}")
+            message = f"Node {peer.name} unreachable: {e}"
+            return ([{"device": d, "status": "Error", "message": message} for d in device_names],
+                    {"node": peer.name, "devices": device_names, "status": "Error", "message": str(e)})
+        finally:
+            for _, f, _ in kwargs["files"].values():
+                f.close()
+
+        remote = _server_time(response)
+        overhead = round_trip - remote if remote is not None else None
+        metrics.observe("federation_forward", round_trip, peer.name)
+        if overhead is not None:
+            metrics.observe("federation_overhead", max(0.0, overhead), peer.name)
+        node = {"node": peer.name, "devices": device_names, "status_code": response.status_code,
+                "round_trip_ms": round(round_trip * 1000, 1),
+                "remote_ms": round(remote * 1000, 1) if remote is not None else None,
+                "overhead_ms": round(overhead * 1000, 1) if overhead is not None else None}
+        body = body if isinstance(body, dict) else {}
+        for key in ("job_id", "job_ids", "jobs"):
+            if body.get(key):
+                node[key] = body[key]
+        node_results = body.get("results")
+        if not node_results:
+            # Queued requests answer with job ids instead of per-device results
+            entry = {"status": body.get("status", "Forwarded" if response.ok else "Error")}
+            for key in ("job_id", "message"):
+                if body.get(key):
+                    entry[key] = body[key]
+            node_results = [dict(entry, device=d) for d in device_names]
+        return [dict(r, node=peer.name) for r in node_results], node
+
+    def _sync_loop(self):
+        while True:
+            if self.state is not None:
+                try:
+                    for url, name in self.state.peers():
+                        if self.token is None and url not in self._configured:
+                            continue  # Saved under an earlier configuration
+                        with self._lock:
+                            if url != self.node_url and url not in self._peers:
+                                self._peers[url] = Peer(url, name)
+                except Exception as e:
+                    chromecast_logger.error(f"Error reading peers: {str(e)}")
+            with self._lock:
+                peers = list(self._peers.values())
+            for peer in peers:
+                self._sync(peer)
+            time.sleep(FEDERATION_SYNC_INTERVAL)
+
+    def _sync(self, peer):
+        headers = {TOKEN_HEADER: self.token} if self.token else {}
+        start = time.perf_counter()
+        try:
+            if peer.name is None:
+                # Registering also returns the peer's table and lets it pull ours
+                response = self._session.post(f"{peer.url}/api/federation/register", headers=headers,
+                                              json=self.local_table(),
+                                              timeout=FEDERATION_SYNC_TIMEOUT)
+            else:
+                response = self._session.get(f"{peer.url}/api/federation/devices", headers=headers,
+                                             timeout=FEDERATION_SYNC_TIMEOUT)
+            response.raise_for_status()
+            table = response.json()
+        except (requests.RequestException, ValueError) as e:
+            now = time.time()
+            with self._lock:
+                peer.last_error = str(e)
+                peer.failing_since = peer.failing_since or now
+                if peer.synced is not None and now - peer.synced > FEDERATION_STALE_AFTER:
+                    peer.devices = []
+                prune = peer.url not in self._configured and now - peer.failing_since > FEDERATION_PRUNE_AFTER
+                if prune:
+                    self._peers.pop(peer.url, None)
+            if prune:
+                chromecast_logger.info(f"Dropped node {peer.name} at {peer.url}: no answer for {FEDERATION_PRUNE_AFTER:.0f}s")
+                if self.state is not None:
+                    try:
+                        self.state.delete_peer(peer.url)
+                    except Exception as e:
+                        chromecast_logger.error(f"Error removing peer {peer.url}: {str(e)}")
+            return
+        with self._lock:
+            if peer.name is None:
+                chromecast_logger.info(f"Registered with node {table.get('name')} at {peer.url}")
+            peer.name = table.get("name") or peer.url
+            peer.devices = [d for d in table.get("devices", []) if isinstance(d, dict) and d.get("name")]
+            peer.synced = time.time()
+            peer.last_error = None
+            peer.failing_since = None
+            peer.round_trip = time.perf_counter() - start
+
+def _server_time(response):
+    """Seconds the peer spent on the request, from its Server-Timing header."""
+    match = _SERVER_TIMING.search(response.headers.get('Server-Timing', ''))
+    return float(match.group(1)) / 1000 if match else None
+
+federation = Federation(state=shared_state)
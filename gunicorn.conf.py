@@ -0,0 +1,14 @@
+# gunicorn.conf.py
+
+import os
+
+# The workers share logs/*.log, and Python cannot rotate one file from several processes; logrotate does it instead
+os.environ.setdefault('NESTCAST_LOG_ROTATION', 'external')
+
+bind = f"0.0.0.0:{os.environ.get('NESTCAST_PORT', '5030')}"
+workers = int(os.environ.get('NESTCAST_WORKERS', '2'))
+threads = int(os.environ.get('NESTCAST_THREADS', '16'))  # Slow cast requests and event streams each hold one thread
+worker_class = 'gthread'
+timeout = 180             # Longer than FANOUT_TIMEOUT, so a waited send is not killed mid-request
+preload_app = False       # Each worker must open its own SQLite connections and cast sockets
+keepalive = 75            # Peer nodes reuse pooled connections for forwarded requests
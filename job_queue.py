@@ -0,0 +1,367 @@
+# job_queue.py
+
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from chromecast_utils import create_message_audio, combine_message_audio, send_message_to_device
+from device_registry import registry
+from logger_utils import chromecast_logger, carry_context, current_context, log_context
+from shared_state import shared_state
+from metrics import metrics
+from events import event_hub
+
+# Lower runs first, so a doorbell ("high") jumps ahead of a routine reminder ("low")
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+JOB_HISTORY = 500   # Finished jobs kept for /api/jobs/<id> lookups
+JOB_POLL_INTERVAL = 0.1   # Seconds between checks for jobs submitted by other worker processes
+JOB_TRIM_INTERVAL = 60.0  # Seconds between trims of the shared job history
+BATCH_WINDOW = 2.0        # Default seconds a batched message waits for more messages to the same device
+BATCH_MAX_WINDOW = 30.0
+COALESCE_POLL_INTERVAL = 0.05  # Seconds between checks for urgent messages while a lane holds a batch open
+PREPARE_WORKERS = 4       # Clips of one coalesced batch synthesized at the same time
+LANE_IDLE_TIMEOUT = 300.0  # Seconds a device lane waits for work before its thread exits
+
+# Synthesizes the parts of coalesced batches in parallel instead of one after another
+_prepare_pool = ThreadPoolExecutor(max_workers=PREPARE_WORKERS, thread_name_prefix='batch-prepare')
+
+def parse_priority(value):
+    if value is None or value == '':
+        return PRIORITIES["normal"]
+    if str(value).lower() in PRIORITIES:
+        return PRIORITIES[str(value).lower()]
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Unknown priority: {value}")
+
+def _prepare_logged(job):
+    with log_context(job_id=job.id, request_id=job.request_id):
+        job.prepare()
+
+class Job:
+    """One message sent to one or more devices, tracked from queueing to completion."""
+
+    def __init__(self, message, device_names, volume, language, priority, stream=False,
+                 job_id=None, created=None, state=None, coalesce_window=None, request_id=None, chime=False):
+        self.id = job_id or uuid.uuid4().hex
+        self.message = message
+        self.device_names = list(dict.fromkeys(device_names))
+        self.volume = volume
+        self.language = language
+        self.priority = priority
+        self.stream = stream
+        self.coalesce_window = coalesce_window  # None unless queued through a batch
+        self.chime = chime                      # Play the attention chime before the message
+        self.request_id = request_id or current_context().get("request_id")  # Ties lane log lines to the request
+        self.state = state
+        self.status = "queued"
+        self.audio_path = None
+        self.created = created or time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self._results = {}
+        self._error = None
+        self._prepared = False
+        self._prepare_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        """Synthesize the message once, on whichever lane reaches the job first."""
+        with self._prepare_lock:
+            if not self._prepared:
+                try:
+                    self.audio_path = create_message_audio(self.message, self.language, stream=self.stream)
+                except Exception as e:
+                    self._error = e
+                self._prepared = True
+        if self._error is not None:
+            raise self._error
+
+    def payload(self):
+        """The fields another process needs to rebuild this job."""
+        return {
+            "message": self.message,
+            "device_names": self.device_names,
+            "volume": self.volume,
+            "language": self.language,
+            "stream": self.stream,
+            "coalesce_window": self.coalesce_window,
+            "request_id": self.request_id,
+            "chime": self.chime,
+        }
+
+    def mark_running(self):
+        with self._lock:
+            if self.started is not None:
+                return
+            self.started = time.time()
+            self.status = "running"
+            self._persist(started=self.started)
+        event_hub.publish("job", self.to_dict())
+
+    def record(self, device_name, result):
+        with self._lock:
+            self._results[device_name] = result
+            finished = len(self._results) == len(self.device_names)
+            if finished:
+                self.status = "done"
+                self.finished = time.time()
+            # Written under the lock so a slower lane cannot overwrite a newer snapshot
+            self._persist(finished=self.finished,
+                          results=[self._results[d] for d in self.device_names if d in self._results])
+        event_hub.publish("job", self.to_dict())
+        if finished:
+            self.done.set()
+
+    def _persist(self, **fields):
+        if self.state is None:
+            return
+        try:
+            self.state.update_job(self.id, self.status, **fields)
+        except Exception as e:
+            chromecast_logger.error(f"Error saving job {self.id}: {str(e)}")
+
+    def results(self):
+        with self._lock:
+            return [self._results[d] for d in self.device_names if d in self._results]
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "devices": self.device_names,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "results": self.results(),
+        }
+
+class JobQueue:
+    """
+    Message jobs served by one worker lane per device.
+
+    Each lane is a priority queue drained by its own thread, so a slow or
+    unreachable device only delays its own messages. A job targeting several
+    devices is placed on each of their lanes and synthesized once.
+
+    With a shared state, jobs are also recorded there. The lanes run only in
+    the process that called start(); other worker processes submit into the
+    shared table, which that process polls, and read job status back from it.
+    """
+
+    def __init__(self, history=JOB_HISTORY, state=None):
+        self.history = history
+        self.state = state
+        self._running = state is None
+        self._jobs = OrderedDict()
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()  # Keeps FIFO order within a priority level
+
+    def start(self):
+        """Run the device lanes in this process, including jobs submitted by other workers."""
+        if self._running:
+            return
+        self._running = True
+        self.state.recover_jobs()
+        threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True).start()
+
+    def submit(self, message, device_names, volume, language, priority=PRIORITIES["normal"], stream=False,
+               coalesce_window=None, chime=False):
+        """
+        Queue a message. With coalesce_window (seconds), the message may be
+        joined with other batched messages reaching the same device lane
+        within that window, and exact duplicates among them are dropped.
+        """
+        job = Job(message, device_names, volume, language, priority, stream, state=self.state,
+                  coalesce_window=coalesce_window, chime=chime)
+        if self.state is not None:
+            self.state.add_job(job.id, job.priority, job.payload(), job.created, dispatched=self._running)
+        event_hub.publish("job", job.to_dict())
+        if not self._running:
+            chromecast_logger.info(f"Queued job {job.id} for {job.device_names} on the service process")
+            return job
+        self._enqueue(job)
+        chromecast_logger.info(f"Queued job {job.id} for {job.device_names} with priority {priority}")
+        return job
+
+    def status(self, job_id):
+        """Return the job as a dict, from this process or the shared state, or None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.state.job(job_id) if self.state is not None else None
+
+    def wait(self, job_id, timeout):
+        """Wait for a job to finish and return its status dict."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None or self.state is None:
+            if job is not None:
+                job.done.wait(timeout=timeout)
+            return self.status(job_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.state.job(job_id)
+            if status is None or status["status"] in ("done", "failed") or time.monotonic() >= deadline:
+                return status
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def depth(self):
+        """Number of messages waiting on each device lane."""
+        with self._lock:
+            return {device_name: lane.qsize() for device_name, lane in self._lanes.items()}
+
+    def _enqueue(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        for device_name in job.device_names:
+            if not registry.knows(device_name):
+                # No lane for a name that is not a device; a typo would otherwise leave a thread behind
+                job.record(device_name, {"device": device_name, "status": "Error",
+                                         "message": f"Device '{device_name}' not found"})
+                continue
+            self._put(device_name, (job.priority, next(self._seq), job))
+
+    def _dispatch_loop(self):
+        next_trim = time.monotonic() + JOB_TRIM_INTERVAL
+        while True:
+            try:
+                for job_id, priority, created, payload in self.state.take_jobs():
+                    job = Job(priority=priority, job_id=job_id, created=created, state=self.state, **payload)
+                    self._enqueue(job)
+                    chromecast_logger.info(f"Picked up job {job.id} for {job.device_names} with priority {priority}")
+                if time.monotonic() >= next_trim:
+                    self.state.trim_jobs(self.history)
+                    next_trim = time.monotonic() + JOB_TRIM_INTERVAL
+            except Exception as e:
+                chromecast_logger.error(f"Error reading shared job queue: {str(e)}")
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def _trim(self):
+        excess = len(self._jobs) - self.history
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].done.is_set():
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _put(self, device_name, item):
+        # Under the lock, so an idle lane cannot exit between being found here and receiving the item
+        with self._lock:
+            lane = self._lanes.get(device_name)
+            if lane is None:
+                lane = self._lanes[device_name] = queue.PriorityQueue()
+                threading.Thread(target=self._run_lane, args=(device_name, lane),
+                                 name=f'lane-{device_name}', daemon=True).start()
+            lane.put(item)
+
+    def _run_lane(self, device_name, lane):
+        while True:
+            try:
+                _, _, job = lane.get(timeout=LANE_IDLE_TIMEOUT)
+            except queue.Empty:
+                with self._lock:
+                    if lane.empty():
+                        del self._lanes[device_name]
+                        return
+                continue
+            if job.coalesce_window is not None:
+                group = self._coalesce(lane, job)
+                with log_context(job_id=[j.id for j in group], request_id=job.request_id, device=device_name):
+                    self._run_batch(device_name, group)
+                continue
+            with log_context(job_id=job.id, request_id=job.request_id, device=device_name):
+                self._run_job(device_name, job)
+
+    def _run_job(self, device_name, job):
+        metrics.observe("queue_wait", time.time() - job.created, device_name)
+        job.mark_running()
+        try:
+            job.prepare()
+            send_message_to_device(device_name, job.message, job.volume, job.language, audio_path=job.audio_path,
+                                   chime=job.chime)
+            job.record(device_name, {"device": device_name, "status": "Message sent"})
+        except Exception as e:
+            chromecast_logger.error(f"Job {job.id} failed on {device_name}: {str(e)}")
+            job.record(device_name, {"device": device_name, "status": "Error", "message": str(e)})
+
+    def _coalesce(self, lane, first):
+        """
+        Hold a batched job until its window closes, then take the batched jobs
+        queued right behind it with the same priority, volume and chime. A more
+        urgent message closes the window early; everything not taken goes
+        back on the lane in its original order.
+        """
+        deadline = first.created + first.coalesce_window
+        while time.time() < deadline:
+            with lane.mutex:
+                urgent = bool(lane.queue) and lane.queue[0][0] < first.priority
+            if urgent:
+                break
+            time.sleep(min(COALESCE_POLL_INTERVAL, max(0.0, deadline - time.time())))
+        group, rest = [first], []
+        while True:
+            try:
+                item = lane.get_nowait()
+            except queue.Empty:
+                break
+            job = item[2]
+            if not rest and job.coalesce_window is not None and job.priority == first.priority \
+                    and job.volume == first.volume and job.chime == first.chime:
+                group.append(job)
+            else:
+                rest.append(item)
+        for item in rest:
+            lane.put(item)
+        return group
+
+    def _run_batch(self, device_name, group):
+        now = time.time()
+        played, duplicates = [], []
+        seen = {}
+        for job in group:
+            metrics.observe("queue_wait", now - job.created, device_name)
+            job.mark_running()
+            original = seen.setdefault((job.message, job.language), job)
+            if original is job:
+                played.append(job)
+            else:
+                duplicates.append((job, original))
+        if len(group) > 1:
+            chromecast_logger.info(f"Coalesced {len(group)} messages for {device_name} into one clip, "
+                                   f"dropped {len(duplicates)} duplicates")
+            metrics.increment("coalesced_messages", "batch", device_name, amount=len(played))
+            metrics.increment("duplicate_messages", "batch", device_name, amount=len(duplicates))
+        try:
+            list(_prepare_pool.map(carry_context(_prepare_logged), played))
+            if len(played) == 1:
+                audio_path = played[0].audio_path
+            else:
+                audio_path = combine_message_audio([job.audio_path for job in played])
+            message = " ".join(job.message for job in played)
+            send_message_to_device(device_name, message, group[0].volume, group[0].language, audio_path=audio_path,
+                                   chime=group[0].chime)
+        except Exception as e:
+            chromecast_logger.error(f"Batch {[job.id for job in group]} failed on {device_name}: {str(e)}")
+            for job in group:
+                job.record(device_name, {"device": device_name, "status": "Error", "message": str(e)})
+            return
+        result = {"device": device_name, "status": "Message sent"}
+        if len(played) > 1:
+            result["coalesced_with"] = [job.id for job in played]
+        for job in played:
+            job.record(device_name, dict(result))
+        for job, original in duplicates:
+            job.record(device_name, {"device": device_name, "status": "Duplicate dropped", "duplicate_of": original.id})
+
+message_queue = JobQueue(state=shared_state)
@@ -1,16 +1,182 @@
+import atexit
+import contextlib
+import contextvars
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
 
-def setup_logger(name, log_file, level=logging.INFO):
-    handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
+LOG_LEVEL = os.environ.get('NESTCAST_LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+# 'app': this process rotates the files at LOG_MAX_BYTES. 'external': several processes append to the same
+# files and logrotate rotates them; each process reopens a file once it has been moved (set by gunicorn.conf.py)
+LOG_ROTATION = os.environ.get('NESTCAST_LOG_ROTATION', 'app')
+LOG_QUEUE_SIZE = 10000        # Records the file writer may fall behind by; further ones only count towards log_dropped
+DEBUG_SAMPLE_EVERY = int(os.environ.get('NESTCAST_LOG_SAMPLE', '10'))  # Keep 1 in N debug records per call site
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
+# Request and job ids attached to every record logged while they are set
+_context = contextvars.ContextVar('log_context', default={})
 
-    return logger
+# Attributes every LogRecord has; anything else on a record came from extra= and is written as a field
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+def bind_context(**fields):
+    """Attach fields to every record logged from here on; returns a token for reset_context()."""
+    return _context.set({**_context.get(), **fields})
+
+def reset_context(token):
+    _context.reset(token)
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach fields such as request_id or job_id to every record logged inside the block."""
+    token = bind_context(**fields)
+    try:
+        yield
+    finally:
+        reset_context(token)
+
+def current_context():
+    return _context.get()
+
+def carry_context(fn):
+    """
+    Wrap fn so it logs with the caller's context (request_id, job_id, ...)
+    on whichever pool thread runs it. Each call gets its own binding, so the
+    wrapper can be handed to ThreadPoolExecutor.submit or map.
+    """
+    fields = _context.get()
+
+    def run(*args, **kwargs):
+        with log_context(**fields):
+            return fn(*args, **kwargs)
+    return run
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the log context and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != 'context':
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class DebugSampler(logging.Filter):
+    """Keeps every record at INFO and above, and 1 in `every` debug records from each call site."""
+
+    def __init__(self, every=DEBUG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = max(1, every)
+        self._seen = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+        site = (record.pathname, record.lineno)
+        count = self._seen.get(site, 0)
+        self._seen[site] = count + 1   # A lost increment under a race only shifts which line is sampled
+        return count % self.every == 0
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the background writer. The record is only captured
+    here (message merged with its args, log context attached); formatting
+    and file I/O happen on the writer thread. A full queue drops the record
+    instead of blocking the request or cast thread.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        record.context = _context.get()
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _NonBlockingQueueHandler.dropped += 1
+
+class _Writer:
+    """The one background thread that writes every logger's file."""
+
+    def __init__(self):
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._listener = None
+        self._handlers = []
+        self._lock = threading.Lock()
+
+    def add_file(self, name, log_file):
+        if LOG_ROTATION == 'external':
+            handler = WatchedFileHandler(log_file, delay=True)
+        else:
+            handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)
+        handler.setFormatter(JsonFormatter())
+        handler.addFilter(logging.Filter(name))  # Only this logger's records go to its file
+        with self._lock:
+            self._handlers.append(handler)
+            if self._listener is not None:
+                self._listener.stop()
+            self._listener = QueueListener(self.queue, *self._handlers, respect_handler_level=True)
+            self._listener.start()
+
+    def stop(self):
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()   # Writes out everything still queued
+                self._listener = None
+
+_writer = _Writer()
+_configured = {}
+_configured_lock = threading.Lock()
+atexit.register(_writer.stop)
+
+def setup_logger(name, log_file, level=LOG_LEVEL):
+    """
+    Return the named logger writing JSON lines to log_file through the
+    shared background writer. Calling it again for the same name returns
+    the same logger without adding another handler.
+    """
+    with _configured_lock:
+        logger = _configured.get(name)
+        if logger is not None:
+            return logger
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.propagate = False
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        _writer.add_file(name, log_file)
+        handler = _NonBlockingQueueHandler(_writer.queue)
+        handler.addFilter(DebugSampler())
+        logger.addHandler(handler)
+        _configured[name] = logger
+        return logger
+
+def dropped_records():
+    """Records dropped because the writer fell behind."""
+    return _NonBlockingQueueHandler.dropped
 
 # Create logger
-chromecast_logger = setup_logger('chromecast', 'logs/chromecast.log')
\ No newline at end of file
+chromecast_logger = setup_logger('chromecast', 'logs/chromecast.log')
@@ -0,0 +1,357 @@
+# media_queue.py
+
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from chromecast_utils import start_media
+from device_registry import registry
+from events import event_hub
+from logger_utils import chromecast_logger, carry_context, log_context
+from media_types import content_type_resolver
+from metrics import metrics
+from shared_state import shared_state
+
+QUEUE_PRELOAD_SECONDS = 15.0   # The device starts buffering the next item this long before the current one ends
+QUEUE_COMMAND_TIMEOUT = 10.0   # Seconds to wait for the device to answer a queue command
+IMAGE_DURATION = 10.0          # Seconds an image stays on screen when its item gives no duration
+MEDIA_QUEUE_MAX = 200          # Items waiting per device
+MEDIA_POLL_INTERVAL = 0.1      # Seconds between checks for commands submitted by other worker processes
+RESOLVE_WORKERS = 8            # Content-type lookups run at the same time when items are enqueued
+
+_item_ids = itertools.count(1)
+ITEM_DATA_KEY = 'nestcast_item'   # customData field naming the queue item a device is playing
+_resolve_pool = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix='media-resolve')
+
+class MediaQueueFull(Exception):
+    pass
+
+class UnknownDevice(ValueError):
+    pass
+
+class MediaItem:
+    __slots__ = ('id', 'url', 'content_type', 'title', 'duration', 'queue_item_id')
+
+    def __init__(self, url, content_type, title=None, duration=None, id=None):
+        self.id = id or next(_item_ids)
+        self.url = url
+        self.content_type = content_type
+        self.title = title
+        self.duration = duration
+        self.queue_item_id = None  # Assigned by the device once the item is in its queue
+
+    @property
+    def is_image(self):
+        return self.content_type.startswith('image/')
+
+    def to_dict(self):
+        return {"id": self.id, "url": self.url, "content_type": self.content_type,
+                "title": self.title, "duration": self.duration}
+
+def resolve_items(items):
+    """
+    Turn request items ({"url", "content_type"?, "title"?, "duration"?}) into
+    dicts with a content type, looking up the unknown ones in parallel so
+    nothing is resolved while the device waits for its next item.
+    """
+    def resolve(item):
+        url = item.get("url") if isinstance(item, dict) else None
+        if not url:
+            raise ValueError("Every item needs a url")
+        duration = item.get("duration")
+        return {"url": url, "content_type": item.get("content_type") or content_type_resolver.resolve(url),
+                "title": item.get("title"), "duration": float(duration) if duration is not None else None}
+    return list(_resolve_pool.map(carry_context(resolve), items))
+
+class _DeviceQueue:
+    """
+    One device's queue. Every change runs on the device's own thread, in
+    order, so cast commands never block the connection thread that delivers
+    media status.
+    """
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.pending = deque()
+        self.current = None        # Item playing on the device
+        self.next = None           # Item already in the device's queue, buffering for a gapless start
+        self.volume = None         # Left as the device has it until an enqueue sets one
+        self.queue_supported = True
+        self.last_error = None
+        self.slide_timer = None
+        self.slide_item = None
+        self.published = None
+        self.tasks = queue.Queue()
+
+    def to_dict(self):
+        return {
+            "device": self.device_name,
+            "current": self.current.to_dict() if self.current else None,
+            "next": self.next.to_dict() if self.next else None,
+            "pending": [item.to_dict() for item in self.pending],
+            "last_error": self.last_error,
+        }
+
+class MediaQueues:
+    """
+    Per-device media queues for clips, streams and image slideshows.
+
+    The first item is loaded with play_media. After that the next item is
+    always inserted into the device's own queue with a preload time, so the
+    device buffers it while the current one plays and moves on without a
+    gap. Images have no natural end, so the next slide is triggered after
+    the item's duration. Media status callbacks tell which item is playing.
+
+    Like the job lanes, the queues run only in the process that called
+    start(); other worker processes pass their commands through the shared
+    state and read the queue status back from it.
+    """
+
+    def __init__(self, state=None):
+        self.state = state
+        self._running = state is None
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        threading.Thread(target=self._command_loop, name='media-commands', daemon=True).start()
+
+    def enqueue(self, device_name, items, volume=None):
+        """Append resolved items (see resolve_items) to a device's queue."""
+        self._command(device_name, "enqueue", {"items": items, "volume": volume})
+
+    def skip(self, device_name):
+        self._command(device_name, "skip", {})
+
+    def clear(self, device_name, stop=False):
+        """Drop the waiting items; with stop=True also stop the current one."""
+        self._command(device_name, "clear", {"stop": stop})
+
+    def status(self, device_name):
+        with self._lock:
+            dq = self._queues.get(device_name)
+        if dq is not None:
+            # The snapshot taken on the device's thread; reading the live deque here could race with it
+            return dq.published or dq.to_dict()
+        if self.state is not None:
+            status = self.state.media_queue(device_name)
+            if status is not None:
+                return status
+        return {"device": device_name, "current": None, "next": None, "pending": [], "last_error": None}
+
+    def _command(self, device_name, command, payload):
+        if not registry.knows(device_name):
+            # Every queue owns a thread, so none is created for a name that is not a device
+            raise UnknownDevice(f"Device '{device_name}' not found")
+        if not self._running:
+            self.state.add_media_command(device_name, command, payload)
+            return
+        dq = self._queue(device_name)
+        if command == "enqueue" and len(dq.pending) + len(payload["items"]) > MEDIA_QUEUE_MAX:
+            raise MediaQueueFull(f"The queue for {device_name} holds at most {MEDIA_QUEUE_MAX} items")
+        dq.tasks.put((getattr(self, f"_do_{command}"), (payload,)))
+
+    def _command_loop(self):
+        while True:
+            try:
+                for device_name, command, payload in self.state.take_media_commands():
+                    try:
+                        self._command(device_name, command, payload)
+                    except (MediaQueueFull, UnknownDevice) as e:
+                        chromecast_logger.warning(str(e))
+            except Exception as e:
+                chromecast_logger.error(f"Error reading shared media commands: {str(e)}")
+            time.sleep(MEDIA_POLL_INTERVAL)
+
+    def _queue(self, device_name):
+        with self._lock:
+            dq = self._queues.get(device_name)
+            if dq is not None:
+                return dq
+            dq = self._queues[device_name] = _DeviceQueue(device_name)
+        registry.playback(device_name).add_listener(
+            lambda status: dq.tasks.put((self._on_status, (status.content_id, _status_item_id(status),
+                                                           status.player_state, status.idle_reason))))
+        threading.Thread(target=self._run, args=(dq,), name=f'media-{device_name}', daemon=True).start()
+        return dq
+
+    def _run(self, dq):
+        while True:
+            action, args = dq.tasks.get()
+            try:
+                with log_context(device=dq.device_name):
+                    action(dq, *args)
+            except Exception as e:
+                dq.last_error = str(e)
+                chromecast_logger.error(f"Media queue error on {dq.device_name}: {str(e)}")
+            # Position updates arrive often and change nothing; only publish real changes
+            status = dq.to_dict()
+            if status != dq.published:
+                dq.published = status
+                self._publish(dq.device_name, status)
+
+    # Commands, run on the device's thread
+
+    def _do_enqueue(self, dq, payload):
+        if payload.get("volume") is not None:
+            dq.volume = payload["volume"]
+        dq.pending.extend(MediaItem(**item) for item in payload["items"])
+        self._advance(dq)
+
+    def _do_skip(self, dq, payload):
+        if dq.next is not None:
+            self._cast(dq).media_controller.queue_next(timeout=QUEUE_COMMAND_TIMEOUT)
+        elif dq.pending:
+            dq.current = None
+            self._advance(dq)
+        elif dq.current is not None:
+            self._cast(dq).media_controller.stop()
+            dq.current = None
+
+    def _do_clear(self, dq, payload):
+        dq.pending.clear()
+        if dq.next is not None:
+            if dq.next.queue_item_id is not None:
+                self._queue_command(dq, {"type": "QUEUE_REMOVE", "itemIds": [dq.next.queue_item_id]})
+            dq.next = None
+        if payload.get("stop") and dq.current is not None:
+            self._cast(dq).media_controller.stop()
+            dq.current = None
+        self._cancel_slide(dq)
+
+    def _on_status(self, dq, content_id, item_id, player_state, idle_reason):
+        if _is_playing(dq.next, content_id, item_id) and player_state != 'IDLE':
+            # The device moved on to the item it had preloaded
+            dq.current, dq.next = dq.next, None
+            self._advance(dq)
+        elif _is_playing(dq.current, content_id, item_id) and player_state == 'IDLE':
+            if idle_reason == 'ERROR':
+                dq.last_error = f"{dq.current.url} failed to play"
+            if idle_reason in ('FINISHED', 'ERROR') and dq.next is None:
+                dq.current = None
+                self._advance(dq)
+            elif idle_reason == 'CANCELLED' or (idle_reason == 'INTERRUPTED' and dq.next is None):
+                # Stopped, or replaced by other media; the waiting items stay until the next command
+                dq.current, dq.next = None, None
+                self._cancel_slide(dq)
+
+    def _next_slide(self, dq, item):
+        if dq.current is item:
+            self._do_skip(dq, {})
+
+    # Helpers
+
+    def _advance(self, dq):
+        """Start the first waiting item if nothing plays, and keep one item preloaded behind the current one."""
+        while dq.current is None and dq.pending:
+            item = dq.pending.popleft()
+            try:
+                start_media(dq.device_name, self._cast(dq), item.url, item.content_type, dq.volume,
+                            media_info={"customData": {ITEM_DATA_KEY: item.id}})
+            except Exception as e:
+                dq.last_error = f"{item.url}: {e}"
+                chromecast_logger.error(f"Could not play {item.url} on {dq.device_name}: {str(e)}")
+                continue
+            dq.current = item
+            dq.next = None
+        if dq.current is not None and dq.next is None and dq.pending and dq.queue_supported:
+            self._insert(dq, dq.pending.popleft())
+        self._schedule_slide(dq)
+
+    def _insert(self, dq, item):
+        media = {"contentId": item.url, "contentType": item.content_type, "streamType": "BUFFERED",
+                 "metadata": {"metadataType": 0, "title": item.title} if item.title else {},
+                 "customData": {ITEM_DATA_KEY: item.id}}
+        with metrics.timer("queue_insert", dq.device_name):
+            ok, response = self._queue_command(dq, {"type": "QUEUE_INSERT", "items": [
+                {"media": media, "autoplay": True, "startTime": 0, "preloadTime": QUEUE_PRELOAD_SECONDS}]})
+        if not ok:
+            # Without a device-side queue, items are loaded one by one when the previous one ends
+            chromecast_logger.warning(f"{dq.device_name} did not accept a queue insert; loading items one at a time")
+            dq.queue_supported = False
+            dq.pending.appendleft(item)
+            return
+        item.queue_item_id = _queue_item_id(response, item)
+        dq.next = item
+
+    def _queue_command(self, dq, message):
+        mc = self._cast(dq).media_controller
+        if mc.status is None or mc.status.media_session_id is None:
+            return False, None
+        message["mediaSessionId"] = mc.status.media_session_id
+        answered = threading.Event()
+        reply = [False, None]
+
+        def callback(ok, response):
+            reply[:] = [ok, response]
+            answered.set()
+
+        mc.send_message(message, inc_session_id=True, callback_function=callback)
+        answered.wait(QUEUE_COMMAND_TIMEOUT)
+        return reply[0], reply[1]
+
+    def _schedule_slide(self, dq):
+        item = dq.current
+        if dq.slide_timer is not None and dq.slide_item is item:
+            return  # This slide's time is already running
+        self._cancel_slide(dq)
+        if item is None or not item.is_image or not (dq.next or dq.pending):
+            return
+        dq.slide_item = item
+        dq.slide_timer = threading.Timer(item.duration or IMAGE_DURATION,
+                                         lambda: dq.tasks.put((self._next_slide, (item,))))
+        dq.slide_timer.daemon = True
+        dq.slide_timer.start()
+
+    def _cancel_slide(self, dq):
+        if dq.slide_timer is not None:
+            dq.slide_timer.cancel()
+            dq.slide_timer = None
+            dq.slide_item = None
+
+    def _cast(self, dq):
+        return registry.get(dq.device_name)
+
+    def _publish(self, device_name, status):
+        if self.state is not None:
+            try:
+                self.state.put_media_queue(device_name, status)
+            except Exception as e:
+                chromecast_logger.error(f"Error publishing media queue of {device_name}: {str(e)}")
+        event_hub.publish("media_queue", status)
+
+def _status_item_id(status):
+    """Our item id carried in the media's customData, or None for media the queue did not load."""
+    custom_data = getattr(status, 'media_custom_data', None)
+    return custom_data.get(ITEM_DATA_KEY) if isinstance(custom_data, dict) else None
+
+def _is_playing(item, content_id, item_id):
+    """
+    Whether a status is about item. The id tells apart two queue entries
+    with the same URL; the URL check keeps a stale id (pychromecast keeps
+    the last customData when new media has none) from matching other media.
+    """
+    return item is not None and content_id == item.url and (item_id is None or item_id == item.id)
+
+def _queue_item_id(response, item):
+    """
+    Find the device's itemId for item in the media status sent back after a
+    queue insert: the entry carrying its id, else the last one with its URL.
+    """
+    found = None
+    for status in (response or {}).get("status", []):
+        for entry in status.get("items", []):
+            media = entry.get("media") or {}
+            if (media.get("customData") or {}).get(ITEM_DATA_KEY) == item.id:
+                return entry.get("itemId")
+            if media.get("contentId") == item.url:
+                found = entry.get("itemId")
+    return found
+
+media_queues = MediaQueues(state=shared_state)
@@ -0,0 +1,152 @@
+# media_types.py
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+import requests
+
+from logger_utils import chromecast_logger
+
+# Known file extensions and their corresponding MIME types
+EXTENSION_MIME_TYPES = {
+    'mp4': 'video/mp4',
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg',
+    'webm': 'video/webm',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif'
+}
+
+# Audio files served from /audio/, by extension
+AUDIO_MIME_TYPES = {
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg',
+    'flac': 'audio/flac',
+    'aac': 'audio/aac',
+    'm4a': 'audio/mp4',
+    'wma': 'audio/x-ms-wma'
+}
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+PROBE_TIMEOUT = 5.0       # Seconds for the HEAD request
+RANGE_GET_TIMEOUT = 3.0   # Seconds for the one-byte GET used when a server rejects HEAD
+CACHE_TTL = 3600.0        # Seconds a resolved content type is reused
+FAILURE_TTL = 60.0        # Seconds a failed lookup is remembered before retrying the network
+CACHE_MAX_ENTRIES = 1024
+
+# One pass over the URL finds the first known extension that is not part of a longer word
+_EXTENSION_PATTERN = re.compile(
+    r'\.(' + '|'.join(sorted(map(re.escape, EXTENSION_MIME_TYPES), key=len, reverse=True)) + r')(?![a-z0-9])')
+
+def mime_type_for_path(path):
+    """Return the MIME type for a path ending in a known extension, or None."""
+    _, dot, ext = path.lower().rpartition('.')
+    return EXTENSION_MIME_TYPES.get(ext) if dot else None
+
+def audio_mime_type(filename):
+    """Return the MIME type for an audio file name, defaulting to MP3."""
+    _, dot, ext = filename.lower().rpartition('.')
+    return AUDIO_MIME_TYPES.get(ext, 'audio/mpeg') if dot else 'audio/mpeg'
+
+def guess_mime_type(url):
+    """Return the MIME type of the first known extension anywhere in the URL, or None."""
+    match = _EXTENSION_PATTERN.search(url.lower())
+    return EXTENSION_MIME_TYPES[match.group(1)] if match else None
+
+class ContentTypeResolver:
+    """
+    Works out the MIME type of a media URL with as little network traffic as possible.
+
+    A known extension in the path needs no request at all. Otherwise the
+    server is asked once over a pooled HTTP session, with HEAD and, if the
+    server rejects HEAD, a bounded one-byte ranged GET. The answer is cached
+    per URL; failures are cached for a shorter time so an unreachable server
+    is not retried on every request.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, failure_ttl=FAILURE_TTL, max_entries=CACHE_MAX_ENTRIES, ranged_get=True):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.ranged_get = ranged_get
+        self.session = requests.Session()
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # url -> (expires, content type or None)
+        self._lock = threading.Lock()
+
+    def resolve(self, url):
+        content_type = mime_type_for_path(urlparse(unquote(url)).path)
+        if content_type:
+            return content_type
+
+        content_type = self._cached(url)
+        if content_type is False:
+            content_type = self._probe(url)
+            self._store(url, content_type)
+        if content_type:
+            return content_type
+
+        # If all else fails, try to guess the content type from the URL
+        return guess_mime_type(url) or DEFAULT_CONTENT_TYPE
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _cached(self, url):
+        """Return the cached content type (None for a cached failure), or False on a miss."""
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(url)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return False
+
+    def _store(self, url, content_type):
+        ttl = self.ttl if content_type else self.failure_ttl
+        with self._lock:
+            self._cache[url] = (time.monotonic() + ttl, content_type)
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _probe(self, url):
+        try:
+            response = self.session.head(url, timeout=PROBE_TIMEOUT, allow_redirects=True)
+            content_type = _header_content_type(response)
+            if content_type and response.ok:
+                return content_type
+        except requests.RequestException as e:
+            chromecast_logger.warning(f"HEAD request failed for {url}: {str(e)}")
+
+        if not self.ranged_get:
+            return None
+        try:
+            with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True,
+                                  timeout=RANGE_GET_TIMEOUT, allow_redirects=True) as response:
+                return _header_content_type(response) if response.ok else None
+        except requests.RequestException as e:
+            chromecast_logger.warning(f"Ranged GET failed for {url}: {str(e)}")
+            return None
+
+def _header_content_type(response):
+    # Drop parameters such as "; charset=utf-8", which Chromecasts do not expect
+    return response.headers.get('content-type', '').split(';')[0].strip().lower() or None
+
+content_type_resolver = ContentTypeResolver()
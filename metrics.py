@@ -0,0 +1,202 @@
+# metrics.py
+
+import bisect
+import os
+import threading
+import time
+
+from logger_utils import chromecast_logger
+
+# Upper bounds in seconds; covers everything from a cached lookup to a whole announcement
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+METRICS_FLUSH_INTERVAL = 5.0   # Seconds between snapshots shared with the other worker processes
+METRICS_MAX_AGE = 60.0         # Snapshots from workers silent for longer than this are ignored
+
+class Histogram:
+    """Fixed-bucket latency histogram; observe() is one bisect and three additions."""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def to_dict(self):
+        return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'device', 'start')
+
+    def __init__(self, metrics, stage, device):
+        self.metrics = metrics
+        self.stage = stage
+        self.device = device
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.device)
+        if exc_type is not None:
+            self.metrics.increment('stage_errors', self.stage, self.device)
+        return False
+
+class Metrics:
+    """
+    In-process latency histograms and counters, labelled by stage and device.
+
+    Recording takes one short lock, so the instrumentation stays on in
+    production. Gauges such as queue depth and cache statistics are read
+    from registered callbacks only when /metrics is scraped. With a shared
+    state, each worker process publishes its snapshot periodically and
+    collect() merges them, so any worker can answer a scrape.
+    """
+
+    def __init__(self):
+        self._histograms = {}   # (stage, device) -> Histogram
+        self._counters = {}     # (name, label, device) -> int
+        self._gauges = {}       # name -> callback returning {label: value}
+        self._lock = threading.Lock()
+        self._state = None
+
+    def timer(self, stage, device=''):
+        """Context manager timing a stage; exceptions are counted as stage_errors."""
+        return _Timer(self, stage, device or '')
+
+    def observe(self, stage, seconds, device=''):
+        key = (stage, device or '')
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, label='', device='', amount=1):
+        key = (name, label, device or '')
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauge(self, name, callback):
+        """callback() returns {label: number}, read at scrape time."""
+        self._gauges[name] = callback
+
+    def snapshot(self):
+        with self._lock:
+            histograms = [[stage, device, h.to_dict()] for (stage, device), h in self._histograms.items()]
+            counters = [[name, label, device, value] for (name, label, device), value in self._counters.items()]
+        gauges = []
+        for name, callback in self._gauges.items():
+            try:
+                gauges.extend([name, str(label), value] for label, value in callback().items())
+            except Exception as e:
+                chromecast_logger.error(f"Error reading gauge {name}: {str(e)}")
+        return {"histograms": histograms, "counters": counters, "gauges": gauges}
+
+    def share(self, state, interval=METRICS_FLUSH_INTERVAL):
+        """Publish this process's snapshot to state every interval seconds."""
+        if self._state is not None:
+            return
+        self._state = state
+        threading.Thread(target=self._flush_loop, args=(interval,), name='metrics-flush', daemon=True).start()
+
+    def collect(self):
+        """Snapshot merged with the latest snapshots of the other worker processes."""
+        snapshots = [self.snapshot()]
+        if self._state is not None:
+            try:
+                snapshots += self._state.metrics_snapshots(METRICS_MAX_AGE, exclude_pid=os.getpid())
+            except Exception as e:
+                chromecast_logger.error(f"Error reading shared metrics: {str(e)}")
+        return merge_snapshots(snapshots)
+
+    def _flush_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self._state.put_metrics(os.getpid(), self.snapshot())
+            except Exception as e:
+                chromecast_logger.error(f"Error publishing metrics: {str(e)}")
+
+def merge_snapshots(snapshots):
+    histograms, counters, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        for stage, device, h in snapshot["histograms"]:
+            merged = histograms.setdefault((stage, device), {"counts": [0] * len(h["counts"]), "sum": 0.0, "count": 0})
+            merged["counts"] = [a + b for a, b in zip(merged["counts"], h["counts"])]
+            merged["sum"] += h["sum"]
+            merged["count"] += h["count"]
+        for name, label, device, value in snapshot["counters"]:
+            counters[(name, label, device)] = counters.get((name, label, device), 0) + value
+        for name, label, value in snapshot["gauges"]:
+            gauges[(name, label)] = gauges.get((name, label), 0) + value
+    return {"histograms": histograms, "counters": counters, "gauges": gauges}
+
+def render_json(merged):
+    stages = {}
+    for (stage, device), h in sorted(merged["histograms"].items()):
+        stages.setdefault(stage, {})[device or "all"] = {
+            "count": h["count"],
+            "sum": h["sum"],
+            "mean": h["sum"] / h["count"] if h["count"] else 0.0,
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], _cumulative(h["counts"]))),
+        }
+    counters = {}
+    for (name, label, device), value in sorted(merged["counters"].items()):
+        counters.setdefault(name, {})[":".join(p for p in (label, device) if p) or "all"] = value
+    gauges = {}
+    for (name, label), value in sorted(merged["gauges"].items()):
+        gauges.setdefault(name, {})[label] = value
+    return {"stages": stages, "counters": counters, "gauges": gauges, "cache_hit_rate": _hit_rates(merged["gauges"])}
+
+def render_prometheus(merged):
+    lines = ["# TYPE nestcast_stage_seconds histogram"]
+    for (stage, device), h in sorted(merged["histograms"].items()):
+        labels = f'stage="{_escape(stage)}",device="{_escape(device)}"'
+        for bound, total in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], _cumulative(h["counts"])):
+            lines.append(f'nestcast_stage_seconds_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'nestcast_stage_seconds_sum{{{labels}}} {h["sum"]}')
+        lines.append(f'nestcast_stage_seconds_count{{{labels}}} {h["count"]}')
+    names = sorted({name for name, _, _ in merged["counters"]})
+    for name in names:
+        lines.append(f"# TYPE nestcast_{name}_total counter")
+        for (n, label, device), value in sorted(merged["counters"].items()):
+            if n == name:
+                lines.append(f'nestcast_{name}_total{{label="{_escape(label)}",device="{_escape(device)}"}} {value}')
+    names = sorted({name for name, _ in merged["gauges"]})
+    for name in names:
+        lines.append(f"# TYPE nestcast_{name} gauge")
+        for (n, label), value in sorted(merged["gauges"].items()):
+            if n == name:
+                lines.append(f'nestcast_{name}{{label="{_escape(label)}"}} {value}')
+    lines.append("# TYPE nestcast_cache_hit_rate gauge")
+    for cache, rate in sorted(_hit_rates(merged["gauges"]).items()):
+        lines.append(f'nestcast_cache_hit_rate{{label="{_escape(cache)}"}} {rate}')
+    return "\n".join(lines) + "\n"
+
+def _cumulative(counts):
+    total, result = 0, []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+def _hit_rates(gauges):
+    # Hit rates are recomputed from the summed counts, since rates cannot be added across processes
+    rates = {}
+    for (name, cache), hits in gauges.items():
+        if name == "cache_hits":
+            lookups = hits + gauges.get(("cache_misses", cache), 0)
+            rates[cache] = hits / lookups if lookups else 0.0
+    return rates
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
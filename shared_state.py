@@ -0,0 +1,344 @@
+# shared_state.py
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from logger_utils import chromecast_logger
+
+STATE_DIR = os.environ.get('NESTCAST_STATE_DIR', os.path.join(tempfile.gettempdir(), 'nestcast_state'))
+STATE_DB = os.path.join(STATE_DIR, 'state.sqlite3')
+SERVICE_LOCK_FILE = os.path.join(STATE_DIR, 'services.lock')
+DB_TIMEOUT = 5.0   # Seconds a writer waits for another process to release the database
+# Queued announcements and media commands older than this are dropped after a restart instead of played
+JOB_MAX_AGE = float(os.environ.get('NESTCAST_JOB_MAX_AGE', '600'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    uuid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    model TEXT,
+    cast_type TEXT,
+    manufacturer TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    priority INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    dispatched INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    results TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS jobs_undispatched ON jobs (dispatched, priority, created);
+CREATE TABLE IF NOT EXISTS health (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS media_commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device TEXT NOT NULL,
+    command TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS media_queues (
+    device TEXT PRIMARY KEY,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS peers (
+    url TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    pid INTEGER PRIMARY KEY,
+    snapshot TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+class SharedState:
+    """
+    SQLite-backed state shared by every worker process on this host.
+
+    The process that owns discovery and the job lanes publishes the device
+    table and job progress here; the other workers read the device table,
+    submit jobs and poll their status. Each thread gets its own connection,
+    and WAL mode lets readers proceed while the owner writes.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(media_commands)')}
+        if 'created' not in columns:
+            # State databases from before commands were timestamped; their old rows count as expired
+            conn.execute('ALTER TABLE media_commands ADD COLUMN created REAL NOT NULL DEFAULT 0')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DB_TIMEOUT, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def version(self):
+        """Changes whenever another connection commits, so followers can skip unchanged reads."""
+        return self._connect().execute('PRAGMA data_version').fetchone()[0]
+
+    # Device table
+
+    def put_devices(self, devices):
+        """Replace the device table with dicts holding uuid, name, ip, port, model, cast_type and manufacturer."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM devices')
+            conn.executemany(
+                'INSERT INTO devices (uuid, name, ip, port, model, cast_type, manufacturer) '
+                'VALUES (:uuid, :name, :ip, :port, :model, :cast_type, :manufacturer)', devices)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def devices(self):
+        rows = self._connect().execute('SELECT * FROM devices').fetchall()
+        return [dict(row) for row in rows]
+
+    # Jobs
+
+    def add_job(self, job_id, priority, payload, created, dispatched):
+        self._connect().execute(
+            'INSERT INTO jobs (id, priority, payload, status, dispatched, created) VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, priority, json.dumps(payload), 'queued', int(dispatched), created))
+
+    def update_job(self, job_id, status, started=None, finished=None, results=None):
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, started = COALESCE(?, started), finished = COALESCE(?, finished), '
+            'results = COALESCE(?, results) WHERE id = ?',
+            (status, started, finished, None if results is None else json.dumps(results), job_id))
+
+    def job(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row['id'],
+            "status": row['status'],
+            "priority": row['priority'],
+            "devices": json.loads(row['payload'])['device_names'],
+            "created": row['created'],
+            "started": row['started'],
+            "finished": row['finished'],
+            "results": json.loads(row['results']),
+        }
+
+    def take_jobs(self):
+        """Claim every job not yet handed to a lane, highest priority first, as (id, priority, created, payload)."""
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM jobs WHERE dispatched = 0 LIMIT 1').fetchone() is None:
+            return []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, priority, created, payload FROM jobs WHERE dispatched = 0 '
+                'ORDER BY priority, created').fetchall()
+            conn.executemany('UPDATE jobs SET dispatched = 1 WHERE id = ?', [(row['id'],) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [(row['id'], row['priority'], row['created'], json.loads(row['payload'])) for row in rows]
+
+    def recover_jobs(self, max_age=JOB_MAX_AGE):
+        """
+        Called by a new owner: jobs the previous owner claimed but never started
+        are queued again, and jobs it was running are marked failed. Queued
+        jobs older than max_age are marked failed too, so a restart hours
+        later does not play stale announcements.
+        """
+        conn = self._connect()
+        now = time.time()
+        expired = conn.execute("SELECT id, payload, created FROM jobs WHERE status = 'queued' AND created < ?",
+                               (now - max_age,)).fetchall()
+        for row in expired:
+            message = f"Expired: queued {now - row['created']:.0f}s ago, before the service restarted"
+            results = [{"device": d, "status": "Error", "message": message}
+                       for d in json.loads(row['payload'])['device_names']]
+            conn.execute("UPDATE jobs SET status = 'failed', dispatched = 1, finished = ?, results = ? WHERE id = ?",
+                         (now, json.dumps(results), row['id']))
+        if expired:
+            chromecast_logger.warning(f"Dropped {len(expired)} queued jobs older than {max_age:.0f}s")
+        conn.execute("UPDATE jobs SET dispatched = 0 WHERE status = 'queued'")
+        for row in conn.execute("SELECT id, payload, results FROM jobs WHERE status = 'running'").fetchall():
+            # Devices that had not reported yet get a result, so callers see why the job ended
+            results = json.loads(row['results'])
+            reported = {r.get("device") for r in results}
+            results += [{"device": d, "status": "Error", "message": "Interrupted: the service process restarted"}
+                        for d in json.loads(row['payload'])['device_names'] if d not in reported]
+            conn.execute("UPDATE jobs SET status = 'failed', finished = ?, results = ? WHERE id = ?",
+                         (now, json.dumps(results), row['id']))
+
+    def trim_jobs(self, keep):
+        self._connect().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND id NOT IN "
+            "(SELECT id FROM jobs ORDER BY created DESC LIMIT ?)", (keep,))
+
+    # Device health
+
+    def put_health(self, name, status):
+        self._connect().execute('INSERT OR REPLACE INTO health (name, status) VALUES (?, ?)', (name, json.dumps(status)))
+
+    def health(self):
+        rows = self._connect().execute('SELECT name, status FROM health').fetchall()
+        return {row['name']: json.loads(row['status']) for row in rows}
+
+    # Events
+
+    def add_events(self, events):
+        """Insert (type, data) events in one transaction, in order."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO events (type, data) VALUES (?, ?)',
+                             [(event_type, json.dumps(data)) for event_type, data in events])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def events_after(self, event_id):
+        rows = self._connect().execute(
+            'SELECT id, type, data FROM events WHERE id > ? ORDER BY id', (event_id,)).fetchall()
+        return [(row['id'], row['type'], json.loads(row['data'])) for row in rows]
+
+    def last_event_id(self):
+        return self._connect().execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def trim_events(self, keep):
+        self._connect().execute('DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?', (keep,))
+
+    # Media queues
+
+    def add_media_command(self, device, command, payload):
+        self._connect().execute('INSERT INTO media_commands (device, command, payload, created) VALUES (?, ?, ?, ?)',
+                                (device, command, json.dumps(payload), time.time()))
+
+    def take_media_commands(self, max_age=JOB_MAX_AGE):
+        """
+        Remove and return pending media queue commands in submission order, as
+        (device, command, payload). Commands older than max_age, left over
+        from before a restart, are removed without being returned.
+        """
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM media_commands LIMIT 1').fetchone() is None:
+            return []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT id, device, command, payload, created FROM media_commands ORDER BY id').fetchall()
+            if rows:
+                conn.execute('DELETE FROM media_commands WHERE id <= ?', (rows[-1]['id'],))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        cutoff = time.time() - max_age
+        expired = sum(1 for row in rows if row['created'] < cutoff)
+        if expired:
+            chromecast_logger.warning(f"Dropped {expired} media queue commands older than {max_age:.0f}s")
+        return [(row['device'], row['command'], json.loads(row['payload'])) for row in rows if row['created'] >= cutoff]
+
+    def put_media_queue(self, device, status):
+        self._connect().execute('INSERT OR REPLACE INTO media_queues (device, status) VALUES (?, ?)',
+                                (device, json.dumps(status)))
+
+    def media_queue(self, device):
+        row = self._connect().execute('SELECT status FROM media_queues WHERE device = ?', (device,)).fetchone()
+        return json.loads(row['status']) if row is not None else None
+
+    # Federation
+
+    def put_peer(self, url, name):
+        self._connect().execute('INSERT OR REPLACE INTO peers (url, name) VALUES (?, ?)', (url, name))
+
+    def delete_peer(self, url):
+        self._connect().execute('DELETE FROM peers WHERE url = ?', (url,))
+
+    def peers(self):
+        """Nodes that registered with any worker on this host, as (url, name)."""
+        return [(row['url'], row['name']) for row in self._connect().execute('SELECT url, name FROM peers')]
+
+    # Metrics
+
+    def put_metrics(self, pid, snapshot):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO metrics (pid, snapshot, updated) VALUES (?, ?, ?)',
+            (pid, json.dumps(snapshot), time.time()))
+
+    def metrics_snapshots(self, max_age, exclude_pid=None):
+        """Latest snapshot of every other worker that published within max_age seconds."""
+        conn = self._connect()
+        cutoff = time.time() - max_age
+        conn.execute('DELETE FROM metrics WHERE updated < ?', (cutoff,))
+        rows = conn.execute('SELECT snapshot FROM metrics WHERE pid IS NOT ?', (exclude_pid,)).fetchall()
+        return [json.loads(row['snapshot']) for row in rows]
+
+class ServiceLock:
+    """
+    Host-wide lock electing the one process that runs discovery and the job lanes.
+
+    The operating system releases the lock when its holder exits, so another
+    worker can take over by calling acquire() again.
+    """
+
+    def __init__(self, path=SERVICE_LOCK_FILE):
+        self.path = path
+        self.held = False
+        self._file = None
+
+    def acquire(self):
+        if self.held:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        f = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        self.held = True
+        chromecast_logger.info(f"Process {os.getpid()} runs discovery and the job lanes")
+        return True
+
+shared_state = SharedState()
+service_lock = ServiceLock()
@@ -17,6 +17,21 @@ document.addEventListener('DOMContentLoaded', function() {
     const volumeInput = document.getElementById('volume');
     const volumeValueSpan = document.getElementById('volume-value');
 
+    // Live updates from the server replace polling where the browser supports them
+    const events = window.EventSource ? new EventSource('/api/events') : null;
+    const playerStates = {};
+    let deviceListTimer = null;
+
+    if (events) {
+        events.addEventListener('snapshot', e => {
+            const snapshot = JSON.parse(e.data);
+            Object.values(snapshot.player || {}).forEach(showPlayerState);
+        });
+        events.addEventListener('device', scheduleDeviceListUpdate);
+        events.addEventListener('health', scheduleDeviceListUpdate);
+        events.addEventListener('player', e => showPlayerState(JSON.parse(e.data)));
+    }
+
     // Initialize device list on page load
     updateDeviceList();
     populate_tts_languages();
@@ -44,7 +59,27 @@ document.addEventListener('DOMContentLoaded', function() {
         return Array.from(document.querySelectorAll('input[name="devices"]:checked')).map(input => input.value);
     }
 
+    // Discovery announcements arrive in bursts; rebuild the list once they settle
+    function scheduleDeviceListUpdate() {
+        clearTimeout(deviceListTimer);
+        deviceListTimer = setTimeout(updateDeviceList, 500);
+    }
+
+    function showPlayerState(status) {
+        playerStates[status.device] = status.player_state;
+        const label = document.querySelector(`.device-state[data-device="${CSS.escape(status.device)}"]`);
+        if (label) {
+            label.textContent = playerStateText(status.device);
+        }
+    }
+
+    function playerStateText(deviceName) {
+        const state = playerStates[deviceName];
+        return state && state !== 'IDLE' && state !== 'UNKNOWN' ? state.toLowerCase() : '';
+    }
+
     function updateDeviceList() {   
+        const selected = new Set(getSelectedDevices());
         loadingDevices.style.display = 'block';
         axios.get('/api/devices')
             .then(response => {
@@ -54,10 +89,12 @@ document.addEventListener('DOMContentLoaded', function() {
                         <div class="device-list">
                             ${response.data.map(device => `
                                 <div class="device-item">
-                                    <input type="checkbox" name="devices" value="${device.name}" id="${device.name}">
+                                    <input type="checkbox" name="devices" value="${device.name}" id="${device.name}" ${selected.has(device.name) ? 'checked' : ''}>
                                     <label for="${device.name}">
                                         <span class="device-name">${device.name}</span>
-                                        <span class="device-ip">${device.ip}</span>
+                                        <span class="device-ip">${device.node ? `${device.ip} via ${device.node}` : device.ip}</span>
+                                        ${device.health && device.health.state === 'unavailable' ? '<span class="device-health">Unavailable</span>' : ''}
+                                        <span class="device-state" data-device="${device.name}">${playerStateText(device.name)}</span>
                                     </label>
                                 </div>
                             `).join('')}
@@ -76,24 +113,24 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
 
+    // The voice catalog is revalidated with its ETag, so repeat visits get a 304 instead of the list
     function populate_tts_languages() {
-        console.log('Attempting to fetch tts_languages.txt');
-        fetch('/static/txt/tts_languages.txt')  // or .html if you kept it as HTML
+        fetch('/api/voices')
             .then(response => {
                 if (!response.ok) {
                     throw new Error(`HTTP error! status: ${response.status}`);
                 }
-                return response.text();
+                return response.json();
             })
-            .then(data => {
-                console.log('Successfully loaded tts_languages.txt');
+            .then(voices => {
                 const languageSelect = document.getElementById('language');
-                if (languageSelect) {
-                    languageSelect.innerHTML = data;
-                    console.log('Populated language select');
-                } else {
+                if (!languageSelect) {
                     console.error('Language select element not found');
+                    return;
                 }
+                const options = document.createDocumentFragment();
+                voices.forEach(voice => options.appendChild(new Option(voice.label, voice.name)));
+                languageSelect.replaceChildren(options);
             })
             .catch(error => {
                 console.error('Error loading languages:', error);
@@ -113,13 +150,22 @@ document.addEventListener('DOMContentLoaded', function() {
         formData.append('language', language);
         formData.append('volume', volumeValue);
         formData.append('devices', JSON.stringify(selectedDevices));
+        formData.append('chime', document.getElementById('chime').checked);
         axios.post('/api/send_message', formData)
+            .then(response => response.data.job_id ? waitForJob(response.data.job_id).then(done => {
+                // Devices on other nodes run their own jobs; keep what their nodes reported
+                const forwarded = (response.data.results || []).filter(result => result.node);
+                done.data.results = (done.data.results || []).concat(forwarded);
+                return done;
+            }) : response)
             .then(response => {
-                if (response.data.results) {
+                if (response.data.results && response.data.results.length) {
                     const messages = response.data.results.map(result =>
                         `${result.device}: ${result.status}${result.message ? ' - ' + result.message : ''}`
                     );
                     alert(messages.join('\n'));
+                } else if (response.data.status === 'failed') {
+                    alert('Failed to send message: the job did not finish');
                 } else {
                     alert('Message sent!');
                 }
@@ -134,6 +180,44 @@ document.addEventListener('DOMContentLoaded', function() {
             });
     }
 
+    // A job ends "done", or "failed" when it expired or the service restarted under it
+    const JOB_END_STATES = ['done', 'failed'];
+
+    // Messages are queued server-side; wait for the job's end event, polling
+    // slowly as a backstop (or quickly without EventSource) in case the stream drops
+    function waitForJob(jobId) {
+        const waiting = {done: false};
+        const finished = response => {
+            waiting.done = true;
+            return response;
+        };
+        const polled = pollJob(jobId, events ? 5000 : 500, waiting);
+        if (!events) {
+            return polled.then(finished);
+        }
+        const pushed = new Promise(resolve => {
+            const onJob = e => {
+                const job = JSON.parse(e.data);
+                if (job.job_id === jobId && JOB_END_STATES.includes(job.status)) {
+                    events.removeEventListener('job', onJob);
+                    resolve({data: job});
+                }
+            };
+            events.addEventListener('job', onJob);
+        });
+        return Promise.race([pushed, polled]).then(finished);
+    }
+
+    function pollJob(jobId, interval, waiting) {
+        return axios.get(`/api/jobs/${jobId}`).then(response => {
+            if (JOB_END_STATES.includes(response.data.status) || waiting.done) {
+                return response;
+            }
+            return new Promise(resolve => setTimeout(resolve, interval))
+                .then(() => pollJob(jobId, interval, waiting));
+        });
+    }
+
     function handleDiscoverDevices() {
         discoverBtn.textContent = 'Discovering...';
         discoverBtn.disabled = true;
@@ -372,6 +456,7 @@ document.addEventListener('DOMContentLoaded', function() {
         formData.append('audio', file);
         formData.append('devices', JSON.stringify(selectedDevices));
         formData.append('volume', volumeValue);
+        formData.append('chime', document.getElementById('chime').checked);
 
         const button = action === 'play' ? playAudioBtn : streamBtn;
         button.textContent = `${action === 'play' ? 'Playing' : 'Streaming'}...`;
@@ -0,0 +1,96 @@
+# tests/test_audio_processing.py
+#
+# Runs the app against the simulated devices and Edge TTS from benchmarks/fakes.py,
+# with a stand-in ffmpeg that records its inputs into the clip it writes.
+#
+#   python -m pytest tests
+
+import json
+import os
+import stat
+import sys
+import tempfile
+import textwrap
+import unittest
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+# Writes "chime" for each generated input and the bytes of each file input, in order
+FAKE_FFMPEG = textwrap.dedent('''\
+    import sys
+    args = sys.argv[1:]
+    out = b''
+    for i, arg in enumerate(args):
+        if arg == '-i':
+            source = args[i + 1]
+            if source.startswith('sine='):
+                out += b'chime'
+            else:
+                with open(source, 'rb') as f:
+                    out += f.read()
+    with open(args[-1], 'wb') as f:
+        f.write(out)
+''')
+
+DEVICE = "Test Speaker"
+
+class LongMessageChimeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        workdir = tempfile.mkdtemp(prefix='nestcast_test_')
+        tempfile.tempdir = workdir
+        os.environ['NESTCAST_STATE_DIR'] = os.path.join(workdir, 'state')
+        os.makedirs(os.path.join(workdir, 'logs'))
+        cls._cwd = os.getcwd()
+        os.chdir(workdir)
+
+        ffmpeg = os.path.join(workdir, 'ffmpeg')
+        with open(ffmpeg, 'w') as f:
+            f.write(f"#!{sys.executable}\n{FAKE_FFMPEG}")
+        os.chmod(ffmpeg, os.stat(ffmpeg).st_mode | stat.S_IEXEC)
+
+        from fakes import FakeConfig, install
+        install(FakeConfig(connect_delay=0.0, command_delay=0.0, playback=0.05, fetch_audio=False,
+                           tts_delay=0.05, tts_first_chunk=0.01))
+
+        import app as nestcast
+        import chromecast_utils
+        from audio_processing import audio_processor
+        from device_registry import device_browser, registry
+        from job_queue import message_queue
+        from shared_state import service_lock
+
+        audio_processor.ffmpeg, audio_processor.enabled = ffmpeg, True
+        nestcast.get_local_ip = chromecast_utils.get_local_ip = lambda: '127.0.0.1'
+        device_browser._apply([{"uuid": str(uuid.uuid5(uuid.NAMESPACE_DNS, DEVICE)), "name": DEVICE,
+                                "ip": "127.0.1.1", "port": 8009, "model": "Fake", "cast_type": "audio",
+                                "manufacturer": "Test"}])
+        service_lock.acquire()
+        message_queue.start()
+        cls.client = nestcast.app.test_client()
+        cls.registry = registry
+        cls.processor = audio_processor
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls._cwd)
+
+    def test_long_message_with_chime_plays_the_chime(self):
+        message = "This is a long announcement that would normally be streamed. " * 5
+        response = self.client.post('/api/send_message', data={
+            "message": message, "devices": json.dumps([DEVICE]), "chime": "true", "wait": "true"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["results"], [{"device": DEVICE, "status": "Message sent"}])
+
+        played = self.registry.get(DEVICE).media_controller.status.content_id
+        name = played.rsplit('/audio/', 1)[1]
+        self.assertFalse(name.startswith('stream/'), "a chime cannot be added to a streamed message")
+        path = self.processor.cache.lookup_file(name)
+        self.assertIsNotNone(path, "the device was not given the processed clip")
+        with open(path, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'chime'), "the chime does not come first")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# tts_cache.py
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from logger_utils import chromecast_logger
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'nestcast_tts')
+CACHE_MAX_BYTES = int(os.environ.get('NESTCAST_TTS_CACHE_BYTES', 200 * 1024 * 1024))  # Disk budget for synthesized clips
+CACHE_MIN_AGE = 60.0                  # Never evict a clip younger than this; a device may still be fetching it
+PARTIAL_SUFFIX = '.part'              # Files still being written into a cache directory
+CACHE_SCAN_INTERVAL = 30.0            # Seconds between the janitor's scans for files other workers wrote or deleted
+
+class AudioCache:
+    """
+    Content-addressed disk cache for synthesized speech and uploaded audio.
+
+    Clips are stored as <sha256 of text, voice and rate>.mp3, so a repeated
+    announcement is served from disk without contacting Edge TTS. Entries are
+    kept in least-recently-used order. Every worker process writes into the
+    same directory, so only the process that called start_janitor() (the
+    service process) evicts: its janitor rescans the directory before each
+    pass and evicts the oldest files whenever it holds more than max_bytes.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, suffix='.mp3'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._janitor = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256('\0'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Return the cached file path for key, or None on a miss."""
+        with self._lock:
+            if key in self._entries and os.path.exists(self.path_for(key)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self.path_for(key)
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            elif self._adopt(key):
+                self.hits += 1
+                return self.path_for(key)
+            self.misses += 1
+        return None
+
+    def put(self, key, source_path):
+        """Move a freshly written file into the cache and return its cached path."""
+        path = self.path_for(key)
+        os.replace(source_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self._wakeup.set()
+        return path
+
+    def lookup_file(self, filename):
+        """Return the path of a cached file by its served name, or None."""
+        key = self._key_for_name(filename)
+        if key is None:
+            return None
+        with self._lock:
+            if key in self._entries and os.path.exists(self.path_for(key)):
+                self._entries.move_to_end(key)
+            elif key in self._entries:
+                # Evicted by the service process
+                self._total_bytes -= self._entries.pop(key)
+                return None
+            elif not self._adopt(key):
+                return None
+        return self.path_for(key)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _adopt(self, key):
+        # Another worker process may have written the file since this one loaded the directory
+        path = self.path_for(key)
+        if key.startswith('.') or not os.path.isfile(path):
+            return False
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        self._entries[key] = size
+        self._total_bytes += size
+        return True
+
+    def _key_for_name(self, filename):
+        if not filename.endswith(self.suffix) or filename.endswith(PARTIAL_SUFFIX):
+            return None
+        return filename[:len(filename) - len(self.suffix)]
+
+    def _load(self):
+        # Rebuild LRU order from the files left by a previous run, oldest access first
+        files = []
+        for name in os.listdir(self.directory):
+            key = self._key_for_name(name)
+            if not key:
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((st.st_atime, key, st.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def start_janitor(self):
+        """Evict from this process, for every worker sharing the directory."""
+        if self._janitor is None:
+            self._janitor = threading.Thread(target=self._janitor_loop, name='tts-cache-janitor', daemon=True)
+            self._janitor.start()
+
+    def _janitor_loop(self):
+        while True:
+            try:
+                self._rescan()
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+            except Exception as e:
+                chromecast_logger.error(f"Error evicting TTS cache entries: {str(e)}")
+            self._wakeup.wait(CACHE_SCAN_INTERVAL)
+            self._wakeup.clear()
+
+    def _rescan(self):
+        # Count what other workers wrote or deleted since the last pass; their new files count as recently used
+        on_disk = []
+        for name in os.listdir(self.directory):
+            key = self._key_for_name(name)
+            if not key:
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            on_disk.append((st.st_atime, key, st.st_size))
+        sizes = {key: size for _, key, size in on_disk}
+        with self._lock:
+            for key in [key for key in self._entries if key not in sizes]:
+                if not os.path.exists(self.path_for(key)):   # Not just put() since the listing
+                    del self._entries[key]
+            for _, key, size in sorted(on_disk):
+                self._entries[key] = size   # Known keys keep their place in the LRU order
+            self._total_bytes = sum(self._entries.values())
+
+    def _evict(self):
+        now = time.time()
+        victims = []
+        with self._lock:
+            # Least recently used first; entries a device may still be fetching are skipped, not a reason to stop
+            for key, size in list(self._entries.items()):
+                if self._total_bytes <= self.max_bytes:
+                    break
+                path = self.path_for(key)
+                try:
+                    if now - os.path.getmtime(path) < CACHE_MIN_AGE:
+                        continue
+                except OSError:
+                    pass
+                del self._entries[key]
+                self._total_bytes -= size
+                self.evictions += 1
+                victims.append(path)
+        for path in victims:
+            try:
+                os.unlink(path)
+                chromecast_logger.info(f"Evicted cached audio file: {path}")
+            except OSError as e:
+                chromecast_logger.error(f"Error deleting audio file {path}: {str(e)}")
+
+tts_cache = AudioCache()
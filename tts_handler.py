@@ -1,12 +1,74 @@
-from gtts import gTTS
 import tempfile
-import edge_tts
 import asyncio
+import importlib
+import concurrent.futures
 import os
+import threading
+import time
 
 from logger_utils import chromecast_logger
+from tts_cache import tts_cache, PARTIAL_SUFFIX
+from metrics import metrics
+
+STREAM_CHUNK_TIMEOUT = 30.0   # Seconds a reader waits for the next chunk before giving up
+TTS_CONCURRENCY = 4           # Edge TTS requests allowed in flight at once
+STREAM_TAIL_INTERVAL = 0.05   # Seconds between reads of a clip another process is still writing
+STREAM_READ_BYTES = 64 * 1024
+
+# Streams still being synthesized, by cache key
+_streams = {}
+_streams_lock = threading.Lock()
+
+# Synthesis futures still running, by cache key, so identical requests share one
+_pending = {}
+_pending_lock = threading.Lock()
+
+class SynthesisLoop:
+    """
+    One asyncio event loop on a background thread, shared by every synthesis.
+
+    submit() is thread-safe and returns a concurrent.futures.Future, so Flask
+    and worker threads can start several syntheses and wait on them together
+    without building a new event loop per message. At most `concurrency`
+    coroutines run against Edge TTS at the same time.
+    """
+
+    def __init__(self, concurrency=TTS_CONCURRENCY):
+        self.concurrency = concurrency
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def submit(self, coro):
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._limited(coro), loop)
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+                threading.Thread(target=self._loop.run_forever, name='tts-loop', daemon=True).start()
+            return self._loop
+
+    async def _limited(self, coro):
+        async with self._semaphore:
+            return await coro
+
+tts_loop = SynthesisLoop()
+
+def preload():
+    """
+    Import edge_tts (and aiohttp with it) on a background thread.
+
+    The import costs a noticeable part of startup on a Raspberry Pi, so it
+    is kept out of the module imports and done once the server is up,
+    before the first message needs it.
+    """
+    threading.Thread(target=importlib.import_module, args=('edge_tts',), name='tts-preload', daemon=True).start()
 
 def create_audio_file_gtts(message, lang='en'):
+    from gtts import gTTS  # Only needed by this fallback, so not imported at startup
     try:
         tts = gTTS(text=message, lang=lang)
         with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as fp:
@@ -16,17 +78,6 @@ def create_audio_file_gtts(message, lang='en'):
         chromecast_logger.error(f"Error creating audio file: {str(e)}")
         raise
 
-def delete_audio_file(filepath):
-    global audio_files
-    try:
-        if os.path.exists(filepath):
-            os.unlink(filepath)
-        if filepath in audio_files:
-            del audio_files[filepath]
-        chromecast_logger.info(f"Deleted audio file: {filepath}")
-    except Exception as e:
-        chromecast_logger.error(f"Error deleting audio file {filepath}: {str(e)}")
-        
 async def create_audio_file_edge(message, voice="sv-SE-MattiasNeural", rate="+0%"):
     try:
         # Create a temporary file with .mp3 extension
@@ -34,16 +85,181 @@ async def create_audio_file_edge(message, voice="sv-SE-MattiasNeural", rate="+0%
             file_path = fp.name
 
         # Create TTS object and generate audio
+        import edge_tts
         communicate = edge_tts.Communicate(message, voice, rate=rate)
         await communicate.save(file_path)
 
-        print(f"Audio file created successfully. Size: {os.path.getsize(file_path)} bytes")
+        chromecast_logger.info(f"Audio file created successfully. Size: {os.path.getsize(file_path)} bytes")
         return file_path
     except Exception as e:
-        print(f"Error creating audio file: {str(e)}")
+        chromecast_logger.error(f"Error creating audio file: {str(e)}")
         raise
 
-def create_custom_audio_file_edge(message, lang):
-    file_path = asyncio.run(create_audio_file_edge(message, voice=lang, rate="-5%"))
-    print(f"Audio file created at: {file_path}")
-    return file_path
\ No newline at end of file
+def submit_custom_audio_file_edge(message, lang, rate="-5%"):
+    """
+    Start synthesizing a message on the shared event loop.
+
+    Returns a concurrent.futures.Future resolving to the cached file path.
+    Cache hits resolve immediately and identical in-flight requests share a
+    future, so callers can submit several messages and wait on them together.
+    """
+    # Identical text, voice and rate always produce the same clip, so reuse it
+    key = tts_cache.make_key(message, lang, rate)
+    file_path = tts_cache.get(key)
+    if file_path:
+        chromecast_logger.debug(f"Audio file served from cache: {file_path}")
+        future = concurrent.futures.Future()
+        future.set_result(file_path)
+        return future
+
+    with _pending_lock:
+        future = _pending.get(key)
+        if future is None:
+            future = tts_loop.submit(_synthesize_to_cache(key, message, lang, rate))
+            _pending[key] = future
+            future.add_done_callback(lambda _: _pop_pending(key))
+    return future
+
+def _pop_pending(key):
+    with _pending_lock:
+        _pending.pop(key, None)
+
+async def _synthesize_to_cache(key, message, voice, rate):
+    with metrics.timer("tts_synthesis"):
+        file_path = tts_cache.put(key, await create_audio_file_edge(message, voice=voice, rate=rate))
+    chromecast_logger.info(f"Audio file created at: {file_path}")
+    return file_path
+
+def create_custom_audio_file_edge(message, lang, rate="-5%"):
+    return submit_custom_audio_file_edge(message, lang, rate).result()
+
+class SynthesisStream:
+    """
+    An Edge TTS clip that can be read while it is still being synthesized.
+
+    Chunks from Communicate.stream() are kept in memory for concurrent
+    readers and written to a partial file next to the cache entry, which
+    moves into place once synthesis completes. Worker processes that do not
+    hold the stream read the partial file instead (see follow_partial_stream).
+    """
+
+    def __init__(self, key, message, voice, rate):
+        self.key = key
+        self.message = message
+        self.voice = voice
+        self.rate = rate
+        self.error = None
+        self._chunks = []
+        self._done = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        tts_loop.submit(self._run())
+
+    async def _run(self):
+        file_path = partial_path(self.key)
+        try:
+            with metrics.timer("tts_synthesis"), open(file_path, 'wb') as f:
+                await self._synthesize(f)
+            tts_cache.put(self.key, file_path)
+            chromecast_logger.info(f"Streamed audio file cached at: {tts_cache.path_for(self.key)}")
+        except Exception as e:
+            self.error = e
+            chromecast_logger.error(f"Error streaming audio: {str(e)}")
+            if os.path.exists(file_path):
+                os.unlink(file_path)
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+            # Cached before removal, so late readers always find the clip somewhere
+            with _streams_lock:
+                _streams.pop(self.key, None)
+
+    async def _synthesize(self, f):
+        import edge_tts
+        communicate = edge_tts.Communicate(self.message, self.voice, rate=self.rate)
+        start = time.perf_counter()
+        async for chunk in communicate.stream():
+            if chunk["type"] != "audio":
+                continue
+            if start is not None:
+                # Playback can begin once the first chunk exists
+                metrics.observe("tts_first_chunk", time.perf_counter() - start)
+                start = None
+            f.write(chunk["data"])
+            with self._cond:
+                self._chunks.append(chunk["data"])
+                self._cond.notify_all()
+
+    def iter_chunks(self):
+        """Yield every chunk from the start, blocking until more arrive or synthesis ends."""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._chunks) and not self._done:
+                    if not self._cond.wait(timeout=STREAM_CHUNK_TIMEOUT):
+                        chromecast_logger.warning(f"Audio stream {self.key} stalled, closing reader")
+                        return
+                chunks = self._chunks[index:]
+                done = self._done
+            index += len(chunks)
+            yield from chunks
+            if done and index >= len(self._chunks):
+                return
+
+def start_custom_audio_stream_edge(message, lang, rate="-5%"):
+    """
+    Start synthesizing a message for streaming playback.
+
+    Returns (key, file_path). file_path is set when the clip is already cached
+    and can be served as a file; otherwise the clip is readable through
+    get_audio_stream(key) while it is produced.
+    """
+    key = tts_cache.make_key(message, lang, rate)
+    file_path = tts_cache.get(key)
+    if file_path:
+        return key, file_path
+
+    with _streams_lock:
+        if key not in _streams:
+            _streams[key] = SynthesisStream(key, message, lang, rate)
+            _streams[key].start()
+    return key, None
+
+def get_audio_stream(key):
+    with _streams_lock:
+        return _streams.get(key)
+
+def partial_path(key):
+    return tts_cache.path_for(key) + PARTIAL_SUFFIX
+
+def follow_partial_stream(key):
+    """
+    Return a chunk iterator over a clip that another worker process is still
+    synthesizing, or None if no such clip is being written.
+    """
+    path = partial_path(key)
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    return _tail(f, path, key)
+
+def _tail(f, path, key):
+    with f:
+        last_data = time.monotonic()
+        while True:
+            chunk = f.read(STREAM_READ_BYTES)
+            if chunk:
+                last_data = time.monotonic()
+                yield chunk
+                continue
+            if not os.path.exists(path):
+                # Moved into the cache (or abandoned); the open file still has everything written
+                yield from iter(lambda: f.read(STREAM_READ_BYTES), b'')
+                return
+            if time.monotonic() - last_data > STREAM_CHUNK_TIMEOUT:
+                chromecast_logger.warning(f"Audio stream {key} stalled, closing reader")
+                return
+            time.sleep(STREAM_TAIL_INTERVAL)
\ No newline at end of file
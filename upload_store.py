@@ -0,0 +1,146 @@
+# upload_store.py
+
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+from logger_utils import chromecast_logger
+from tts_cache import AudioCache, PARTIAL_SUFFIX
+
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), 'nestcast_uploads')
+UPLOAD_MAX_BYTES = int(os.environ.get('NESTCAST_UPLOAD_BYTES', 500 * 1024 * 1024))  # Disk budget for uploaded audio
+UPLOAD_MAX_FILE_BYTES = 100 * 1024 * 1024  # Largest single upload accepted
+UPLOAD_SPOOL_BYTES = 1024 * 1024           # Uploads smaller than this never touch the disk unless they are new
+UPLOAD_CHUNK_BYTES = 64 * 1024
+STALE_PART_AGE = 3600.0                    # Partial uploads older than this are left over from a crash
+
+# Uploaded files are named <sha256 of contents>.<extension>, so the served name already carries the type
+upload_cache = AudioCache(UPLOAD_DIR, UPLOAD_MAX_BYTES, suffix='')
+
+class HashingUpload(io.RawIOBase):
+    """
+    Upload target that hashes the file while the form parser writes it.
+
+    Small files stay in memory; once an upload grows past spool_bytes it
+    continues into a partial file in the upload directory, so a large file
+    never sits in memory and a new one can be moved into the store without
+    being copied. A partial file that is never stored is deleted on close.
+    """
+
+    def __init__(self, directory=UPLOAD_DIR, spool_bytes=UPLOAD_SPOOL_BYTES):
+        self.directory = directory
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self.part_path = None
+        self._sha256 = hashlib.sha256()
+        self._file = io.BytesIO()
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        self._sha256.update(data)
+        self.size += len(data)
+        if self.part_path is None and self.size > self.spool_bytes:
+            self._roll_over()
+        return self._file.write(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def detach_part(self):
+        """Close and hand over the partial file, or write the in-memory buffer to one first."""
+        if self.part_path is None:
+            fd, self.part_path = tempfile.mkstemp(dir=self.directory, suffix=PARTIAL_SUFFIX)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._file.getbuffer())
+        self._file.close()
+        path, self.part_path = self.part_path, None
+        return path
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            if self.part_path is not None:
+                _unlink(self.part_path)
+                self.part_path = None
+        super().close()
+
+    def _roll_over(self):
+        fd, self.part_path = tempfile.mkstemp(dir=self.directory, suffix=PARTIAL_SUFFIX)
+        spooled = self._file
+        self._file = os.fdopen(fd, 'w+b')
+        self._file.write(spooled.getbuffer())
+        spooled.close()
+
+def upload_stream_factory(total_content_length, content_type, filename, content_length=None):
+    """Stream factory for the form parser: every uploaded file is hashed as it arrives."""
+    return HashingUpload()
+
+def store_upload(file_storage, extension):
+    """
+    Put an uploaded file into the content-addressed store and return its served name.
+
+    Identical files are stored once; uploading a clip that is already in the
+    store writes nothing to disk.
+    """
+    stream = file_storage.stream
+    if not isinstance(stream, HashingUpload):
+        # Parsed without upload_stream_factory, so hash it now in chunks
+        hashed = HashingUpload()
+        stream.seek(0)
+        for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_BYTES), b''):
+            hashed.write(chunk)
+        stream = hashed
+
+    key = f"{stream.hexdigest()}.{extension.lstrip('.').lower()}"
+    try:
+        if upload_cache.get(key):
+            chromecast_logger.info(f"Upload already stored as {key}")
+            return key
+        upload_cache.put(key, stream.detach_part())
+        chromecast_logger.info(f"Stored upload {file_storage.filename} as {key} ({stream.size} bytes)")
+        return key
+    finally:
+        stream.close()
+
+def remove_stale_parts(directory=UPLOAD_DIR, max_age=STALE_PART_AGE):
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.endswith(PARTIAL_SUFFIX) and now - os.path.getmtime(path) > max_age:
+                _unlink(path)
+        except OSError:
+            pass
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        chromecast_logger.error(f"Error deleting partial upload {path}: {str(e)}")
+
+remove_stale_parts()
@@ -0,0 +1,193 @@
+# voice_catalog.py
+#
+# Compiles static/txt/tts_languages.txt into static/json/voices.json and
+# serves lookups from it. Run after editing the voice list:
+#
+#   python voice_catalog.py            # compile
+#   python voice_catalog.py --check    # also compare the names with the live Edge TTS voice list
+
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from logger_utils import chromecast_logger
+
+VOICE_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'txt', 'tts_languages.txt')
+VOICE_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'json', 'voices.json')
+VOICE_RESPONSES_MAX = 256   # Serialized query responses kept, least recently used dropped first
+
+_OPTION = re.compile(r'<option\s+value="([^"]+)"\s*>([^<]*)</option>')
+_LABEL = re.compile(r'^(?P<language>.+?) \((?P<gender>Female|Male), (?P<region>.+)\)$')
+# Edge neural voice names: <language>-<REGION>[-<variant>]-<Name>Neural, e.g. zh-CN-liaoning-XiaobeiNeural
+_VOICE_NAME = re.compile(r'^(?P<locale>[a-z]{2,3}-[A-Z]{2}(?:-[A-Za-z]+)?)-[A-Za-z]+Neural$')
+
+class VoiceCatalogError(ValueError):
+    pass
+
+def compile_catalog(source=VOICE_SOURCE):
+    """
+    Parse the <option> list into voice records, in the order of the file.
+
+    Raises VoiceCatalogError for a name that is not an Edge neural voice
+    name or a label that is not "Language (Gender, Region)". Repeated voices
+    keep their first position.
+    """
+    with open(source, encoding='utf-8') as f:
+        text = f.read()
+    voices, seen, errors = [], set(), []
+    for name, label in _OPTION.findall(text):
+        label = html.unescape(label).strip()
+        name_match, label_match = _VOICE_NAME.match(name), _LABEL.match(label)
+        if name_match is None:
+            errors.append(f"{name}: not an Edge neural voice name")
+            continue
+        if label_match is None:
+            errors.append(f"{name}: label '{label}' is not 'Language (Gender, Region)'")
+            continue
+        if name in seen:
+            continue
+        seen.add(name)
+        voices.append({
+            "name": name,
+            "locale": name_match.group('locale'),
+            "language": label_match.group('language'),
+            "region": label_match.group('region'),
+            "gender": label_match.group('gender'),
+            "label": label,
+        })
+    if errors:
+        raise VoiceCatalogError("; ".join(errors))
+    return voices
+
+def write_catalog(voices, path=VOICE_CATALOG):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(voices, f, ensure_ascii=False, indent=1)
+        f.write('\n')
+
+class VoiceCatalog:
+    """
+    The compiled voice list, indexed by name, locale, language code and gender.
+
+    Loaded from voices.json on first use, or compiled from the source list if
+    that is missing or older. Responses for each distinct query are
+    serialized once and carry an ETag, so browsers revalidate with a 304
+    instead of downloading and parsing the list again. Queries are keyed by
+    their normalized filters, with every value the catalog does not know
+    folded into one, so arbitrary query strings cannot grow the cache.
+    """
+
+    def __init__(self, catalog=VOICE_CATALOG, source=VOICE_SOURCE):
+        self.catalog = catalog
+        self.source = source
+        self._voices = None
+        self._by_name = {}
+        self._by_locale = {}
+        self._by_language = {}
+        self._by_gender = {}
+        self._responses = OrderedDict()  # normalized query -> (body, etag), least recently used first
+        self._lock = threading.Lock()
+
+    def voices(self):
+        self._ensure_loaded()
+        return self._voices
+
+    def get(self, name):
+        self._ensure_loaded()
+        return self._by_name.get(name)
+
+    def search(self, locale=None, language=None, gender=None):
+        """
+        Voices matching every given filter, in catalog order. locale is a
+        full locale ("en-GB") or a language code ("en"); gender is matched
+        case-insensitively.
+        """
+        self._ensure_loaded()
+        candidates = None
+        if locale:
+            index = self._by_locale if '-' in locale else self._by_language
+            candidates = index.get(locale.lower(), [])
+        if language:
+            matches = self._by_language.get(language.lower(), [])
+            candidates = matches if candidates is None else [v for v in candidates if v in matches]
+        if gender:
+            matches = self._by_gender.get(gender.lower(), [])
+            candidates = matches if candidates is None else [v for v in candidates if v in matches]
+        return list(self._voices if candidates is None else candidates)
+
+    def response(self, locale=None, language=None, gender=None):
+        """Return (JSON body, ETag) for a query, built once per distinct query."""
+        self._ensure_loaded()
+        query = (self._normalize(locale, self._by_locale if locale and '-' in locale else self._by_language),
+                 self._normalize(language, self._by_language),
+                 self._normalize(gender, self._by_gender))
+        with self._lock:
+            cached = self._responses.get(query)
+            if cached is not None:
+                self._responses.move_to_end(query)
+                return cached
+        body = json.dumps(self.search(*query), ensure_ascii=False).encode('utf-8')
+        cached = (body, hashlib.sha256(body).hexdigest()[:32])
+        with self._lock:
+            self._responses[query] = cached
+            while len(self._responses) > VOICE_RESPONSES_MAX:
+                self._responses.popitem(last=False)
+        return cached
+
+    @staticmethod
+    def _normalize(value, index):
+        # '?' is in no index, so every unknown value shares one (empty) response
+        if not value:
+            return ''
+        value = value.lower()
+        return value if value in index else '?'
+
+    def _ensure_loaded(self):
+        if self._voices is not None:
+            return
+        with self._lock:
+            if self._voices is None:
+                self._index(self._load())
+
+    def _load(self):
+        try:
+            if os.path.getmtime(self.catalog) >= os.path.getmtime(self.source):
+                with open(self.catalog, encoding='utf-8') as f:
+                    return json.load(f)
+        except OSError:
+            pass
+        chromecast_logger.info(f"Compiling voice catalog from {self.source}")
+        return compile_catalog(self.source)
+
+    def _index(self, voices):
+        for voice in voices:
+            self._by_name[voice["name"]] = voice
+            self._by_locale.setdefault(voice["locale"].lower(), []).append(voice)
+            self._by_language.setdefault(voice["locale"].split('-')[0], []).append(voice)
+            self._by_gender.setdefault(voice["gender"].lower(), []).append(voice)
+        self._voices = voices
+
+def check_against_edge(voices):
+    """Names in the catalog that the Edge TTS service does not offer (needs network access)."""
+    import asyncio
+    import edge_tts
+    available = {v["ShortName"] for v in asyncio.run(edge_tts.list_voices())}
+    return [v["name"] for v in voices if v["name"] not in available]
+
+voice_catalog = VoiceCatalog()
+
+if __name__ == '__main__':
+    voices = compile_catalog()
+    write_catalog(voices)
+    print(f"Wrote {len(voices)} voices to {VOICE_CATALOG}")
+    if '--check' in sys.argv[1:]:
+        try:
+            unknown = check_against_edge(voices)
+        except Exception as e:
+            sys.exit(f"Could not fetch the Edge TTS voice list: {e}")
+        print(f"Not offered by Edge TTS: {', '.join(unknown)}" if unknown else "All voices are offered by Edge TTS")
+        sys.exit(1 if unknown else 0)
@@ -0,0 +1,8 @@
+# wsgi.py
+#
+# Production entry point, e.g.: gunicorn -c gunicorn.conf.py wsgi:app
+
+from app import app, start_services
+
+# Safe in every worker: only one process on the host ends up running discovery and the job lanes
+start_services()